@@ -25,10 +25,18 @@ import string
 import re
 import sys
 import collections as coll
+import functools
 import os
 import urllib
 import warnings
 import gzip
+import hashlib
+import itertools
+import json
+import sqlite3
+import threading
+import multiprocessing as mp
+import numpy as np
 import pandas as pd
 
 __version__ = '4.3.0'
@@ -36,6 +44,17 @@ __version__ = '4.3.0'
 # Supress Biopython translation warning when translating sequences where length % 3 != 0
 warnings.filterwarnings("ignore")
 
+# Codon lookup for batch translation: bases are coded A/C/G/T/N = 0-4 (255 for anything else),
+# and codon_table holds the amino acid for codon code 25 * first + 5 * second + third, as translated by Biopython
+nt_bases = 'ACGTN'
+nt_codes = np.full(256, 255, dtype=np.uint8)
+nt_codes[np.frombuffer(nt_bases.encode(), dtype=np.uint8)] = np.arange(len(nt_bases))
+codon_table = np.frombuffer(''.join([str(Seq(''.join(codon)).translate())
+                                     for codon in itertools.product(nt_bases, repeat=3)]).encode(), dtype=np.uint8)
+
+# Number of DCRs translated together by cdr3translator
+translation_batch_size = 10000
+
 # TODO Potentially add a flag to combine convergent recombinations into a single row?
 
 def findfile(filename):
@@ -52,7 +71,7 @@ def findfile(filename):
         sys.exit()
 
 
-def read_tcr_file(species, tagset, gene, filetype, expected_dir_name):
+def read_tcr_file(species, tagset, gene, filetype, expected_dir_name, chain):
     """
     Reads in the associated data for the appropriate TCR locus from the ancillary files (hosted in own repo)
     :param species: human or mouse
@@ -60,6 +79,7 @@ def read_tcr_file(species, tagset, gene, filetype, expected_dir_name):
     :param gene: V or J
     :param filetype: tag/fasta/translate/cdrs
     :param expected_dir_name: (by default) Decombinator-Tags-FASTAs
+    :param chain: a/b/g/d
     :return: the opened file (either locally or remotely)
     """
     # Define expected file name
@@ -100,6 +120,10 @@ def sort_permissions(fl):
         os.chmod(fl, 0o666)
 
 
+# Gene data already read in by import_gene_information, by (species, tag set, chain, tag/FASTA directory)
+gene_information_cache = {}
+gene_information_lock = threading.Lock()
+
 def import_gene_information(inputargs):
     """
     Obtains gene-specific information for translation
@@ -116,10 +140,11 @@ def import_gene_information(inputargs):
     :param inputargs: command line (argparse) input arguments dictionary
     :return: Multiple items of TCR data: the V regions (sequence), J regions (sequence), V gene names,
     J gene names, V conserved C translate positions, V conserved position residue identidy, J conserved F
-    translate position, J conserved position residue identity, V gene functionality, J gene functionality
+    translate position, J conserved position residue identity, V gene functionality, J gene functionality,
+    V CDR1s, V CDR2s, V translations, J translations (in each of the three frames), V conserved C presence,
+    compiled J conserved motifs
     """
 
-    global chainnams, chain
     chain = inputargs['chain']
 
     if inputargs['tags'] == "extended" and inputargs['species'] == "mouse":
@@ -141,33 +166,48 @@ def import_gene_information(inputargs):
               "If mouse is required by default, consider changing the default value in the script.")
         sys.exit()
 
+    # Gene data is only read in once per species, tag set, chain and directory, e.g. when translating many samples
+    cache_key = (inputargs['species'], inputargs['tags'], chain, inputargs['tagfastadir'])
+    with gene_information_lock:
+        if cache_key not in gene_information_cache:
+            gene_information_cache[cache_key] = read_gene_information(inputargs['species'], inputargs['tags'], chain,
+                                                                      inputargs['tagfastadir'])
+        return gene_information_cache[cache_key]
+
+
+def read_gene_information(species, tagset, chain, tagfastadir):
+    """
+    Reads in the gene data for translating one chain's rearrangements, as described in import_gene_information()
+    :return: the tuple of TCR data returned by import_gene_information()
+    """
+
     # Look for tag and V/J fasta and cysteine position files: if these cannot be found in the working directory,
     # source them from GitHub repositories
     # Note that fasta/tag files fit the pattern "species_tagset_gene.[fasta/tags]"
     # I.e. "[human/mouse]_[extended/original]_TR[A/B/G/D][V/J].[fasta/tags]"
 
+    genedata = {}
     for gene in ['v', 'j']:
         # Get FASTA data
-        fasta_file = read_tcr_file(inputargs['species'], inputargs['tags'], gene, "fasta", inputargs['tagfastadir'])
-        globals()[gene + "_genes"] = list(SeqIO.parse(fasta_file, "fasta"))
+        fasta_file = read_tcr_file(species, tagset, gene, "fasta", tagfastadir, chain)
+        genes = list(SeqIO.parse(fasta_file, "fasta"))
 
-        globals()[gene + "_regions"] = [str(    item.seq.upper()) for item in globals()[gene + "_genes"]]
-        globals()[gene + "_names"] = [str(item.id.upper().split("|")[1]) for item in globals()[gene + "_genes"]]
+        genedata[gene + "_regions"] = [str(    item.seq.upper()) for item in genes]
+        genedata[gene + "_names"] = [str(item.id.upper().split("|")[1]) for item in genes]
 
         # Get conserved translation residue sites and functionality data
-        translation_file = open(read_tcr_file(inputargs['species'], inputargs['tags'], gene, "translate",
-                                         inputargs['tagfastadir']),"rt")
-        translate_data = [x.rstrip() for x in list(translation_file)]
+        with open(read_tcr_file(species, tagset, gene, "translate", tagfastadir, chain), "rt") as translation_file:
+            translate_data = [x.rstrip() for x in list(translation_file)]
 
-        globals()[gene + "_translate_position"] = [int(x.split(",")[1]) for x in translate_data]
-        globals()[gene + "_translate_residue"] = [x.split(",")[2] for x in translate_data]
-        globals()[gene + "_functionality"] = [x.split(",")[3] for x in translate_data]
+        genedata[gene + "_translate_position"] = [int(x.split(",")[1]) for x in translate_data]
+        genedata[gene + "_translate_residue"] = [x.split(",")[2] for x in translate_data]
+        genedata[gene + "_functionality"] = [x.split(",")[3] for x in translate_data]
 
         if gene == 'v':
             
-            if inputargs['species'] == "human":
+            if species == "human":
                 # Get germline CDR data
-                cdr_file = open(read_tcr_file(inputargs['species'], inputargs['tags'], gene, "cdrs", inputargs['tagfastadir']), "rt")
+                cdr_file = open(read_tcr_file(species, tagset, gene, "cdrs", tagfastadir, chain), "rt")
                 cdr_data = [x.rstrip() for x in list(cdr_file)]
                 cdr_file.close()
                 v_cdr1 = [x.split(" ")[1] for x in cdr_data]
@@ -176,101 +216,295 @@ def import_gene_information(inputargs):
                 # cdr_file only exists for human -  CDR1 and CDR2 only written to output tsv
                 # for human. Otherwise create empty lists fo v_cdr1 and v_cdr2, to write empty
                 # fields to output tsv
-                v_cdr1 = [""]*len(globals()[gene + "_genes"])
-                v_cdr2 = [""]*len(globals()[gene + "_genes"])
+                v_cdr1 = [""]*len(genes)
+                v_cdr2 = [""]*len(genes)
+
+    v_regions, j_regions, v_names, j_names = [genedata[x] for x in ['v_regions', 'j_regions', 'v_names', 'j_names']]
+    v_translate_position, v_translate_residue, j_translate_position, j_translate_residue = \
+        [genedata[x] for x in ['v_translate_position', 'v_translate_residue', 'j_translate_position', 'j_translate_residue']]
+    v_functionality, j_functionality = genedata['v_functionality'], genedata['j_functionality']
+
+    # Precompute germline translations, so that only the codons spanning the insert need translating per DCR.
+    # V genes are always read from their first base, so the amino acids contributed by a V with any number of
+    # deletions are a prefix of its full translation; J genes are translated in all three frames, and the residues
+    # contributed by a J are a suffix of one of these.
+    v_aa = [str(Seq(x).translate()) for x in v_regions]
+    j_aa_frames = [[str(Seq(x[frame:]).translate()) for frame in range(3)] for x in j_regions]
+
+    # Whether each V's germline conserved cysteine (or equivalent) is intact; None where its position falls outside the V
+    v_conserved_c = [v_aa[v][v_translate_position[v] - 1] == v_translate_residue[v]
+                     if 0 <= v_translate_position[v] - 1 < len(v_aa[v]) else None for v in range(len(v_regions))]
+
+    j_motifs = [re.compile(x) for x in j_translate_residue]
+
+    return v_regions, j_regions, v_names, j_names, v_translate_position, v_translate_residue, j_translate_position, \
+        j_translate_residue, v_functionality, j_functionality, v_cdr1, v_cdr2, v_aa, j_aa_frames, v_conserved_c, j_motifs
+
+
+def translate_batch(seqs):
+    """
+    Translates a batch of nucleotide sequences in one go, by looking up every codon in codon_table at once
+    Sequences containing characters other than A/C/G/T/N fall back to Biopython
+    :param seqs: list of nucleotide sequences (any partial final codon is ignored, as by Seq.translate())
+    :return: list of the corresponding amino acid sequences
+    """
+
+    n_codons = np.array([len(x) // 3 for x in seqs], dtype=np.int64)
+    if not n_codons.sum():
+        return [''] * len(seqs)
+
+    # Encode as one array of base codes, three per codon ('?' keeps any non-ASCII characters to a single byte)
+    joined = ''.join([x[:3 * n] for x, n in zip(seqs, n_codons)])
+    codons = nt_codes[np.frombuffer(joined.encode('ascii', 'replace'), dtype=np.uint8)].reshape(-1, 3)
+
+    unknown = (codons == 255).any(axis=1)
+    codons[unknown] = 0
+    codons = codons.astype(np.int64)
+    aa = codon_table[25 * codons[:, 0] + 5 * codons[:, 1] + codons[:, 2]].tobytes().decode()
+
+    ends = np.cumsum(n_codons)
+    starts = ends - n_codons
+    out_aa = [aa[start:end] for start, end in zip(starts.tolist(), ends.tolist())]
+
+    for i in np.unique(np.repeat(np.arange(len(seqs)), n_codons)[unknown]).tolist():
+        out_aa[i] = str(Seq(seqs[i]).translate())
+
+    return out_aa
+
+
+def find_stop_codons(seqs_aa):
+    """
+    :param seqs_aa: list of amino acid sequences
+    :return: boolean array, True for each sequence containing a stop codon ('*')
+    """
+
+    lengths = np.array([len(x) for x in seqs_aa], dtype=np.int64)
+    joined = np.frombuffer(''.join(seqs_aa).encode('ascii', 'replace'), dtype=np.uint8)
+    stops = np.flatnonzero(joined == ord('*'))
+
+    has_stop = np.zeros(len(seqs_aa), dtype=bool)
+    has_stop[np.searchsorted(np.cumsum(lengths), stops, side='right')] = True
+    return has_stop
+
 
-    return v_regions, j_regions, v_names, j_names, v_translate_position, v_translate_residue, \
-           j_translate_position, j_translate_residue, v_functionality, j_functionality, v_cdr1, v_cdr2
+# Gene data used by get_cdr3_batch when it is not given any, as set by set_gene_information
+default_gene_information = None
 
 
-def get_cdr3(dcr, headers):
+def set_gene_information(gene_information):
+    """
+    Sets the gene data that get_cdr3_batch uses by default
+    Also used as the initializer of translation worker processes, so that each only receives the gene data once
+    :param gene_information: the tuple of TCR data returned by import_gene_information()
+    :return: Nothing: gene data is stored in a module global
+    """
+
+    global default_gene_information
+    default_gene_information = gene_information
+
+
+def get_cdr3(dcr, gene_information=None):
     """
     Checks the productivity of a given DCR-assigned rearrangement.
-    Note it requires certain items to be in memory: import_gene_information() must be run first
+    Note it requires gene data: either given, or set by set_gene_information() first
     :param dcr: the 5 part Decombinator identifier of a given sequence
-    :param headers: the headers of the fields that will appear in the final output file (including empty ones)
-    :return: a dictionary of the relevant output fields, for downstream transcription into the out file
+    :param gene_information: the tuple of TCR data returned by import_gene_information()
+    :return: a dictionary of the relevant output fields, as per get_cdr3_batch
     """
 
+    return get_cdr3_batch([dcr], gene_information)[0]
+
+
+def get_cdr3_batch(dcrs, gene_information=None):
+    """
+    Checks the productivity of a batch of DCR-assigned rearrangements, translating them all at once.
+    Note it requires gene data: either given, or set by set_gene_information() first
+    :param dcrs: list of the 5 part Decombinator identifiers of the sequences
+    :param gene_information: the tuple of TCR data returned by import_gene_information()
+    :return: list of dictionaries of the relevant output fields, for downstream transcription into the out file.
+    Fields that are not filled for a rearrangement (e.g. junction, for non-productive rearrangements) are left out,
+    as are those that are the same for every rearrangement (see constant_fields)
+    """
+
+    v_regions, j_regions, v_names, j_names, v_translate_position, v_translate_residue, j_translate_position, \
+    j_translate_residue, v_functionality, j_functionality, v_cdr1, v_cdr2, v_aa, j_aa_frames, \
+    v_conserved_c, j_motifs = gene_information or default_gene_information
+
     # NB: A productively rearranged receptor does not necessarily mean that it is the working receptor used in a cell!
-    out_data = coll.defaultdict()
-    for field in headers:
-        out_data[field] = ''
-
-    out_data['decombinator_id'] = ", ".join(dcr)
-    out_data['rev_comp'] = 'F'
-
-    # CDR3-defining positions
-    start_cdr3 = 0
-    end_cdr3 = 0
-
-    # 1. Rebuild whole nucleotide sequence from Decombinator assignment
-    classifier_elements = dcr
-    v = int(classifier_elements[0])
-    j = int(classifier_elements[1])
-    vdel = int(classifier_elements[2])
-    jdel = int(classifier_elements[3])
-    ins_nt = classifier_elements[4]
-
-    # TODO remove 'split' if and when the gene names in the tag files get properly adjusted to be consistent
-    out_data['v_call'] = v_names[v].split('*')[0]
-    out_data['j_call'] = j_names[j].split('*')[0]
-
-    if vdel == 0:
-        v_used = v_regions[v]
-    else:
-        v_used = v_regions[v][:-vdel]
+    out_batch = []
+    positions = []
+    junctions_nt = []
+
+    for dcr in dcrs:
+        out_data = {}
+        out_data['decombinator_id'] = ", ".join(dcr)
+
+        # 1. Rebuild whole nucleotide sequence from Decombinator assignment
+        classifier_elements = dcr
+        v = int(classifier_elements[0])
+        j = int(classifier_elements[1])
+        vdel = int(classifier_elements[2])
+        jdel = int(classifier_elements[3])
+        ins_nt = classifier_elements[4]
+
+        # TODO remove 'split' if and when the gene names in the tag files get properly adjusted to be consistent
+        out_data['v_call'] = v_names[v].split('*')[0]
+        out_data['j_call'] = j_names[j].split('*')[0]
+
+        if vdel == 0:
+            v_used = v_regions[v]
+        else:
+            v_used = v_regions[v][:-vdel]
+
+        j_used = j_regions[j][jdel:]
 
-    j_used = j_regions[j][jdel:]
+        out_data['sequence'] = ''.join([v_used, ins_nt, j_used])
 
-    out_data['sequence'] = ''.join([v_used, ins_nt, j_used])
+        # 2. Gather the codons spanning the insert; all others are taken from the precomputed germline translations
+        v_codons = len(v_used) // 3
+        j_offset = (3 - (len(v_used) + len(ins_nt)) % 3) % 3  # J bases needed to complete the last codon of the insert
+        junctions_nt.append(v_used[3 * v_codons:] + ins_nt + j_used[:j_offset])
 
-    # 2. Translate
-    out_data['sequence_aa'] = str(Seq(out_data['sequence']).translate())
+        out_batch.append(out_data)
+        positions.append((v, j, v_codons, jdel + j_offset))
+
+    junctions_aa = translate_batch(junctions_nt)
+    for out_data, (v, j, v_codons, j_start), junction_aa in zip(out_batch, positions, junctions_aa):
+        out_data['sequence_aa'] = v_aa[v][:v_codons] + junction_aa + j_aa_frames[j][j_start % 3][j_start // 3:]
 
     # 3. Check whether whole rearrangement is in frame
-    if (len(out_data['sequence']) - 1) % 3 == 0:
-        out_data['productive'] = 'T'
-        out_data['vj_in_frame'] = 'T'
-    else:
-        out_data['productive'] = 'F'
-        out_data['vj_in_frame'] = 'F'
+    in_frame = (np.array([len(x['sequence']) for x in out_batch], dtype=np.int64) - 1) % 3 == 0
 
     # 4. Check for stop codons in the in-frame rearrangements
-    if '*' in out_data['sequence_aa']:
-        out_data['productive'] = 'F'
-        out_data['stop_codon'] = 'T'
-    else:
-        out_data['stop_codon'] = 'F'
+    has_stop = find_stop_codons([x['sequence_aa'] for x in out_batch])
 
-    # 5. Check for conserved cysteine in the V gene
-    if out_data['sequence_aa'][v_translate_position[v] - 1] == v_translate_residue[v]:
-        start_cdr3 = v_translate_position[v] - 1
-        out_data['conserved_c'] = 'T'
-    else:
-        out_data['productive'] = 'F'
-        out_data['conserved_c'] = 'F'
+    for out_data, (v, j, v_codons, j_start), frame_flag, stop_flag in \
+            zip(out_batch, positions, in_frame.tolist(), has_stop.tolist()):
 
-    # 5.5 Having found conserved cysteine, only need look downstream to find other end of CDR3
-    downstream_c = out_data['sequence_aa'][start_cdr3:]
+        # CDR3-defining positions
+        start_cdr3 = 0
+        end_cdr3 = 0
 
-    # 6. Check for presence of FGXG motif (or equivalent)
-    site = downstream_c[j_translate_position[j]:j_translate_position[j] + 4]
+        if frame_flag:
+            out_data['productive'] = 'T'
+            out_data['vj_in_frame'] = 'T'
+        else:
+            out_data['productive'] = 'F'
+            out_data['vj_in_frame'] = 'F'
 
-    if re.findall(j_translate_residue[j], site):
-        end_cdr3 = len(downstream_c) + j_translate_position[j] + start_cdr3 + 1
-        out_data['conserved_f'] = 'T'
-    else:
-        out_data['productive'] = 'F'
-        out_data['conserved_f'] = 'F'
+        if stop_flag:
+            out_data['productive'] = 'F'
+            out_data['stop_codon'] = 'T'
+        else:
+            out_data['stop_codon'] = 'F'
+
+        # 5. Check for conserved cysteine in the V gene (looked up from the germline, unless the site is lost to deletions)
+        if 0 <= v_translate_position[v] - 1 < v_codons:
+            has_conserved_c = v_conserved_c[v]
+        else:
+            has_conserved_c = out_data['sequence_aa'][v_translate_position[v] - 1] == v_translate_residue[v]
+
+        if has_conserved_c:
+            start_cdr3 = v_translate_position[v] - 1
+            out_data['conserved_c'] = 'T'
+        else:
+            out_data['productive'] = 'F'
+            out_data['conserved_c'] = 'F'
+
+        # 5.5 Having found conserved cysteine, only need look downstream to find other end of CDR3
+        downstream_c = out_data['sequence_aa'][start_cdr3:]
+
+        # 6. Check for presence of FGXG motif (or equivalent)
+        site = downstream_c[j_translate_position[j]:j_translate_position[j] + 4]
+
+        if j_motifs[j].search(site):
+            end_cdr3 = len(downstream_c) + j_translate_position[j] + start_cdr3 + 1
+            out_data['conserved_f'] = 'T'
+        else:
+            out_data['productive'] = 'F'
+            out_data['conserved_f'] = 'F'
 
-    if out_data['productive'] == 'T':
-        out_data['junction_aa'] = out_data['sequence_aa'][start_cdr3:end_cdr3]
-        out_data['junction'] = out_data['sequence'][start_cdr3 * 3:3 * end_cdr3]
-        out_data['cdr1_aa'] = v_cdr1[v]
-        out_data['cdr2_aa'] = v_cdr2[v]
+        if out_data['productive'] == 'T':
+            out_data['junction_aa'] = out_data['sequence_aa'][start_cdr3:end_cdr3]
+            out_data['junction'] = out_data['sequence'][start_cdr3 * 3:3 * end_cdr3]
+            out_data['cdr1_aa'] = v_cdr1[v]
+            out_data['cdr2_aa'] = v_cdr2[v]
 
-    return out_data
+    return out_batch
+
+
+def get_gene_file_hash(inputargs):
+    """
+    Fingerprints the germline data used for translation, so that cached translations are only reused with the same files
+    :param inputargs: command line (argparse) input arguments dictionary, with the chain as a single letter
+    :return: hex digest of the V and J FASTA, translate (and where present, CDR) files
+    """
+
+    file_hash = hashlib.sha1()
+    for gene in ['v', 'j']:
+        filetypes = ['fasta', 'translate']
+        if gene == 'v' and inputargs['species'] == "human":
+            filetypes.append('cdrs')
+        for filetype in filetypes:
+            with open(read_tcr_file(inputargs['species'], inputargs['tags'], gene, filetype, inputargs['tagfastadir'],
+                                     inputargs['chain']), "rb") as fl:
+                file_hash.update(fl.read())
+
+    return file_hash.hexdigest()
+
+
+def open_translation_cache(cachefile):
+    """
+    Opens (creating if necessary) an SQLite database of previously translated DCRs, shared between runs
+    :param cachefile: path to the cache database
+    :return: the open database connection
+    """
+
+    cache = sqlite3.connect(cachefile, timeout=60)
+    cache.execute("CREATE TABLE IF NOT EXISTS translations (species TEXT, tagset TEXT, chain TEXT, filehash TEXT, dcr TEXT, "
+                  "fields TEXT, PRIMARY KEY (species, tagset, chain, filehash, dcr))")
+    return cache
+
+
+def lookup_cached_translations(dcrs, cache, cache_key, counts):
+    """
+    Looks a batch of DCRs up in the translation cache
+    :param dcrs: list of the 5 part Decombinator identifiers of the sequences
+    :param cache: open translation cache, from open_translation_cache()
+    :param cache_key: (species, tagset, chain, gene file hash) tuple identifying the germline data used
+    :param counts: Counter to add the cache hits and misses to
+    :return: list of cached output field dictionaries (None where not cached), list of indices of uncached DCRs
+    """
+
+    out_batch = []
+    misses = []
+
+    for i, dcr in enumerate(dcrs):
+        dcr_id = ", ".join(dcr)
+        cached = cache.execute("SELECT fields FROM translations WHERE species = ? AND tagset = ? AND chain = ? AND filehash = ? "
+                               "AND dcr = ?", cache_key + (dcr_id,)).fetchone()
+
+        if cached:
+            counts['cache_hits'] += 1
+            out_batch.append(json.loads(cached[0]))
+        else:
+            counts['cache_misses'] += 1
+            out_batch.append(None)
+            misses.append(i)
+
+    return out_batch, misses
+
+
+def store_cached_translations(translated, cache, cache_key):
+    """
+    :param translated: list of output field dictionaries, from get_cdr3_batch()
+    :param cache: open translation cache, from open_translation_cache()
+    :param cache_key: (species, tagset, chain, gene file hash) tuple identifying the germline data used
+    :return: Nothing: translations are added to the cache
+    """
+
+    cache.executemany("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)",
+                      [cache_key + (x['decombinator_id'], json.dumps(x)) for x in translated])
 
 
 out_headers = ['sequence_id', 'v_call', 'd_call', 'j_call', 'junction_aa', 'duplicate_count', 'sequence',
@@ -278,15 +512,45 @@ out_headers = ['sequence_id', 'v_call', 'd_call', 'j_call', 'junction_aa', 'dupl
                'vj_in_frame', 'stop_codon', 'conserved_c', 'conserved_f',
                'sequence_alignment', 'germline_alignment', 'v_cigar', 'd_cigar', 'j_cigar', 'av_UMI_cluster_size']
 
-def cdr3translator(data: list, inputargs: dict) -> list:
-    """Function Wrapper for CDR3translator"""
+# Output fields that take the same value for every rearrangement, which are added to the output as whole columns
+constant_fields = {'d_call': '', 'rev_comp': 'F', 'sequence_alignment': '', 'germline_alignment': '',
+                   'v_cigar': '', 'd_cigar': '', 'j_cigar': ''}
+
+# T/F output fields, which are stored as single bytes and output as T/F string columns
+flag_fields = ['productive', 'vj_in_frame', 'stop_codon', 'conserved_c', 'conserved_f']
+flag_values = np.array(['F', 'T'], dtype=object)
 
-    global counts
-    counts = coll.Counter()
+# Output fields filled in by get_cdr3 (if applicable), and by cdr3translator from the input data
+translated_fields = [x for x in out_headers if x not in constant_fields and x not in flag_fields and
+                     x not in ['sequence_id', 'duplicate_count', 'av_UMI_cluster_size']]
 
-    print("Running CDR3Translator version", __version__)
 
-    # Get chain information
+def build_output_dataframe(out_columns, out_flags):
+    """
+    Assembles the output columns collected by cdr3translator into a dataframe, in the order given by out_headers
+    :param out_columns: dictionary of lists of values, for each field that varies between rearrangements
+    :param out_flags: dictionary of bytearrays (1 for T, 0 for F), for each field in flag_fields
+    :return: the output dataframe, with constant_fields filled in and flag_fields as T/F string columns
+    """
+
+    out_df = {}
+    for x in out_headers:
+        if x in out_columns:
+            out_df[x] = out_columns[x]
+        elif x in out_flags:
+            out_df[x] = flag_values[np.frombuffer(out_flags[x], dtype=np.int8)]
+        else:
+            out_df[x] = constant_fields[x]
+
+    return pd.DataFrame(out_df, columns=out_headers)
+
+
+def get_chain(inputargs):
+    """
+    :param inputargs: command line (argparse) input arguments dictionary
+    :return: the chain to translate, as a single letter, from the chain argument or failing that the FASTQ file name
+    """
+
     if not inputargs['chain']:
         # If chain not given, try and infer from input file name
         chaincheck = [x for x in ["alpha", "beta", "gamma", "delta"] if x in inputargs['fastq'].lower()]
@@ -308,131 +572,244 @@ def cdr3translator(data: list, inputargs: dict) -> list:
             print("TCR chain not recognised. Please choose from a/b/g/d (case-insensitive).")
             sys.exit()
 
-    inputargs['chain'] = chain  # Correct inputarg chain value so that import gene function gets correct input
-
-    suffix = ".tsv"
-
-    # Extract CDR3s # TODO create class object to hold globals
-    global v_regions, j_regions, v_names, j_names, v_translate_position, v_translate_residue, j_translate_position, \
-    j_translate_residue, v_functionality, j_functionality, v_cdr1, v_cdr2
-    v_regions, j_regions, v_names, j_names, v_translate_position, v_translate_residue, j_translate_position, \
-    j_translate_residue, v_functionality, j_functionality, v_cdr1, v_cdr2 = import_gene_information(inputargs)
-
-    infile = data
-
-    counts['line_count'] = 0
+    return chain
 
-    # Count non-productive rearrangments
-    chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
 
-    print("Translating", chainnams[chain], "chain CDR3s from", inputargs['fastq'])
-
-    filename_id = os.path.basename(inputargs['fastq']).split(".")[0]
-    outfilename = filename_id + suffix
-
-    out_data = []
-
-    for line in data:
+class Translator:
+    """
+    Translates the CDR3s of one sample's rearrangements. Each holds its own gene data, counts and settings, so several
+    (e.g. for different chains or samples) can be used side by side in one process
+    """
 
-        counts['line_count'] += 1
-        tcr_data = line
-        in_dcr = tcr_data[:5]
-        v = int(tcr_data[0])
-        j = int(tcr_data[1])
+    def __init__(self, inputargs: dict):
+        """
+        :param inputargs: command line (argparse) input arguments dictionary; its chain is corrected to a single letter
+        """
+
+        print("Running CDR3Translator version", __version__)
+
+        self.inputargs = inputargs
+        self.counts = coll.Counter()
+        self.chain = get_chain(inputargs)
+        inputargs['chain'] = self.chain  # Correct inputarg chain value so that import gene function gets correct input
+
+        self.gene_information = import_gene_information(inputargs)
+
+    def translate(self, data: list):
+        """
+        :param data: list of collapsed (or, with nobarcoding, decombined) rearrangements
+        :return: dataframe of the translated rearrangements, as written out by write_out_translated()
+        """
+
+        inputargs, counts, chain, gene_information = self.inputargs, self.counts, self.chain, self.gene_information
+        v_functionality, j_functionality = gene_information[8], gene_information[9]
+
+        suffix = ".tsv"
+
+        counts['line_count'] = 0
+
+        # Optionally serve repeated DCRs from a persistent translation cache
+        if inputargs['translationcache']:
+            cache = open_translation_cache(inputargs['translationcache'])
+            cache_key = (inputargs['species'], inputargs['tags'], chain, get_gene_file_hash(inputargs))
+
+        # Count non-productive rearrangments
+        chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
+
+        print("Translating", chainnams[chain], "chain CDR3s from", inputargs['fastq'])
+
+        filename_id = os.path.basename(inputargs['fastq']).split(".")[0]
+        outfilename = filename_id + suffix
+
+        # Output is built column by column, rather than row by row
+        out_columns = {x: [] for x in ['sequence_id', 'duplicate_count', 'av_UMI_cluster_size'] + translated_fields}
+        out_flags = {x: bytearray() for x in flag_fields}
+
+        # Read the input in contiguous batches, keeping the input order
+        batches = []
+        run_translations = {}  # Translations of the cache misses so far, so that DCRs repeated within the run are cache hits
+        for batch_start in range(0, len(data), translation_batch_size):
+            batch = data[batch_start:batch_start + translation_batch_size]
+
+            in_dcrs = []
+            frequencies = []
+            av_UMI_cluster_sizes = []
+
+            for line in batch:
+
+                tcr_data = line
+                in_dcrs.append(tcr_data[:5])
+
+                if inputargs['nobarcoding']:
+                    use_freq = False
+                    frequency = 1
+                    av_UMI_cluster_size = ""
+
+                else:
+                    if isinstance(tcr_data[5], int):
+                        frequency = tcr_data[5]
+                    else:
+                        print("TCR frequency could not be detected. If using non-barcoded data," \
+                                " please include the additional '-nbc' argument when running" \
+                                " CDR3translator.")
+                        sys.exit()
+
+                    if isinstance(tcr_data[6], (int, float)):
+                        av_UMI_cluster_size = tcr_data[6]
+                    else:
+                        av_UMI_cluster_size = ""
+
+                frequencies.append(frequency)
+                av_UMI_cluster_sizes.append(av_UMI_cluster_size)
+
+            # Only DCRs not already in the translation cache need translating
+            repeats = []
+            if inputargs['translationcache']:
+                cdr3_batch, misses = lookup_cached_translations(in_dcrs, cache, cache_key, counts)
+                # Misses already met earlier in the run are only translated the first time, and then served as hits
+                new_misses = []
+                for i in misses:
+                    dcr_id = ", ".join(in_dcrs[i])
+                    if dcr_id in run_translations:
+                        repeats.append(i)
+                    else:
+                        run_translations[dcr_id] = None
+                        new_misses.append(i)
+                misses = new_misses
+                counts['cache_hits'] += len(repeats)
+                counts['cache_misses'] -= len(repeats)
+            else:
+                cdr3_batch, misses = [None] * len(in_dcrs), list(range(len(in_dcrs)))
 
-        if inputargs['nobarcoding']:
-            use_freq = False
-            frequency = 1
-            av_UMI_cluster_size = ""
+            batches.append((in_dcrs, frequencies, av_UMI_cluster_sizes, cdr3_batch, misses, repeats))
 
+        # Translate the batches, optionally across a pool of worker processes; results come back in input order,
+        # so sequence_ids and counts are the same as for a serial run
+        to_translate = [[in_dcrs[i] for i in misses] for in_dcrs, _, _, _, misses, _ in batches]
+        if inputargs['processes'] > 1:
+            pool = mp.Pool(inputargs['processes'], initializer=set_gene_information, initargs=(gene_information,))
+            translated_batches = pool.imap(get_cdr3_batch, to_translate)
         else:
-            if isinstance(tcr_data[5], int):
-                frequency = tcr_data[5]
-            else:
-                print("TCR frequency could not be detected. If using non-barcoded data," \
-                        " please include the additional '-nbc' argument when running" \
-                        " CDR3translator.")
-                sys.exit()
+            pool = None
+            translated_batches = map(functools.partial(get_cdr3_batch, gene_information=gene_information), to_translate)
 
-            if isinstance(tcr_data[6], (int, float)):
-                av_UMI_cluster_size = tcr_data[6]
+        try:
+            for (in_dcrs, frequencies, av_UMI_cluster_sizes, cdr3_batch, misses, repeats), translated in \
+                    zip(batches, translated_batches):
+
+                for i, cdr3_data in zip(misses, translated):
+                    cdr3_batch[i] = cdr3_data
+                if inputargs['translationcache']:
+                    store_cached_translations(translated, cache, cache_key)
+                    for i, cdr3_data in zip(misses, translated):
+                        run_translations[", ".join(in_dcrs[i])] = cdr3_data
+                    for i in repeats:
+                        cdr3_batch[i] = run_translations[", ".join(in_dcrs[i])]
+
+                for in_dcr, frequency, av_UMI_cluster_size, cdr3_data in \
+                        zip(in_dcrs, frequencies, av_UMI_cluster_sizes, cdr3_batch):
+
+                    counts['line_count'] += 1
+                    v = int(in_dcr[0])
+                    j = int(in_dcr[1])
+
+                    if cdr3_data['productive'] == 'T':
+                        counts['prod_recomb'] += 1
+                        productivity = "P"
+                    else:
+                        productivity = "NP"
+                        counts['NP_count'] += 1
+
+                    if productivity == "P" or not inputargs['nonproductivefilter']:
+                        out_columns['sequence_id'].append(str(counts['line_count']))
+                        out_columns['duplicate_count'].append(frequency)
+                        out_columns['av_UMI_cluster_size'].append(av_UMI_cluster_size)
+                        for x in translated_fields:
+                            out_columns[x].append(cdr3_data.get(x, ''))
+                        for x in flag_fields:
+                            out_flags[x].append(cdr3_data[x] == 'T')
+
+                    # Count the number of number of each type of gene functionality (by IMGT definitions, based on prototypic)
+                    if inputargs['tags'] == 'extended' and inputargs['species'] == 'human':
+                        counts[productivity + "_" + "V-" + v_functionality[v]] += 1
+                        counts[productivity + "_" + "J-" + j_functionality[j]] += 1
+        finally:
+            # Also stops the workers if translation fails part way through
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+        if inputargs['translationcache']:
+            cache.commit()
+            cache.close()
+            print("Translation cache:", counts['cache_hits'], "hits,", counts['cache_misses'], "misses")
+
+        out_df = build_output_dataframe(out_columns, out_flags)
+
+        print("CDR3 data written to dataframe")
+
+        # Write data to summary file
+        if not inputargs['suppresssummary']:
+
+            # Check for directory and make summary file
+            if not os.path.exists('Logs'):
+                os.makedirs('Logs')
+            date = strftime("%Y_%m_%d")
+
+            # Check for existing date-stamped file
+            summaryname = "Logs/" + date + "_" + "dcr_" + filename_id + f"_{chainnams[chain]}" + "_CDR3_Translation_Summary.csv"
+            if not os.path.exists(summaryname):
+                summaryfile = open(summaryname, "wt")
             else:
-                av_UMI_cluster_size = ""
+                # If one exists, start an incremental day stamp
+                for i in range(2, 10000):
+                    summaryname = "Logs/" + date + "_" + "dcr_" + filename_id + f"_{chainnams[chain]}" + \
+                                  "_CDR3_Translation_Summary" + str(i) + ".csv"
+                    if not os.path.exists(summaryname):
+                        summaryfile = open(summaryname, "wt")
+                        break
+
+            inout_name = "_".join(f"{filename_id}".split('_')[:-1]) + f"_{chainnams[chain]}"
+        
+            # Generate string to write to summary file
+            summstr = "Property,Value\nDirectory," + os.getcwd() + "\nInputFile," \
+                      + inout_name + "\nOutputFile," + inout_name \
+                      + "\nDateFinished," + date + "\nTimeFinished," \
+                      + strftime("%H:%M:%S") + "\n\nInputArguments:,\n"
+            for s in ['species', 'chain', 'tags', 'dontgzip']:
+                summstr = summstr + s + "," + str(inputargs[s]) + "\n"
 
-        cdr3_data = get_cdr3(in_dcr, out_headers)
-        cdr3_data['sequence_id'] = str(counts['line_count'])
+            summstr = summstr + "\nNumberUniqueDCRsInput," + str(counts['line_count']) \
+                      + "\nNumberUniqueDCRsProductive," + str(counts['prod_recomb']) \
+                      + "\nNumberUniqueDCRsNonProductive," + str(counts['NP_count'])
 
-        cdr3_data['duplicate_count'] = frequency
-        cdr3_data['av_UMI_cluster_size'] = av_UMI_cluster_size
+            if inputargs['translationcache']:
+                summstr = summstr + "\n\nTranslationCacheHits," + str(counts['cache_hits']) \
+                          + "\nTranslationCacheMisses," + str(counts['cache_misses'])
 
-        if cdr3_data['productive'] == 'T':
-            counts['prod_recomb'] += 1
-            productivity = "P"
-            out_data.append([cdr3_data[x] for x in out_headers])
-        else:
-            productivity = "NP"
-            counts['NP_count'] += 1
-            if not inputargs['nonproductivefilter']:
-                out_data.append([cdr3_data[x] for x in out_headers])
+            if inputargs['tags'] == 'extended' and inputargs['species'] == 'human':
+                summstr = summstr + "\n\nFunctionalityOfGermlineGenesUsed,"
+                for p in ['P', 'NP']:
+                    for g in ['V', 'J']:
+                        for f in ['F', 'ORF', 'P']:
+                            target = p + '_' + g + '-' + f
+                            summstr = summstr + '\n' + target + ',' + str(counts[target])
 
-        # Count the number of number of each type of gene functionality (by IMGT definitions, based on prototypic)
-        if inputargs['tags'] == 'extended' and inputargs['species'] == 'human':
-            counts[productivity + "_" + "V-" + v_functionality[v]] += 1
-            counts[productivity + "_" + "J-" + j_functionality[j]] += 1
+            print(summstr, file=summaryfile)
+            summaryfile.close()
+            sort_permissions(summaryname)
 
-    out_df = pd.DataFrame(out_data, columns=out_headers)
+        return out_df
 
-    print("CDR3 data written to dataframe")
 
-    # Write data to summary file
-    if not inputargs['suppresssummary']:
+def cdr3translator(data: list, inputargs: dict) -> list:
+    """Function Wrapper for CDR3translator"""
 
-        # Check for directory and make summary file
-        if not os.path.exists('Logs'):
-            os.makedirs('Logs')
-        date = strftime("%Y_%m_%d")
+    global counts, chain
+    translator = Translator(inputargs)
+    counts, chain = translator.counts, translator.chain
 
-        # Check for existing date-stamped file
-        summaryname = "Logs/" + date + "_" + "dcr_" + filename_id + f"_{chainnams[chain]}" + "_CDR3_Translation_Summary.csv"
-        if not os.path.exists(summaryname):
-            summaryfile = open(summaryname, "wt")
-        else:
-            # If one exists, start an incremental day stamp
-            for i in range(2, 10000):
-                summaryname = "Logs/" + date + "_" + "dcr_" + filename_id + f"_{chainnams[chain]}" + \
-                              "_CDR3_Translation_Summary" + str(i) + ".csv"
-                if not os.path.exists(summaryname):
-                    summaryfile = open(summaryname, "wt")
-                    break
-
-        inout_name = "_".join(f"{filename_id}".split('_')[:-1]) + f"_{chainnams[chain]}"
-        
-        # Generate string to write to summary file
-        summstr = "Property,Value\nDirectory," + os.getcwd() + "\nInputFile," \
-                  + inout_name + "\nOutputFile," + inout_name \
-                  + "\nDateFinished," + date + "\nTimeFinished," \
-                  + strftime("%H:%M:%S") + "\n\nInputArguments:,\n"
-        for s in ['species', 'chain', 'tags', 'dontgzip']:
-            summstr = summstr + s + "," + str(inputargs[s]) + "\n"
-
-        summstr = summstr + "\nNumberUniqueDCRsInput," + str(counts['line_count']) \
-                  + "\nNumberUniqueDCRsProductive," + str(counts['prod_recomb']) \
-                  + "\nNumberUniqueDCRsNonProductive," + str(counts['NP_count'])
-
-        if inputargs['tags'] == 'extended' and inputargs['species'] == 'human':
-            summstr = summstr + "\n\nFunctionalityOfGermlineGenesUsed,"
-            for p in ['P', 'NP']:
-                for g in ['V', 'J']:
-                    for f in ['F', 'ORF', 'P']:
-                        target = p + '_' + g + '-' + f
-                        summstr = summstr + '\n' + target + ',' + str(counts[target])
-
-        print(summstr, file=summaryfile)
-        summaryfile.close()
-        sort_permissions(summaryname)
-
-    del counts
-    return out_df
+    return translator.translate(data)
 
 if __name__ == "__main__":
   print("Calling CDR3translator from the shell has been depreciated as of Decombinator V4.3. \
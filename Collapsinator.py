@@ -59,9 +59,11 @@ import gzip
 import regex
 import copy
 import ast
+import json
 import os, sys
 import networkx as nx
 from polyleven import levenshtein as polylev
+from dcr_utilities import write_out_intermediate, sort_permissions, profile_stage
 
 __version__ = '4.3.0'
     
@@ -343,7 +345,7 @@ def get_barcode_positions2(bcseq,inputargs,counts):
   return [b1start,b1end,b2start,b2end]
 
 
-def set_barcode(fields, bc_locs):
+def set_barcode(fields, bc_locs, counts):
     # account for N1 barcode being greater or shorter than 6 nt (due to manufacturing errors)
     if (bc_locs[1] - bc_locs[0]) == 6:
         barcode = fields[8][bc_locs[0]:bc_locs[1]] + fields[8][bc_locs[2]:bc_locs[3]]
@@ -399,11 +401,92 @@ def are_seqs_equivalent(seq1, seq2, lev_percent_threshold):
 def are_barcodes_equivalent(bc1, bc2, threshold):
     return polylev(bc1, bc2) <= threshold
 
-def read_in_data(data, inputargs, barcode_quality_parameters, lev_threshold, dont_count):
+def parse_barcoded_read(line, inputargs, barcode_quality_parameters, counts):
+    # Finds and quality checks the barcode of a single Decombinator record, counting any failures in counts.
+    # Returns None if the read has no usable barcode, otherwise (str(dcr), barcode, seq, dcretc), where
+    # dcretc is None if the inter-tag sequence is too long to be kept
+    counts['readdata_input_dcrs'] += 1
+   
+    if str.lower(inputargs['oligo']) == 'i8_single':
+        bc_locs = get_barcode_positions2(line[8], inputargs, counts)        # barcode locations
+    elif str.lower(inputargs['oligo']) == 'i8':
+        bc_locs = get_barcode_positions(line[8], inputargs, counts)
+    elif str.lower(inputargs['oligo']) == 'm13':
+        bc_locs = get_barcode_positions(line[8], inputargs, counts)
+    else:
+        print("The flag for the -ol input must be one of M13, I8 or I8_single")
+        
+    if not bc_locs:
+      counts['readdata_fail_no_bclocs'] += 1
+      return None
+
+    barcode, barcode_qualstring = set_barcode(line, bc_locs, counts)
+    # L and S characters get quality scores of "?", representative of Q30 scores
+
+    if not barcode_quality_check(barcode_qualstring, barcode_quality_parameters):
+      # barcode is not sufficient quality, skip to next line of file
+      counts['readdata_fail_low_barcode_quality'] += 1
+      return None
+
+    dcr = line[:5]
+    seq = line[6]
+        
+    if len(seq) > inputargs['lenthreshold']:
+      # end V tag to start J tag too long to be sane
+      counts['readdata_fail_overlong_intertag_seq'] += 1
+      return str(dcr), barcode, seq, None
+        
+    seq_qualstring = line[7]
+    seq_id = line[5]
+    dcretc = '|'.join([str(dcr), seq, seq_qualstring, seq_id])
+
+    return str(dcr), barcode, seq, dcretc
+
+def assign_to_group(barcode, seq, dcretc, barcode_dcretc, barcode_lookup, lev_threshold):
+    # Assign reads to groups based on their barcode data. Reads with identical barcodes are grouped together
+    # so long as they have equivalent TCR sequences. Reads with identical barcodes but non-equivalent TCR
+    # sequences are grouped separately.
+    # Data is grouped in dictionary format: {'barcode|index|protoseq' : [dcretc1, dcretc2, ...], ... }
+    # where index counts upwards from zero to help disinguish identical barcodes in different groups,
+    # protoseq is the most common sequence present in the group, and dcretc are the input reads
+    
+    if barcode in barcode_lookup:
+      
+      for index in barcode_lookup[barcode]:
+        if are_seqs_equivalent(index[1], seq, lev_threshold):
+          barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]].append(dcretc)       
+          protodcretc_list = barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]]
+          seq_counter = coll.Counter(map(lambda x: x.split("|")[1],protodcretc_list))
+          protoseq = seq_counter.most_common(1)[0][0] # find most common sequence in group
+
+          if not index[1] == protoseq:
+            # if there is a new protoseq, replace record with old protoseq
+            # with identical record with updated  protoseq
+            barcode_dcretc[barcode + "|" + str(index[0]) + "|" + protoseq] = barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]]
+            del barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]]
+
+            barcode_lookup[barcode][index[0]] = [index[0], protoseq]
+
+          # if assigned to a group, stop and move onto next read
+          return
+
+      # if no appropriate group found, create new group with correctly incremented index
+      barcode_lookup[barcode].append([index[0] + 1,seq])
+      barcode_dcretc["|".join([barcode,str(index[0]+1),seq])].append(dcretc)
+
+    else:
+      # if no identical barcode found, create new barcode group with index zero
+      barcode_lookup[barcode].append([0,seq])
+      barcode_dcretc["|".join([barcode,"0",seq])].append(dcretc)
+
+def read_in_data(data, inputargs, barcode_quality_parameters, lev_threshold, dont_count, counts, parsed=False):
     ###########################################
     ############# READING DATA IN #############
     ###########################################        
-        
+    
+    # If parsed is True, data has already been through parse_barcoded_read (e.g. by the parallel pipeline's
+    # barcode workers, which also count any failures), otherwise it is Decombinator records
+
     # Check whether file appears to contain suitable verbose Decombinator output for collapsing
     # TODO: reimplement this section as tests
     # if inputargs['dontcheckinput'] == False:
@@ -431,90 +514,24 @@ def read_in_data(data, inputargs, barcode_quality_parameters, lev_threshold, don
           l = len(barcode_lookup)
           #print(len(barcode_lookup))
           print(round(ratio,2))
-                  
-        counts['readdata_input_dcrs'] += 1
-       
-        if str.lower(inputargs['oligo']) == 'i8_single':
-            bc_locs = get_barcode_positions2(line[8], inputargs, counts)        # barcode locations
-        elif str.lower(inputargs['oligo']) == 'i8':
-            bc_locs = get_barcode_positions(line[8], inputargs, counts)
-        elif str.lower(inputargs['oligo']) == 'm13':
-            bc_locs = get_barcode_positions(line[8], inputargs, counts)
-        else:
-            print("The flag for the -ol input must be one of M13, I8 or I8_single")
-            
-        if not bc_locs:
-          counts['readdata_fail_no_bclocs'] += 1
-          continue
 
-        barcode, barcode_qualstring = set_barcode(line, bc_locs)
-        #print(barcode)
-        # L and S characters get quality scores of "?", representative of Q30 scores
+        if parsed:
+          read = line
+        else:
+          read = parse_barcoded_read(line, inputargs, barcode_quality_parameters, counts)
 
-        if not barcode_quality_check(barcode_qualstring, barcode_quality_parameters):
-          # barcode is not sufficient quality, skip to next line of file
-          counts['readdata_fail_low_barcode_quality'] += 1
+        if not read:
           continue
 
-        dcr = line[:5]
-        input_dcr_counts[str(dcr)] += 1
-            
-        seq = line[6]
-            
-        if len(seq) > inputargs['lenthreshold']:
-          # end V tag to start J tag too long to be sane
-          counts['readdata_fail_overlong_intertag_seq'] += 1
+        dcr, barcode, seq, dcretc = read
+        input_dcr_counts[dcr] += 1
+
+        if not dcretc:
           continue
             
         counts['readdata_success'] += 1
-        seq_qualstring = line[7]
-        seq_id = line[5]
-        dcretc = '|'.join([str(dcr), seq, seq_qualstring, seq_id])
-          
-        group_assigned = False
-
-        # Assign reads to groups based on their barcode data. Reads with identical barcodes are grouped together
-        # so long as they have equivalent TCR sequences. Reads with identical barcodes but non-equivalent TCR
-        # sequences are grouped separately.
-        # Data is grouped in dictionary format: {'barcode|index|protoseq' : [dcretc1, dcretc2, ...], ... }
-        # where index counts upwards from zero to help disinguish identical barcodes in different groups,
-        # protoseq is the most common sequence present in the group, and dcretc are the input reads
-        
-        if barcode in barcode_lookup:
-#          print(len(barcode_lookup[barcode][0]))
-#          print("NEW")
-          #print(barcode_dcretc.values())
-          
-          for index in barcode_lookup[barcode]:
-            if are_seqs_equivalent(index[1], seq, lev_threshold):
-              barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]].append(dcretc)       
-              protodcretc_list = barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]]
-              seq_counter = coll.Counter(map(lambda x: x.split("|")[1],protodcretc_list))
-              protoseq = seq_counter.most_common(1)[0][0] # find most common sequence in group
-
-              if not index[1] == protoseq:
-                # if there is a new protoseq, replace record with old protoseq
-                # with identical record with updated  protoseq
-                barcode_dcretc[barcode + "|" + str(index[0]) + "|" + protoseq] = barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]]
-                del barcode_dcretc[barcode + "|" + str(index[0]) + "|" + index[1]]
-
-                barcode_lookup[barcode][index[0]] = [index[0], protoseq]
-
-              group_assigned = True
-              # if assigned to a group, stop and move onto next read
-              break
-
-          if not group_assigned:
-            # if no appropriate group found, create new group with correctly incremented index
-            barcode_lookup[barcode].append([index[0] + 1,seq])
-            barcode_dcretc["|".join([barcode,str(index[0]+1),seq])].append(dcretc)
-            group_assigned = True
 
-        else:
-          # if no identical barcode found, create new barcode group with index zero
-          barcode_lookup[barcode].append([0,seq])
-          barcode_dcretc["|".join([barcode,"0",seq])].append(dcretc)
-          group_assigned = True
+        assign_to_group(barcode, seq, dcretc, barcode_dcretc, barcode_lookup, lev_threshold)
     
     counts['readdata_barcode_dcretc_keys'] = len(barcode_dcretc.keys())
     counts['number_input_unique_dcrs'] = len(input_dcr_counts.keys())
@@ -528,6 +545,70 @@ def read_in_data(data, inputargs, barcode_quality_parameters, lev_threshold, don
 
     return barcode_dcretc
 
+# Input arguments that affect how reads are grouped in read_in_data, and so must match for a saved group table to be reused
+readin_parameters = ['oligo', 'allowNs', 'minbcQ', 'bcQbelowmin', 'avgQthreshold', 'lenthreshold', 'percentlevdist']
+
+def save_groups(barcode_dcretc, inputargs, groupfile, counts):
+    # Writes the initial barcode groups produced by read_in_data to a gzipped checkpoint file, so that
+    # clustering parameters can be re-tuned without re-running Decombinator and barcode parsing.
+    # The first line holds the run counts and read-in parameters (as JSON), then one line per group of the form:
+    #   barcode <tab> index <tab> protoseq <tab> dcr1=count1;dcr2=count2;...
+    # where dcrs are comma-joined and listed in order of first appearance, so that ties in most_common() are
+    # broken the same way when the groups are reloaded.
+    print("Saving barcode groups to", groupfile, "...")
+    t0 = time()
+
+    header = {'version': __version__,
+              'parameters': {p: inputargs[p] for p in readin_parameters},
+              'counts': {k: v for k, v in counts.items() if k != 'start_time'}}
+
+    with gzip.open(groupfile, 'wt') as outfile:
+      print("#" + json.dumps(header), file=outfile)
+      for group, dcretcs in barcode_dcretc.items():
+        barcode, index, protoseq = group.split("|")
+        member_counts = coll.Counter(map(lambda x: x.split("|")[0], dcretcs))
+        members = ";".join([",".join(ast.literal_eval(dcr)) + "=" + str(n) for dcr, n in member_counts.items()])
+        print("\t".join([barcode, index, protoseq, members]), file=outfile)
+
+    print('  ', len(barcode_dcretc), 'groups saved in', round(time()-t0, 2), 'seconds')
+    return 1
+
+def load_groups(inputargs, groupfile, counts):
+    # Reads a group table written by save_groups back into the barcode_dcretc format output by read_in_data.
+    # Only the DCR of each member read is kept, so the sequence, quality and ID fields of each dcretc are left empty.
+    if not os.path.isfile(groupfile):
+      print("Cannot find barcode group file", groupfile, "- please double-check path.")
+      sys.exit()
+
+    print("Loading barcode groups from", groupfile, "...")
+    t0 = time()
+    barcode_dcretc = coll.defaultdict(list)
+
+    with gzip.open(groupfile, 'rt') as infile:
+      header = json.loads(next(infile)[1:])
+
+      changed = [p for p in readin_parameters if header['parameters'].get(p) != inputargs[p]]
+      if changed:
+        print("   Warning: barcode groups were saved with different read-in parameters:")
+        for p in changed:
+          print("     ", p, "saved as", header['parameters'].get(p), "but now set to", inputargs[p])
+        print("   Groups will not be recalculated; re-run without -lg to apply these parameters to grouping.")
+
+      for line in infile:
+        barcode, index, protoseq, members = line.rstrip("\n").split("\t")
+        dcretcs = barcode_dcretc["|".join([barcode, index, protoseq])]
+        for member in members.split(";"):
+          dcr, n = member.rsplit("=", 1)
+          dcretcs.extend(["|".join([str(dcr.split(",")), '', '', ''])] * int(n))
+
+    counts.update(header['counts'])
+
+    t1 = time()
+    print("  ", counts['readdata_success'], "reads loaded in", len(barcode_dcretc), "initial groups")
+    print('  ', round(t1-t0, 2), 'seconds')
+
+    return barcode_dcretc
+
 def make_clusters(merge_groups, barcode_dcretc):
     # Considers clusters as an undirected graph composed of disconnected subgraphs.
     # The nodes of the graph are the initial groups of barcode/protosequences. Edges between nodes 
@@ -619,12 +700,100 @@ def cluster_UMIs(barcode_dcretc, inputargs, barcode_threshold, seq_threshold, do
     print("  ", num_initial_groups, "groups merged into", len(clusters), "clusters")
     print("  ", round(t1-t0, 2), "seconds")
     
-    # dump clusters to separate files if desired
+    # dump clusters to separate files (or a single indexed archive) if desired
     if inputargs['writeclusters']:
       write_clusters(clusters)
+    if inputargs['writeclusterarchive']:
+      write_cluster_archive(clusters)
 
     return clusters
 
+def get_candidate_edges(barcode_seqs, max_barcode_threshold, max_percent_seq_threshold, dont_count):
+    # Performs the pairwise comparison of cluster_UMIs once, at the loosest thresholds of a sweep.
+    # Returns a weighted edge list [(i, j, barcode_distance, seq_distance, shorter_seq_length), ...] of every pair of
+    # initial groups that could be merged at some combination of thresholds, in the same order cluster_UMIs visits them.
+    # Distances are calculated with a cut-off, so pairs beyond the loosest thresholds are rejected early.
+    t0 = time()
+    edges = []
+
+    for i, b1 in enumerate(barcode_seqs):
+
+      if i % 5000 == 0 and not dont_count:
+        print("   Compared", i, "/", len(barcode_seqs), "...", round(time()-t0,2),"seconds")
+
+      for j, b2 in enumerate(barcode_seqs[i+1:]):
+
+        barcode_distance = polylev(b1[0], b2[0], max_barcode_threshold)
+        if barcode_distance <= max_barcode_threshold:
+
+          shorter_seq_length = len(min(b1[1], b2[1], key=len))
+          max_seq_distance = int(shorter_seq_length * max_percent_seq_threshold)
+          seq_distance = polylev(b1[1], b2[1], max_seq_distance)
+          if seq_distance <= max_seq_distance:
+            edges.append((i, i+j+1, barcode_distance, seq_distance, shorter_seq_length))
+
+    return edges
+
+def sweep_UMIs(barcode_dcretc, inputargs, barcode_threshold, seq_threshold, dont_count, counts):
+    # Clusters the initial groups at every combination of the barcode thresholds (-sbc) and percentage sequence
+    # thresholds (-slv) requested, using a single set of pairwise comparisons made at the loosest thresholds.
+    # A .freq file is written for each combination, along with a CSV table comparing them.
+    # Returns the clusters for the run's own thresholds (-bc and -lv), which are always included in the sweep,
+    # so that the rest of the pipeline carries on as normal.
+    barcode_thresholds = sorted(set((inputargs['sweepbcthresholds'] or []) + [barcode_threshold]))
+    seq_thresholds = sorted(set((inputargs['sweeplevdists'] or []) + [seq_threshold]))
+
+    print("Clustering barcode groups for", len(barcode_thresholds) * len(seq_thresholds), "threshold combinations...")
+    t0 = time()
+
+    barcode_dcretc_list = list(barcode_dcretc.items())
+    barcode_seqs = [ (x[0].split("|")[0], x[0].split("|")[2] ) for x in barcode_dcretc_list]
+
+    edges = get_candidate_edges(barcode_seqs, max(barcode_thresholds), max(seq_thresholds)/100.0, dont_count)
+    print("  ", len(edges), "candidate merges found between", len(barcode_seqs), "groups in", round(time()-t0, 2), "seconds")
+
+    sweep_summary = []
+    for bc in barcode_thresholds:
+      for lv in seq_thresholds:
+        percent_seq_threshold = lv/100.0
+        merge_groups = [(e[0], e[1]) for e in edges if e[2] <= bc and e[3] <= e[4] * percent_seq_threshold]
+        clusters = make_clusters(merge_groups, barcode_dcretc_list)
+        out_data, collapsed, average_cluster_size_counter = collapse_clusters(clusters)
+
+        suffix = "_bc" + str(bc) + "_lv" + str(lv) + ".freq"
+        write_out_intermediate(out_data, inputargs, suffix)
+
+        total_dcrs = sum(collapsed.values())
+        sweep_summary.append([bc, lv, len(barcode_seqs), len(merge_groups), len(clusters), len(collapsed), total_dcrs,
+                              round(total_dcrs / counts['number_input_total_dcrs'], 3) if counts['number_input_total_dcrs'] else '',
+                              round(total_dcrs / len(collapsed), 3) if collapsed else ''])
+        print("   bcthreshold", bc, "percentlevdist", lv, ":", len(clusters), "clusters,", len(collapsed), "unique DCRs")
+
+        if bc == barcode_threshold and lv == seq_threshold:
+          run_clusters = clusters
+
+    # Write table comparing the threshold combinations
+    chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
+    filename_id = os.path.basename(inputargs['fastq']).split(".")[0]
+    sweepname = "dcr_" + filename_id + "_" + chainnams[inputargs['chain']] + "_Collapsing_Sweep.csv"
+    with open(sweepname, 'w') as sweepfile:
+      print("bcthreshold,percentlevdist,InitialGroups,Merges,Clusters,UniqueDCRsPostCollapsing,TotalDCRsPostCollapsing," \
+            "PercentTotalDCRsKept,AverageOutputTCRAbundance", file=sweepfile)
+      for row in sweep_summary:
+        print(",".join(map(str, row)), file=sweepfile)
+    sort_permissions(sweepname)
+
+    t1 = time()
+    print("   Threshold sweep summary saved to", sweepname)
+    print("  ", round(t1-t0, 2), "seconds")
+
+    if inputargs['writeclusters']:
+      write_clusters(run_clusters)
+    if inputargs['writeclusterarchive']:
+      write_cluster_archive(run_clusters)
+
+    return run_clusters
+
 def write_clusters(clusters):
     # create directory to store cluster data without overwriting exiting directories
     dirname = "clusters"
@@ -642,20 +811,57 @@ def write_clusters(clusters):
           print(j, file = ofile)
     return 1
 
+def write_cluster_archive(clusters):
+    # Alternative to write_clusters that avoids creating one small file per cluster.
+    # All clusters are written sequentially to a single archive, each as its own gzip member, so that the archive is
+    # a valid gzip file in its own right. A tab-delimited index gives the byte offset and length of each cluster's
+    # member, keyed by barcode|index (the same name write_clusters gives each file), for use by read_cluster.
+    archivename = "clusters"
+    count = 1
+    while os.path.exists(archivename + ".gz") or os.path.exists(archivename + ".idx"):
+      archivename = "clusters" + str(count)
+      count += 1
 
-def collapsinate(data, inputargs, barcode_quality_parameters, lev_threshold, barcode_distance_threshold,
-                 outpath, file_id, dont_count):
- 
-    # read in, structure, and quality check input data
-    barcode_dcretc = read_in_data(data, inputargs, barcode_quality_parameters, lev_threshold, dont_count)
-
-    # cluster similar UMIs
-    clusters = cluster_UMIs(barcode_dcretc, inputargs, barcode_distance_threshold, lev_threshold, dont_count)
-
-    # collapse (count) UMIs in each cluster and print to output file
-    print("Collapsing clusters...")
-    t0 = time()
+    print("   Writing clusters to archive: ", os.path.abspath(archivename + ".gz"), "...")
+    offset = 0
+    with open(archivename + ".gz", 'wb') as archive, open(archivename + ".idx", 'w') as index:
+      for k in clusters:
+        member = gzip.compress(("\n".join(clusters[k]) + "\n").encode())
+        archive.write(member)
+        print("\t".join(["|".join(k.split("|")[:2]), str(offset), str(len(member))]), file=index)
+        offset += len(member)
+    return 1
 
+def read_cluster_index(archivename):
+    """ Reads the index of a cluster archive made by write_cluster_archive, as a dictionary of key: (offset, length) """
+    index = {}
+    if archivename.endswith(".gz"):
+      archivename = archivename[:-3]
+    with open(archivename + ".idx") as indexfile:
+      for line in indexfile:
+        key, offset, length = line.rstrip("\n").split("\t")
+        index[key] = (int(offset), int(length))
+    return index
+
+def read_cluster(archivename, key, index=None):
+    """
+    Fetches the reads of one cluster (keyed by barcode|index) from an archive made by write_cluster_archive,
+    seeking straight to it rather than scanning the archive. Pass the output of read_cluster_index to avoid
+    re-reading the index when fetching many clusters.
+    """
+    if index is None:
+      index = read_cluster_index(archivename)
+    offset, length = index[key]
+    with open(archivename, 'rb') as archive:
+      archive.seek(offset)
+      return gzip.decompress(archive.read(length)).decode().splitlines()
+
+
+def collapse_clusters(clusters):
+    # Counts the clusters assigned to each DCR: each cluster is assigned its most common DCR, and the number of
+    # clusters (i.e. distinct originator molecules) gives that DCR's abundance.
+    # Returns the output data (the 5-part DCR plus its abundance and average cluster size), along with the
+    # collapsed DCR counts and the distribution of average cluster sizes
     collapsed = coll.Counter()
     cluster_sizes = coll.defaultdict(list)
 
@@ -664,13 +870,6 @@ def collapsinate(data, inputargs, barcode_quality_parameters, lev_threshold, bar
       collapsed[protodcr] += 1
       cluster_sizes[protodcr].append(len(clusters[c]))
 
-    counts['number_output_unique_dcrs'] = len(collapsed)
-    counts['number_output_total_dcrs'] = sum(collapsed.values())      
-
-    t1 = time()
-    print('  ', round(t1-t0, 2), 'seconds')  
-
-    print("Writing to variable...")
     out_data = []
 
     average_cluster_size_counter = coll.Counter()
@@ -681,6 +880,45 @@ def collapsinate(data, inputargs, barcode_quality_parameters, lev_threshold, bar
       list_dcr.extend([dcr_count, av_clus_size])
       out_data.append(list_dcr)  
 
+    return out_data, collapsed, average_cluster_size_counter
+
+def collapsinate(data, inputargs, barcode_quality_parameters, lev_threshold, barcode_distance_threshold,
+                 outpath, file_id, dont_count, counts, parsed=False, profile=None):
+ 
+    # read in, structure, and quality check input data (or reload the groups saved by an earlier run)
+    with profile_stage('collapsinator_read_in', profile=profile) as stage:
+      if inputargs['loadgroups']:
+        barcode_dcretc = load_groups(inputargs, inputargs['loadgroups'], counts)
+      else:
+        barcode_dcretc = read_in_data(data, inputargs, barcode_quality_parameters, lev_threshold, dont_count, counts, parsed)
+        if inputargs['savegroups']:
+          save_groups(barcode_dcretc, inputargs, inputargs['savegroups'], counts)
+      stage.update({'records_in': counts['readdata_input_dcrs'], 'records_out': len(barcode_dcretc)})
+
+    # cluster similar UMIs (optionally over a sweep of thresholds, returning the clusters for the run's own thresholds)
+    with profile_stage('collapsinator_clustering', len(barcode_dcretc), profile) as stage:
+      if inputargs['sweepbcthresholds'] or inputargs['sweeplevdists']:
+        clusters = sweep_UMIs(barcode_dcretc, inputargs, barcode_distance_threshold, lev_threshold, dont_count, counts)
+      else:
+        clusters = cluster_UMIs(barcode_dcretc, inputargs, barcode_distance_threshold, lev_threshold, dont_count)
+      stage['records_out'] = len(clusters)
+
+    # collapse (count) UMIs in each cluster and print to output file
+    print("Collapsing clusters...")
+    t0 = time()
+
+    with profile_stage('collapsinator_collapsing', len(clusters), profile) as stage:
+      out_data, collapsed, average_cluster_size_counter = collapse_clusters(clusters)
+      stage['records_out'] = len(out_data)
+
+    counts['number_output_unique_dcrs'] = len(collapsed)
+    counts['number_output_total_dcrs'] = sum(collapsed.values())      
+
+    t1 = time()
+    print('  ', round(t1-t0, 2), 'seconds')  
+
+    print("Writing to variable...")
+
     # only need to run this bit if interested in the number of times each barcode is repeated in the data
     if inputargs['barcodeduplication'] == True:
         outfile = outpath+file_id+'_barcode_duplication.txt'
@@ -695,135 +933,159 @@ def collapsinate(data, inputargs, barcode_quality_parameters, lev_threshold, bar
 
     return out_data, collapsed, average_cluster_size_counter
 
-def collapsinator(data: list, inputargs: dict) -> list:
-    """Function wrapper for Collapsinator"""
+class Collapser:
+    """
+    Collapses one sample's decombined reads by their barcodes. Each holds its own counts and settings, so several can
+    be used side by side in one process
+    """
+
+    def __init__(self, inputargs: dict, profile: dict = None):
+        """
+        :param inputargs: command line (argparse) input arguments dictionary
+        :param profile: run profile to record the resource use of the collapsing stages in (see dcr_utilities.profile_stage),
+        otherwise that of the current run, if any
+        """
+        self.inputargs = inputargs
+        self.profile = profile
+        self.counts = coll.Counter()
+
+    def collapse(self, data, parsed: bool = False) -> list:
+        """With parsed, data has already been through parse_barcoded_read (whose counts should be added to self.counts)"""
 
-    print("Running Collapsinator version", __version__)  
+        inputargs, counts, profile = self.inputargs, self.counts, self.profile
+
+        print("Running Collapsinator version", __version__)  
     
-    suffix = "." + inputargs['extension']
+        suffix = "." + inputargs['extension']
     
-    global counts
-    counts = coll.Counter()
-    counts['start_time'] = time()   
+        counts['start_time'] = time()   
         
-    ## this is [min_barcode_nt_quality, max_bc_nts_with_min_quality, min_avg_bc_quality]
-    barcode_quality_parameters = [inputargs['minbcQ'], inputargs['bcQbelowmin'], inputargs['avgQthreshold']]
+        ## this is [min_barcode_nt_quality, max_bc_nts_with_min_quality, min_avg_bc_quality]
+        barcode_quality_parameters = [inputargs['minbcQ'], inputargs['bcQbelowmin'], inputargs['avgQthreshold']]
 
-    ## this is the percentage lev distance that is allowed to determine whether two sequences are equivalent
-    lev_threshold = inputargs['percentlevdist']
+        ## this is the percentage lev distance that is allowed to determine whether two sequences are equivalent
+        lev_threshold = inputargs['percentlevdist']
     
-    ## this is the number of barcode edits that are allowed to call two barcodes equivalent
-    barcode_distance_threshold = inputargs['bcthreshold']
+        ## this is the number of barcode edits that are allowed to call two barcodes equivalent
+        barcode_distance_threshold = inputargs['bcthreshold']
 
-    outpath = ''
+        outpath = ''
     
-    file_id = inputargs['fastq'].split('/')[-1].split('.')[0]
+        file_id = inputargs['fastq'].split('/')[-1].split('.')[0]
 
-    ## this is a boolean for printing progress of the run to the terminal (False for printing, True for not printing; default = False)
-    dont_count = inputargs['dontcount']
+        ## this is a boolean for printing progress of the run to the terminal (False for printing, True for not printing; default = False)
+        dont_count = inputargs['dontcount']
 
-    ########################################
+        ########################################
 
-    out_data, collapsed, average_cluster_size_counter = collapsinate(data, inputargs,
-                                        barcode_quality_parameters,
-                                        lev_threshold, barcode_distance_threshold,
-                                        outpath, file_id, dont_count)
+        out_data, collapsed, average_cluster_size_counter = collapsinate(data, inputargs,
+                                                                         barcode_quality_parameters,
+                                                                         lev_threshold, barcode_distance_threshold,
+                                                                         outpath, file_id, dont_count, counts, parsed, profile)
     
-    counts['end_time'] = time()    
-    counts['time_taken_total_s'] = counts['end_time'] - counts['start_time']
+        counts['end_time'] = time()    
+        counts['time_taken_total_s'] = counts['end_time'] - counts['start_time']
     
-    #######################################
+        #######################################
     
-    # Write data to summary file
-    chain = inputargs["chain"]
-    chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
-    if inputargs['suppresssummary'] == False:
+        # Write data to summary file
+        chain = inputargs["chain"]
+        chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
+        if inputargs['suppresssummary'] == False:
       
-      # Check for directory and make summary file
-      if not os.path.exists('Logs'):
-        os.makedirs('Logs')
-      date = strftime("%Y_%m_%d")
+            # Check for directory and make summary file
+            if not os.path.exists('Logs'):
+                os.makedirs('Logs')
+            date = strftime("%Y_%m_%d")
       
-      # Check for existing date-stamped file
-      summaryname = "Logs/" + date + "_" + "dcr_" + file_id + f"_{chainnams[chain]}" + "_Collapsing_Summary.csv"
-      if not os.path.exists(summaryname): 
-        summaryfile = open(summaryname, "w")
-      else:
-        # If one exists, start an incremental day stamp
-        for i in range(2,10000):
-          summaryname = "Logs/" + date + "_" + "dcr_" + file_id + f"_{chainnams[chain]}" + "_Collapsing_Summary" + str(i) + ".csv"
-          if not os.path.exists(summaryname): 
-            summaryfile = open(summaryname, "w")
-            break
+            # Check for existing date-stamped file
+            summaryname = "Logs/" + date + "_" + "dcr_" + file_id + f"_{chainnams[chain]}" + "_Collapsing_Summary.csv"
+            if not os.path.exists(summaryname): 
+                summaryfile = open(summaryname, "w")
+            else:
+                # If one exists, start an incremental day stamp
+                for i in range(2,10000):
+                    summaryname = "Logs/" + date + "_" + "dcr_" + file_id + f"_{chainnams[chain]}" + "_Collapsing_Summary" + str(i) + ".csv"
+                    if not os.path.exists(summaryname): 
+                        summaryfile = open(summaryname, "w")
+                        break
           
-      inout_name = "_".join(f"{file_id}".split('_')[:-1]) + f"_{chainnams[chain]}"
+            inout_name = "_".join(f"{file_id}".split('_')[:-1]) + f"_{chainnams[chain]}"
       
-      # Generate string to write to summary file
-      summstr = "Property,Value\nVersion," + str(__version__) + "\nDirectory," + os.getcwd() + "\nInputFile," + inout_name \
-        + "\nOutputFile," + inout_name + "\nDateFinished," + date + "\nTimeFinished," + strftime("%H:%M:%S") \
-        + "\nTimeTaken(Seconds)," + str(round(counts['time_taken_total_s'],2)) + "\n\n"
-
-      for s in ['extension', 'dontgzip', 'allowNs', 'dontcheckinput', 'barcodeduplication', 'minbcQ', 'bcQbelowmin', 'bcthreshold', \
-        'lenthreshold', 'percentlevdist', 'avgQthreshold', 'positionalbarcodes', 'oligo']:
-        summstr = summstr + s + "," + str(inputargs[s]) + "\n"
-
-      counts['pc_input_dcrs'] = counts['number_input_total_dcrs'] / counts['readdata_input_dcrs']
-      counts['pc_uniq_dcr_kept'] = ( counts['number_output_unique_dcrs'] / counts['number_input_unique_dcrs'] )
-      counts['pc_total_dcr_kept'] = ( counts['number_output_total_dcrs'] / counts['number_input_total_dcrs'] )
+            # Generate string to write to summary file
+            summstr = "Property,Value\nVersion," + str(__version__) + "\nDirectory," + os.getcwd() + "\nInputFile," + inout_name \
+                + "\nOutputFile," + inout_name + "\nDateFinished," + date + "\nTimeFinished," + strftime("%H:%M:%S") \
+                + "\nTimeTaken(Seconds)," + str(round(counts['time_taken_total_s'],2)) + "\n\n"
+
+            for s in ['extension', 'dontgzip', 'allowNs', 'dontcheckinput', 'barcodeduplication', 'minbcQ', 'bcQbelowmin', 'bcthreshold', \
+                'lenthreshold', 'percentlevdist', 'avgQthreshold', 'positionalbarcodes', 'oligo', 'loadgroups']:
+                summstr = summstr + s + "," + str(inputargs[s]) + "\n"
+
+            counts['pc_input_dcrs'] = counts['number_input_total_dcrs'] / counts['readdata_input_dcrs']
+            counts['pc_uniq_dcr_kept'] = ( counts['number_output_unique_dcrs'] / counts['number_input_unique_dcrs'] )
+            counts['pc_total_dcr_kept'] = ( counts['number_output_total_dcrs'] / counts['number_input_total_dcrs'] )
       
-      counts['avg_input_tcr_size'] = counts['number_input_total_dcrs'] / counts['number_input_unique_dcrs']
-      counts['avg_output_tcr_size'] = counts['number_output_total_dcrs'] / counts['number_output_unique_dcrs']
-      counts['avg_RNA_duplication'] = 1 / counts['pc_total_dcr_kept']
+            counts['avg_input_tcr_size'] = counts['number_input_total_dcrs'] / counts['number_input_unique_dcrs']
+            counts['avg_output_tcr_size'] = counts['number_output_total_dcrs'] / counts['number_output_unique_dcrs']
+            counts['avg_RNA_duplication'] = 1 / counts['pc_total_dcr_kept']
       
-      # success properties
-      summstr = summstr + "\nInputUncollapsedDCRLines," + str(counts['readdata_input_dcrs']) \
-        + "\nUniqueDCRsPassingFilters," + str(counts['number_input_unique_dcrs']) \
-        + "\nTotalDCRsPassingFilters," + str(counts['number_input_total_dcrs']) \
-        + "\nPercentDCRPassingFilters(withbarcode)," + str( round(counts['pc_input_dcrs'], 3 ) ) \
-        + "\nUniqueDCRsPostCollapsing," + str(counts['number_output_unique_dcrs']) \
-        + "\nTotalDCRsPostCollapsing," + str(counts['number_output_total_dcrs']) \
-        + "\nPercentUniqueDCRsKept," + str( round(counts['pc_uniq_dcr_kept'], 3 ) ) \
-        + "\nPercentTotalDCRsKept," + str( round(counts['pc_total_dcr_kept'], 3 ) ) \
-        + "\nAverageInputTCRAbundance," + str( round(counts['avg_input_tcr_size'], 3 ) ) \
-        + "\nAverageOutputTCRAbundance," + str( round(counts['avg_output_tcr_size'], 3 ) ) \
-        + "\nAverageRNAduplication," + str( round(counts['avg_RNA_duplication'], 3 ) ) \
-        + "\n\nBarcodeFail_ContainedNs," + str(counts['getbarcode_fail_N']) \
-        + "\nBarcodeFail_SpacersNotFound," + str(counts['readdata_fail_no_bclocs']) \
-        + "\nBarcodeFail_LowQuality," + str(counts['readdata_fail_low_barcode_quality'])
-
-      print(summstr,file=summaryfile) 
-      summaryfile.close()
-
-      # create output data for UMI histogram and save to file (optional)
-      if inputargs['UMIhistogram']:
-
-        hfileprefix = "_".join( summaryname.split("_")[:-2] + ['UMIhistogram'] )
-        # iterate to create unique file name
-        if os.path.exists(hfileprefix + '.csv'):
-          i = 1
-          while os.path.exists(hfileprefix + str(i) + '.csv'):
-            i += 1
-          hfileprefix += str(i)
+            # success properties
+            summstr = summstr + "\nInputUncollapsedDCRLines," + str(counts['readdata_input_dcrs']) \
+                + "\nUniqueDCRsPassingFilters," + str(counts['number_input_unique_dcrs']) \
+                + "\nTotalDCRsPassingFilters," + str(counts['number_input_total_dcrs']) \
+                + "\nPercentDCRPassingFilters(withbarcode)," + str( round(counts['pc_input_dcrs'], 3 ) ) \
+                + "\nUniqueDCRsPostCollapsing," + str(counts['number_output_unique_dcrs']) \
+                + "\nTotalDCRsPostCollapsing," + str(counts['number_output_total_dcrs']) \
+                + "\nPercentUniqueDCRsKept," + str( round(counts['pc_uniq_dcr_kept'], 3 ) ) \
+                + "\nPercentTotalDCRsKept," + str( round(counts['pc_total_dcr_kept'], 3 ) ) \
+                + "\nAverageInputTCRAbundance," + str( round(counts['avg_input_tcr_size'], 3 ) ) \
+                + "\nAverageOutputTCRAbundance," + str( round(counts['avg_output_tcr_size'], 3 ) ) \
+                + "\nAverageRNAduplication," + str( round(counts['avg_RNA_duplication'], 3 ) ) \
+                + "\n\nBarcodeFail_ContainedNs," + str(counts['getbarcode_fail_N']) \
+                + "\nBarcodeFail_SpacersNotFound," + str(counts['readdata_fail_no_bclocs']) \
+                + "\nBarcodeFail_LowQuality," + str(counts['readdata_fail_low_barcode_quality'])
+
+            print(summstr,file=summaryfile) 
+            summaryfile.close()
+
+            # create output data for UMI histogram and save to file (optional)
+            if inputargs['UMIhistogram']:
+
+                hfileprefix = "_".join( summaryname.split("_")[:-2] + ['UMIhistogram'] )
+                # iterate to create unique file name
+                if os.path.exists(hfileprefix + '.csv'):
+                    i = 1
+                    while os.path.exists(hfileprefix + str(i) + '.csv'):
+                        i += 1
+                    hfileprefix += str(i)
         
-        hfilename = hfileprefix + '.csv'
-
-        with open(hfilename,'w') as hfile:
-
-          for av, count in sorted(average_cluster_size_counter.items()):
-            print(str(av) + "," + str(count), file=hfile)
-
-        # print instructions for creating histogram plot using script in Supplementary-Scripts
-        print("\nAverage UMI cluster size histogram data saved to", hfilename)
-        print("To plot histogram, please use UMIhistogram.py script located in the Decombinator-Tools repository.")
-        print("Decombinator-Tools can be found at https://github.com/innate2adaptive/Decombinator-Tools.")
-        print("With the Decombinator-Tools repository downloaded, run:")
-        codestr = "python path/to/Decombinator-Tools/UMIHistogram.py -in "+ hfilename
-        print("#"*(len(codestr) + 4))
-        print(" ", codestr, " ")
-        print("#"*(len(codestr) + 4))
+                hfilename = hfileprefix + '.csv'
+
+                with open(hfilename,'w') as hfile:
+
+                    for av, count in sorted(average_cluster_size_counter.items()):
+                        print(str(av) + "," + str(count), file=hfile)
+
+                # print instructions for creating histogram plot using script in Supplementary-Scripts
+                print("\nAverage UMI cluster size histogram data saved to", hfilename)
+                print("To plot histogram, please use UMIhistogram.py script located in the Decombinator-Tools repository.")
+                print("Decombinator-Tools can be found at https://github.com/innate2adaptive/Decombinator-Tools.")
+                print("With the Decombinator-Tools repository downloaded, run:")
+                codestr = "python path/to/Decombinator-Tools/UMIHistogram.py -in "+ hfilename
+                print("#"*(len(codestr) + 4))
+                print(" ", codestr, " ")
+                print("#"*(len(codestr) + 4))
   
-    del counts
-    return out_data
+        return out_data
+
+def collapsinator(data: list, inputargs: dict, parsed: bool = False) -> list:
+    """Function wrapper for Collapsinator. With parsed, data has already been through parse_barcoded_read"""
+
+    global counts
+    collapser = Collapser(inputargs)
+    counts = collapser.counts
+
+    return collapser.collapse(data, parsed)
 
 if __name__ == "__main__":
   print("Calling Collapsinator from the shell has been depreciated as of Decombinator V4.3. \
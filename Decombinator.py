@@ -101,6 +101,7 @@ import itertools
 import urllib
 import string
 import collections as coll
+import threading
 import argparse
 import gzip
 import Levenshtein as lev
@@ -151,7 +152,7 @@ def revcomp(read):
   """rc(read): Wrapper for SeqIO reverse complement function"""
   return str(Seq(read).reverse_complement())
 
-def read_tcr_file(species, tagset, gene, filetype, expected_dir_name):
+def read_tcr_file(species, tagset, gene, filetype, expected_dir_name, chain):
   """ Reads in the FASTA and tag data for the appropriate TCR locus """
   
   # Define expected file name
@@ -218,179 +219,330 @@ def readfq(fp):
 ############# DECOMBINE #############
 #####################################
 
-def vanalysis(read):
+# Full names of the chains, by their one letter codes
+chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
 
-  hold_v = v_key.findall(read)
-  
-  if hold_v:
-    if len(hold_v) > 1:
-      counts['multiple_v_matches'] += 1
-      return
+class Decombiner:
+  """
+  Decombiner: finds rearranged TCRs of one chain in reads. Each holds its own tag index, counts and settings, so several
+  (e.g. for different chains or samples) can be used side by side in one process, including from different threads
+  """
+
+  def __init__(self, inputargs: dict, tags=None):
+    """
+    :param inputargs: command line (argparse) input arguments dictionary; its tag set is switched to the original
+    tags where there is no extended set for the species or chain
+    :param tags: TagIndex to use, otherwise the shared one for the chain, species and tag set in inputargs
+    """
+    self.inputargs = inputargs
+    self.counts = coll.Counter()
+    self.chain = get_chain(self.inputargs, self.counts)
+    print('Importing TCR', chainnams[self.chain], 'gene sequences...')
+    check_tag_set(self.inputargs, self.chain)
+    self.tags = tags or get_tag_index(self.inputargs['species'], self.inputargs['tags'], self.chain,
+                                      self.inputargs['tagfastadir'])
+
+  def vanalysis(self, read):
+    v_key, v_seqs, jump_to_end_v, v_regions = self.tags.v_key, self.tags.v_seqs, self.tags.jump_to_end_v, self.tags.v_regions
+    half1_v_key, half1_v_seqs, half2_v_key, half2_v_seqs, v_half_split = self.tags.half1_v_key, self.tags.half1_v_seqs, \
+      self.tags.half2_v_key, self.tags.half2_v_seqs, self.tags.v_half_split
+    counts = self.counts
+
+    hold_v = v_key.findall(read)
+  
+    if hold_v:
+      if len(hold_v) > 1:
+        counts['multiple_v_matches'] += 1
+        return
 
-    v_match = v_seqs.index(hold_v[0][0]) # Assigns VJ
-    temp_end_v = hold_v[0][1] + jump_to_end_v[v_match] - 1 # Finds where the end of a full V would be
+      v_match = v_seqs.index(hold_v[0][0]) # Assigns VJ
+      temp_end_v = hold_v[0][1] + jump_to_end_v[v_match] - 1 # Finds where the end of a full V would be
     
-    v_seq_start = hold_v[0][1]      
-    end_v_v_dels = get_v_deletions( read, v_match, temp_end_v, v_regions )      
-    if end_v_v_dels: # If the number of deletions has been found
-      return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
+      v_seq_start = hold_v[0][1]      
+      end_v_v_dels = self.get_v_deletions( read, v_match, temp_end_v, v_regions )      
+      if end_v_v_dels: # If the number of deletions has been found
+        return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
       
-  else:
+    else:
     
-    hold_v1 = half1_v_key.findall(read)
+      hold_v1 = half1_v_key.findall(read)
     
-    if hold_v1:
-      for i in range(len(hold_v1)):
-        indices = [y for y, x in enumerate(half1_v_seqs) if x == hold_v1[i][0] ]
-        for k in indices:
-          if len(v_seqs[k]) == len(read[hold_v1[i][1]:hold_v1[i][1]+len(v_seqs[half1_v_seqs.index(hold_v1[i][0])])]):
-            if lev.hamming( v_seqs[k], read[hold_v1[i][1]:hold_v1[i][1]+len(v_seqs[k])] ) <= 1:
-              counts['verr2'] += 1
-              v_match = k
-              temp_end_v = hold_v1[i][1] + jump_to_end_v[v_match] - 1 # Finds where the end of a full V would be
-              end_v_v_dels = get_v_deletions( read, v_match, temp_end_v, v_regions )
-              if end_v_v_dels:
-                v_seq_start = hold_v1[i][1]  
-                return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
-      counts['foundv1notv2'] += 1
-      return
-    
-    else:
-      
-      hold_v2 = half2_v_key.findall(read)
-      if hold_v2:
-        for i in range(len(hold_v2)):
-          indices = [y for y, x in enumerate(half2_v_seqs) if x == hold_v2[i][0] ]
+      if hold_v1:
+        for i in range(len(hold_v1)):
+          indices = [y for y, x in enumerate(half1_v_seqs) if x == hold_v1[i][0] ]
           for k in indices:
-            if len(v_seqs[k]) == len(read[hold_v2[i][1]-v_half_split:hold_v2[i][1]-v_half_split+len(v_seqs[half2_v_seqs.index(hold_v2[i][0])])]):
-              if lev.hamming( v_seqs[k], read[hold_v2[i][1]-v_half_split:hold_v2[i][1]+len(v_seqs[k])-v_half_split] ) <= 1:
-                counts['verr1'] += 1
+            if len(v_seqs[k]) == len(read[hold_v1[i][1]:hold_v1[i][1]+len(v_seqs[half1_v_seqs.index(hold_v1[i][0])])]):
+              if lev.hamming( v_seqs[k], read[hold_v1[i][1]:hold_v1[i][1]+len(v_seqs[k])] ) <= 1:
+                counts['verr2'] += 1
                 v_match = k
-                temp_end_v = hold_v2[i][1] + jump_to_end_v[v_match] - v_half_split - 1 # Finds where the end of a full V would be
-                end_v_v_dels = get_v_deletions( read, v_match, temp_end_v, v_regions )
+                temp_end_v = hold_v1[i][1] + jump_to_end_v[v_match] - 1 # Finds where the end of a full V would be
+                end_v_v_dels = self.get_v_deletions( read, v_match, temp_end_v, v_regions )
                 if end_v_v_dels:
-                  v_seq_start = hold_v2[i][1] - v_half_split      
+                  v_seq_start = hold_v1[i][1]  
                   return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
-        counts['foundv2notv1'] += 1
+        counts['foundv1notv2'] += 1
         return
-              
+    
       else:
-        counts['no_vtags_found'] += 1
-        return
       
-def janalysis(read, end_of_v):
+        hold_v2 = half2_v_key.findall(read)
+        if hold_v2:
+          for i in range(len(hold_v2)):
+            indices = [y for y, x in enumerate(half2_v_seqs) if x == hold_v2[i][0] ]
+            for k in indices:
+              if len(v_seqs[k]) == len(read[hold_v2[i][1]-v_half_split:hold_v2[i][1]-v_half_split+len(v_seqs[half2_v_seqs.index(hold_v2[i][0])])]):
+                if lev.hamming( v_seqs[k], read[hold_v2[i][1]-v_half_split:hold_v2[i][1]+len(v_seqs[k])-v_half_split] ) <= 1:
+                  counts['verr1'] += 1
+                  v_match = k
+                  temp_end_v = hold_v2[i][1] + jump_to_end_v[v_match] - v_half_split - 1 # Finds where the end of a full V would be
+                  end_v_v_dels = self.get_v_deletions( read, v_match, temp_end_v, v_regions )
+                  if end_v_v_dels:
+                    v_seq_start = hold_v2[i][1] - v_half_split      
+                    return v_match, end_v_v_dels[0], end_v_v_dels[1], v_seq_start
+          counts['foundv2notv1'] += 1
+          return
+              
+        else:
+          counts['no_vtags_found'] += 1
+          return
+
+  def janalysis(self, read, end_of_v):
+    j_key, j_seqs, jump_to_start_j, j_regions = self.tags.j_key, self.tags.j_seqs, self.tags.jump_to_start_j, self.tags.j_regions
+    half1_j_key, half1_j_seqs, half2_j_key, half2_j_seqs, j_half_split = self.tags.half1_j_key, self.tags.half1_j_seqs, \
+      self.tags.half2_j_key, self.tags.half2_j_seqs, self.tags.j_half_split
+    counts = self.counts
   
-  hold_j = j_key.findall(read)
+    hold_j = j_key.findall(read)
   
-  if hold_j:
-    if len(hold_j) > 1:
-      counts['multiple_j_matches'] += 1
-      return
+    if hold_j:
+      if len(hold_j) > 1:
+        counts['multiple_j_matches'] += 1
+        return
   
-    j_match = j_seqs.index(hold_j[0][0]) # Assigns J
-    temp_start_j = hold_j[0][1] - jump_to_start_j[j_match] # Finds where the start of a full J would be
+      j_match = j_seqs.index(hold_j[0][0]) # Assigns J
+      temp_start_j = hold_j[0][1] - jump_to_start_j[j_match] # Finds where the start of a full J would be
     
-    j_seq_end = hold_j[0][1] + len(hold_j[0][0])      
+      j_seq_end = hold_j[0][1] + len(hold_j[0][0])      
         
-    start_j_j_dels = get_j_deletions( read, j_match, temp_start_j, j_regions, end_of_v )
+      start_j_j_dels = self.get_j_deletions( read, j_match, temp_start_j, j_regions, end_of_v )
     
-    if start_j_j_dels: # If the number of deletions has been found
-      return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
+      if start_j_j_dels: # If the number of deletions has been found
+        return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
           
-  else:
+    else:
     
-    hold_j1 = half1_j_key.findall(read)
-    if hold_j1:
-      for i in range(len(hold_j1)):
-        indices = [y for y, x in enumerate(half1_j_seqs) if x == hold_j1[i][0] ]
-        for k in indices:
-          if len(j_seqs[k]) == len(read[hold_j1[i][1]:hold_j1[i][1]+len(j_seqs[half1_j_seqs.index(hold_j1[i][0])])]):
-            if lev.hamming( j_seqs[k], read[hold_j1[i][1]:hold_j1[i][1]+len(j_seqs[k])] ) <= 1:
-              counts['jerr2'] += 1
-              j_match = k
-              temp_start_j = hold_j1[i][1] - jump_to_start_j[j_match] # Finds where the start of a full J would be
-              j_seq_end = hold_j1[i][1] + len(hold_j1[i][0]) + j_half_split                                              
-              start_j_j_dels = get_j_deletions( read, j_match, temp_start_j, j_regions, end_of_v )
-              if start_j_j_dels:
-                return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
-      counts['foundj1notj2'] += 1
-      return              
-            
-    else:        
-      hold_j2 = half2_j_key.findall(read)
-      if hold_j2:
-        for i in range(len(hold_j2)):
-          indices = [y for y, x in enumerate(half2_j_seqs) if x == hold_j2[i][0] ]
+      hold_j1 = half1_j_key.findall(read)
+      if hold_j1:
+        for i in range(len(hold_j1)):
+          indices = [y for y, x in enumerate(half1_j_seqs) if x == hold_j1[i][0] ]
           for k in indices:
-            if len(j_seqs[k]) == len(read[hold_j2[i][1]-j_half_split:hold_j2[i][1]-j_half_split+len(j_seqs[half2_j_seqs.index(hold_j2[i][0])])]):
-              if lev.hamming( j_seqs[k], read[hold_j2[i][1]-j_half_split:hold_j2[i][1]+len(j_seqs[k])-j_half_split] ) <= 1:
-                counts['jerr1'] += 1
+            if len(j_seqs[k]) == len(read[hold_j1[i][1]:hold_j1[i][1]+len(j_seqs[half1_j_seqs.index(hold_j1[i][0])])]):
+              if lev.hamming( j_seqs[k], read[hold_j1[i][1]:hold_j1[i][1]+len(j_seqs[k])] ) <= 1:
+                counts['jerr2'] += 1
                 j_match = k
-                temp_start_j = hold_j2[i][1] - jump_to_start_j[j_match] - j_half_split # Finds where the start of a full J would be
-                j_seq_end = hold_j2[i][1] + len(hold_j2[i][0])                                                
-                start_j_j_dels = get_j_deletions( read, j_match, temp_start_j, j_regions, end_of_v )
+                temp_start_j = hold_j1[i][1] - jump_to_start_j[j_match] # Finds where the start of a full J would be
+                j_seq_end = hold_j1[i][1] + len(hold_j1[i][0]) + j_half_split                                              
+                start_j_j_dels = self.get_j_deletions( read, j_match, temp_start_j, j_regions, end_of_v )
                 if start_j_j_dels:
                   return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
-        counts['foundv2notv1'] += 1
-        return
+        counts['foundj1notj2'] += 1
+        return              
+            
+      else:        
+        hold_j2 = half2_j_key.findall(read)
+        if hold_j2:
+          for i in range(len(hold_j2)):
+            indices = [y for y, x in enumerate(half2_j_seqs) if x == hold_j2[i][0] ]
+            for k in indices:
+              if len(j_seqs[k]) == len(read[hold_j2[i][1]-j_half_split:hold_j2[i][1]-j_half_split+len(j_seqs[half2_j_seqs.index(hold_j2[i][0])])]):
+                if lev.hamming( j_seqs[k], read[hold_j2[i][1]-j_half_split:hold_j2[i][1]+len(j_seqs[k])-j_half_split] ) <= 1:
+                  counts['jerr1'] += 1
+                  j_match = k
+                  temp_start_j = hold_j2[i][1] - jump_to_start_j[j_match] - j_half_split # Finds where the start of a full J would be
+                  j_seq_end = hold_j2[i][1] + len(hold_j2[i][0])                                                
+                  start_j_j_dels = self.get_j_deletions( read, j_match, temp_start_j, j_regions, end_of_v )
+                  if start_j_j_dels:
+                    return j_match, start_j_j_dels[0], start_j_j_dels[1], j_seq_end
+          counts['foundv2notv1'] += 1
+          return
       
-      else:
-         counts['no_j_assigned'] += 1
-         return
-       
-def dcr(read, inputargs):
+        else:
+           counts['no_j_assigned'] += 1
+           return
+
+  def dcr(self, read):
 
-  """dcr(read): Core function which checks a read (in the given frame) for a rearranged TCR of the specified chain.
-    Returns a list giving: V gene index, J gene index, # deletions in V gene, # deletions in J gene,
-      insert sequence (between ends of V and J), inter-tag sequence (for collapsing), and its quality scores"""
-  v_seq_start = 0     
-  j_seq_end = 0      
+    """dcr(read): Core function which checks a read (in the given frame) for a rearranged TCR of the specified chain.
+      Returns a list giving: V gene index, J gene index, # deletions in V gene, # deletions in J gene,
+        insert sequence (between ends of V and J), inter-tag sequence (for collapsing), and its quality scores"""
+    jump_to_end_v, jump_to_start_j, v_seqs, j_seqs = self.tags.jump_to_end_v, self.tags.jump_to_start_j, self.tags.v_seqs, self.tags.j_seqs
+    inputargs, counts = self.inputargs, self.counts
+    v_seq_start = 0     
+    j_seq_end = 0      
   
-  vdat = vanalysis(read)
+    vdat = self.vanalysis(read)
   
-  if not vdat:
-    return
+    if not vdat:
+      return
 
-  end_of_v = vdat[1] + 1
-  jdat = janalysis(read, end_of_v)
+    end_of_v = vdat[1] + 1
+    jdat = self.janalysis(read, end_of_v)
   
-  if jdat:
+    if jdat:
     
-    # Filter out rearrangements with indications they probably represent erroneous sequences
-    if "N" in read[vdat[3]:jdat[3]] and inputargs['allowNs'] == False:                          # Ambiguous base in inter-tag region
-      counts['dcrfilter_intertagN'] += 1
-    elif (vdat[3] - jdat[3]) >= inputargs['lenthreshold']:                                      # Inter-tag length threshold
-      counts['dcrfilter_toolong_intertag'] += 1
-    elif vdat[2] > (jump_to_end_v[vdat[0]] - len(v_seqs[vdat[0]])) or jdat[2] > jump_to_start_j[jdat[0]]: # Impossible number of deletions
-      counts['dcrfilter_imposs_deletion'] += 1                    
-    elif (vdat[3] + len(v_seqs[vdat[0]])) > (jdat[3] + len(j_seqs[jdat[0]])):                             # Overlapping tags 
-      counts['dcrfilter_tag_overlap'] += 1                     
+      # Filter out rearrangements with indications they probably represent erroneous sequences
+      if "N" in read[vdat[3]:jdat[3]] and inputargs['allowNs'] == False:                          # Ambiguous base in inter-tag region
+        counts['dcrfilter_intertagN'] += 1
+      elif (vdat[3] - jdat[3]) >= inputargs['lenthreshold']:                                      # Inter-tag length threshold
+        counts['dcrfilter_toolong_intertag'] += 1
+      elif vdat[2] > (jump_to_end_v[vdat[0]] - len(v_seqs[vdat[0]])) or jdat[2] > jump_to_start_j[jdat[0]]: # Impossible number of deletions
+        counts['dcrfilter_imposs_deletion'] += 1                    
+      elif (vdat[3] + len(v_seqs[vdat[0]])) > (jdat[3] + len(j_seqs[jdat[0]])):                             # Overlapping tags 
+        counts['dcrfilter_tag_overlap'] += 1                     
     
-    else:        
-      vj_details = [vdat[0], jdat[0], vdat[2], jdat[2], read[vdat[1]+1:jdat[1]], vdat[3], jdat[3]]
-      return vj_details
-  
-  else:
-    counts['VJ_assignment_failed'] += 1
-    return
+      else:        
+        vj_details = [vdat[0], jdat[0], vdat[2], jdat[2], read[vdat[1]+1:jdat[1]], vdat[3], jdat[3]]
+        return vj_details
   
+    else:
+      counts['VJ_assignment_failed'] += 1
+      return
+
+  def get_v_deletions(self, read, v_match, temp_end_v, v_regions_cut ):
+      counts = self.counts
+      # This function determines the number of V deletions in sequence read
+      # by comparing it to v_match, beginning by making comparisons at the
+      # end of v_match and at position temp_end_v in read.
+      function_temp_end_v = temp_end_v
+      pos = len(v_regions_cut[v_match]) -10    # changed from -1 for new checking technique
+      is_v_match = 0
+    
+      # Catch situations in which the temporary end of the V exists beyond the end of the read
+      if function_temp_end_v >= len(read):
+        counts['v_del_failed_tag_at_end'] += 1
+        return
+    
+      function_temp_end_v += 1
+      num_del = 0
+
+      while is_v_match == 0 and 0 <= function_temp_end_v < len(read):
+          # Require a 10 base match to determine where end of germ-line sequence lies
+          if str(v_regions_cut[v_match])[pos:pos+10] == read[function_temp_end_v-10:function_temp_end_v]:
+              is_v_match = 1
+              deletions_v = num_del            
+              end_v = temp_end_v - num_del
+          else:
+              pos -= 1
+              num_del += 1
+              function_temp_end_v -= 1
+
+      if is_v_match == 1:
+          return [end_v, deletions_v]
+      else:
+          counts['v_del_failed'] += 1
+          return
+
+  def get_j_deletions(self, read, j_match, temp_start_j, j_regions_cut, end_of_v ):
+      counts = self.counts
+      # This function determines the number of J deletions in sequence read
+      # by comparing it to j_match, beginning by making comparisons at the
+      # end of j_match and at position temp_end_j in read.
+      function_temp_start_j = temp_start_j
+      pos = 0
+      is_j_match = 0
+      while is_j_match == 0 and 0 <= function_temp_start_j+2 < len(str(read)):
+          # in the case of no detectable insertions, where nucleotide junctions could be derived from either gene,
+          # nucleotides will be deemed to have derived from the V gene, and count towards deletions from J. 
+          if function_temp_start_j < end_of_v:
+            pos += 1
+            function_temp_start_j += 1
+          # Require a 10 base match to determine where end of germ-line sequence lies
+          elif str(j_regions_cut[j_match])[pos:pos+10] == read[function_temp_start_j:function_temp_start_j+10]:
+              is_j_match = 1
+              deletions_j = pos
+              start_j = function_temp_start_j
+          else:
+              pos += 1
+              function_temp_start_j += 1
+            
+      if is_j_match == 1:
+          return [start_j, deletions_j]
+      else:
+          counts['j_del_failed'] += 1
+          return
+
+  def decombine_read(self, readid, vdj, vdjqual, bc, bcQ):
+    """
+    Looks for a rearranged TCR in a single read
+    :return: the Decombinator output record (5-part classifier, read ID, inter-tag sequence and quality, barcode and
+    barcode quality), or None if no rearrangement is found
+    """
+    inputargs, counts = self.inputargs, self.counts
+
+    if "N" in bc and inputargs['allowNs'] == False:       # Ambiguous base in barcode region
+      counts['dcrfilter_barcodeN'] += 1
+
+    # Get details of the VJ recombination
+    if inputargs['orientation'] == 'reverse':
+      recom = self.dcr(revcomp(vdj))
+      frame = 'reverse'
+    elif inputargs['orientation'] == 'forward':
+      recom = self.dcr(vdj)
+      frame = 'forward'
+    elif inputargs['orientation'] == 'both':
+      recom = self.dcr(revcomp(vdj))
+      frame = 'reverse'
+      if not recom:
+        recom = self.dcr(vdj)
+        frame = 'forward'
+
+    if not recom:
+      return None
+
+    counts['vj_count'] += 1
+
+    if frame == 'reverse':
+      tcrseq = revcomp(vdj)[recom[5]:recom[6]]
+      tcrQ = vdjqual[::-1][recom[5]:recom[6]]
+    elif frame == 'forward':
+      tcrseq = vdj[recom[5]:recom[6]]
+      tcrQ = vdjqual[recom[5]:recom[6]]
+
+    return [str(recom[0]), str(recom[1]), str(recom[2]), str(recom[3]), recom[4], readid, tcrseq, tcrQ, bc, bcQ]
+
+# Decombiner used by the module-level functions, as set up by import_tcr_info
+default_decombiner = None
+
+def vanalysis(read):
+  return default_decombiner.vanalysis(read)
+
+def janalysis(read, end_of_v):
+  return default_decombiner.janalysis(read, end_of_v)
+
+def dcr(read, inputargs):
+  """dcr(read): Module-level version of Decombiner.dcr, using the tags and settings given to import_tcr_info"""
+  return default_decombiner.dcr(read)
+
+def decombine_read(readid, vdj, vdjqual, bc, bcQ, inputargs: dict):
+  """ Module-level version of Decombiner.decombine_read, using the tags and settings given to import_tcr_info """
+  return default_decombiner.decombine_read(readid, vdj, vdjqual, bc, bcQ)
+
 ###########################################################
 ############# ANCILLARY DECOMBINING FUNCTIONS #############
 ###########################################################
 
-def import_tcr_info(inputargs):
-  """ import_tcr_info: Gathers the required TCR chain information for Decombining """
-    
-  # Get chain information
-  global chainnams, chain, counts
-  counts = coll.Counter()
-  chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
+def get_chain(inputargs, counts):
+  """ get_chain: Works out which TCR chain to look for, from the chain argument or failing that the FASTQ file name """
    
   # Detect whether chain specified in filename
   inner_filename_chains = [x for x in chainnams.values() if x in inputargs['fastq'].lower()]
   if len(inner_filename_chains) == 1:
       counts['chain_detected'] = 1
   
+  nochain_error = "TCR chain not recognised. \n \
+  Please either include (one) chain name in the file name (i.e. alpha/beta/gamma/delta),\n \
+  or use the \'-c\' flag with an explicit chain option (a/b/g/d, case-insensitive)."
+
   if inputargs['chain']:
     if inputargs['chain'].upper() in ['A', 'ALPHA', 'TRA', 'TCRA']:
       chain = "a" 
@@ -410,17 +562,13 @@ def import_tcr_info(inputargs):
       chain = inner_filename_chains[0][0]  
           
     else:
-      nochain_error = "TCR chain not recognised. \n \
-      Please either include (one) chain name in the file name (i.e. alpha/beta/gamma/delta),\n \
-      or use the \'-c\' flag with an explicit chain option (a/b/g/d, case-insensitive)."
       print(nochain_error)
       sys.exit()
-      
-  #################################################
-  ############# GET GENES, BUILD TRIE #############
-  #################################################
-    
-  print('Importing TCR', chainnams[chain], 'gene sequences...')
+
+  return chain
+
+def check_tag_set(inputargs, chain):
+  """ check_tag_set: Checks the tag set and species, switching to the original tag set where there is no extended one """
 
   # First check that valid tag/species combinations have been used
   if inputargs['tags'] == "extended" and inputargs['species'] == "mouse":
@@ -435,13 +583,7 @@ def import_tcr_info(inputargs):
     In future, consider editing the script to change the default, or use the appropriate flags.")
     inputargs['tags'] = "original"
 
-  # Set tag split position, and check tag set. Note that original tags use shorter length J half tags, as these tags were originally shorter.
-  global v_half_split, j_half_split
-  if inputargs['tags'] == "extended":
-    v_half_split, j_half_split = [10,10] 
-  elif inputargs['tags'] == "original":
-    v_half_split, j_half_split = [10,6] 
-  else:
+  if inputargs['tags'] not in ["extended", "original"]:
     print("Tag set unrecognised; should be either \'extended\' or \'original\' for human, or just \'original\' for mouse. \n \
     Please check tag set and species flag.")
     sys.exit()
@@ -451,107 +593,74 @@ def import_tcr_info(inputargs):
     print("Species not recognised. Please select either \'human\' (default) or \'mouse\'.\n \
     If mouse is required by default, consider changing the default value in the script.")
     sys.exit()    
-    
-  # Look for tag and V/J fasta and tag files: if these cannot be found in the working directory, source them from GitHub repositories
-    # Note that fasta/tag files fit the pattern "species_tagset_gene.[fasta/tags]"
-    # I.e. "[human/mouse]_[extended/original]_TR[A/B/G/D][V/J].[fasta/tags]"
-  
-  for gene in ['v', 'j']:
-    # Get FASTA data
-    fasta_file = read_tcr_file(inputargs['species'], inputargs['tags'], gene, "fasta", inputargs['tagfastadir'])
-    globals()[gene + "_genes"] = list(SeqIO.parse(fasta_file, "fasta"))
-    
-    globals()[gene+"_regions"] = []
-    for g in range(0, len(globals()[gene+"_genes"])):
-        globals()[gene+"_regions"].append(globals()[gene+"_genes"][g].seq.upper())  
-        
-    # Get tag data
-    tag_file = read_tcr_file(inputargs['species'], inputargs['tags'], gene, "tags", inputargs['tagfastadir'])  # get tag data
-    tag_data = open(tag_file, "r")
-    if gene == 'v': jumpfunction = "jump_to_end_v"
-    elif gene == 'j': jumpfunction = "jump_to_start_j"
-    globals()[gene+"_seqs"], globals()["half1_"+gene+"_seqs"], globals()["half2_"+gene+"_seqs"], globals()[jumpfunction] = \
-      globals()["get_"+gene+"_tags"](tag_data, globals()[gene+"_half_split"])
-    tag_data.close()
-    
-    # Build Aho-Corasick tries
-    globals()[gene+"_builder"] = AcoraBuilder()
-    for i in range(0,len(globals()[gene+"_seqs"])):
-        globals()[gene+"_builder"].add(str(globals()[gene+"_seqs"][i])) # Add all V tags to keyword trie
-    globals()[gene+"_key"] = globals()[gene+"_builder"].build()
-
-    # And tries for split, half-tags
-    globals()[gene+"_half1_builder"] = AcoraBuilder()
-    for i in range(0,len(globals()["half1_"+gene+"_seqs"])):
-        globals()[gene+"_half1_builder"].add(str(globals()["half1_"+gene+"_seqs"][i]))
-    globals()["half1_"+gene+"_key"] = globals()[gene+"_half1_builder"].build()
-
-    globals()[gene+"_half2_builder"] = AcoraBuilder()
-    for i in range(0,len(globals()["half2_"+gene+"_seqs"])):
-        globals()[gene+"_half2_builder"].add(str(globals()["half2_"+gene+"_seqs"][i]))
-    globals()["half2_"+gene+"_key"] = globals()[gene+"_half2_builder"].build()
-
-
-def get_v_deletions( read, v_match, temp_end_v, v_regions_cut ):
-    # This function determines the number of V deletions in sequence read
-    # by comparing it to v_match, beginning by making comparisons at the
-    # end of v_match and at position temp_end_v in read.
-    function_temp_end_v = temp_end_v
-    pos = len(v_regions_cut[v_match]) -10    # changed from -1 for new checking technique
-    is_v_match = 0
-    
-    # Catch situations in which the temporary end of the V exists beyond the end of the read
-    if function_temp_end_v >= len(read):
-      counts['v_del_failed_tag_at_end'] += 1
-      return
-    
-    function_temp_end_v += 1
-    num_del = 0
-
-    while is_v_match == 0 and 0 <= function_temp_end_v < len(read):
-        # Require a 10 base match to determine where end of germ-line sequence lies
-        if str(v_regions_cut[v_match])[pos:pos+10] == read[function_temp_end_v-10:function_temp_end_v]:
-            is_v_match = 1
-            deletions_v = num_del            
-            end_v = temp_end_v - num_del
-        else:
-            pos -= 1
-            num_del += 1
-            function_temp_end_v -= 1
 
-    if is_v_match == 1:
-        return [end_v, deletions_v]
-    else:
-        counts['v_del_failed'] += 1
-        return 
-
-def get_j_deletions( read, j_match, temp_start_j, j_regions_cut, end_of_v ):
-    # This function determines the number of J deletions in sequence read
-    # by comparing it to j_match, beginning by making comparisons at the
-    # end of j_match and at position temp_end_j in read.
-    function_temp_start_j = temp_start_j
-    pos = 0
-    is_j_match = 0
-    while is_j_match == 0 and 0 <= function_temp_start_j+2 < len(str(read)):
-        # in the case of no detectable insertions, where nucleotide junctions could be derived from either gene,
-        # nucleotides will be deemed to have derived from the V gene, and count towards deletions from J. 
-        if function_temp_start_j < end_of_v:
-          pos += 1
-          function_temp_start_j += 1
-        # Require a 10 base match to determine where end of germ-line sequence lies
-        elif str(j_regions_cut[j_match])[pos:pos+10] == read[function_temp_start_j:function_temp_start_j+10]:
-            is_j_match = 1
-            deletions_j = pos
-            start_j = function_temp_start_j
-        else:
-            pos += 1
-            function_temp_start_j += 1
-            
-    if is_j_match == 1:
-        return [start_j, deletions_j]
-    else:
-        counts['j_del_failed'] += 1
-        return 
+def build_trie(seqs):
+  """ build_trie: Builds an Aho-Corasick trie to search for all of the given sequences at once """
+  builder = AcoraBuilder()
+  for seq in seqs:
+    builder.add(str(seq))
+  return builder.build()
+
+class TagIndex:
+  """
+  TagIndex: the germline sequences and tags of one chain's V and J genes, with the Aho-Corasick tries used to find them.
+  Nothing changes it once built, so one can be shared by any number of Decombiners
+  """
+
+  def __init__(self, species, tags, chain, tagfastadir):
+
+    # Set tag split position. Note that original tags use shorter length J half tags, as these tags were originally shorter.
+    if tags == "extended":
+      self.v_half_split, self.j_half_split = [10,10] 
+    elif tags == "original":
+      self.v_half_split, self.j_half_split = [10,6] 
+
+    # Look for tag and V/J fasta and tag files: if these cannot be found in the working directory, source them from GitHub repositories
+      # Note that fasta/tag files fit the pattern "species_tagset_gene.[fasta/tags]"
+      # I.e. "[human/mouse]_[extended/original]_TR[A/B/G/D][V/J].[fasta/tags]"
+    for gene in ['v', 'j']:
+      # Get FASTA data
+      fasta_file = read_tcr_file(species, tags, gene, "fasta", tagfastadir, chain)
+      genes = list(SeqIO.parse(fasta_file, "fasta"))
+      setattr(self, gene + "_genes", genes)
+      setattr(self, gene + "_regions", [x.seq.upper() for x in genes])
+
+      # Get tag data
+      tag_file = read_tcr_file(species, tags, gene, "tags", tagfastadir, chain)
+      with open(tag_file, "r") as tag_data:
+        seqs, half1_seqs, half2_seqs, jumps = globals()["get_" + gene + "_tags"](tag_data, getattr(self, gene + "_half_split"))
+      setattr(self, gene + "_seqs", seqs)
+      setattr(self, "half1_" + gene + "_seqs", half1_seqs)
+      setattr(self, "half2_" + gene + "_seqs", half2_seqs)
+      setattr(self, "jump_to_end_v" if gene == 'v' else "jump_to_start_j", jumps)
+
+      # Build Aho-Corasick tries, for whole tags and split, half-tags
+      setattr(self, gene + "_key", build_trie(seqs))
+      setattr(self, "half1_" + gene + "_key", build_trie(half1_seqs))
+      setattr(self, "half2_" + gene + "_key", build_trie(half2_seqs))
+
+# Tag indexes already built, by (species, tag set, chain, tag/FASTA directory), e.g. for decombining many samples
+tag_index_cache = {}
+tag_index_lock = threading.Lock()
+
+def get_tag_index(species, tags, chain, tagfastadir):
+  """ get_tag_index: Gets the TagIndex for a chain, only building it the first time it is needed """
+  with tag_index_lock:
+    cache_key = (species, tags, chain, tagfastadir)
+    if cache_key not in tag_index_cache:
+      tag_index_cache[cache_key] = TagIndex(species, tags, chain, tagfastadir)
+    return tag_index_cache[cache_key]
+
+def import_tcr_info(inputargs):
+  """
+  import_tcr_info: Gathers the required TCR chain information for Decombining, for use by the module-level functions
+  (Decombiner objects hold their own)
+  :return: the Decombiner used by the module-level functions
+  """
+  global default_decombiner, chain, counts
+  default_decombiner = Decombiner(inputargs)
+  chain, counts = default_decombiner.chain, default_decombiner.counts
+  return default_decombiner
 
 def get_v_tags(file_v, half_split):
     #"""Read V tags in from file"""
@@ -600,9 +709,50 @@ def sort_permissions(fl):
 ############# READ IN COMMAND LINE ARGUMENTS #############
 ##########################################################
 
-def decombinator(inputargs: dict) -> list:
+def decombinator(inputargs: dict, decombiner: Decombiner = None) -> list:
   """Function wrapper for decombinator."""
-  
+
+  return list(decombinator_records(inputargs, decombiner))
+
+def decombinator_records(inputargs: dict, decombiner: Decombiner = None):
+  """
+  Generator version of decombinator: yields each output record as soon as it is found, so that downstream stages can
+  process reads as they are decombined. The summary is written once the generator has been exhausted.
+  Uses decombiner's tags and counts if given, otherwise those set up by import_tcr_info.
+  """
+
+  opener, decombiner = start_decombining(inputargs, decombiner)
+  counts = decombiner.counts
+
+  found_tcrs = coll.Counter()
+
+  for readid, vdj, vdjqual, bc, bcQ in read_fastq_pairs(inputargs, opener):
+
+    counts['read_count'] += 1
+    if counts['read_count'] % 100000 == 0 and inputargs['dontcount'] == False:
+        print('\t read', counts['read_count'])
+
+    dcr_output = decombiner.decombine_read(readid, vdj, vdjqual, bc, bcQ)
+    if dcr_output:
+      yield dcr_output
+
+  if inputargs['nobarcoding'] == True:
+    # Write out non-barcoded results, with frequencies
+    if inputargs['extension'] == 'n12':
+      print("Non-barcoding option selected, but default output file extension (n12) detected. Automatically changing to 'nbc'.")
+    for x in found_tcrs.most_common():
+      yield x[0] + ", " + str(found_tcrs[x[0]])
+
+  finish_decombining(inputargs, decombiner)
+
+def start_decombining(inputargs: dict, decombiner: Decombiner = None):
+  """
+  Checks the input FASTQ and loads the TCR tag information (unless a decombiner is given), ready for decombining
+  :return: the function to open the FASTQ files with, and the Decombiner to use
+  """
+
+  global chain, counts
+
   print("Running Decombinator version", __version__)
 
   opener = opener_check(inputargs)
@@ -614,43 +764,27 @@ def decombinator(inputargs: dict) -> list:
       sys.exit()
   
   # Get TCR gene information
-  import_tcr_info(inputargs)
-
-  # Get Barcode length
-  bclength = inputargs['bclength']
-  
-  counts['start_time'] = time()
+  if decombiner is None:
+    decombiner = import_tcr_info(inputargs)
+  else:
+    # The module-level chain and counts always describe the latest run, however it was decombined
+    chain, counts = decombiner.chain, decombiner.counts
   
-  #########################################################
-  ############# SCROLL THROUGH FILE & ANALYSE #############
-  #########################################################
+  decombiner.counts['start_time'] = time()
 
   print("Decombining FASTQ data...")
 
-  suffix = "." + inputargs['extension']
-  samplenam = str(inputargs['fastq'].split(".")[0]) 
-  if os.sep in samplenam: # Cope with situation where specified FQ file is in a subdirectory
-    samplenam = samplenam.split(os.sep)[-1]
+  return opener, decombiner
 
-  # If chain had not been autodetected, write it out into output file
-  if counts['chain_detected'] == 1:
-    name_results = inputargs['prefix'] + samplenam
-  else:
-    name_results = inputargs['prefix'] + samplenam + "_" + chainnams[chain]
-  
-  if inputargs['nobarcoding'] == False:
-    stemplate = string.Template('$v $j $del_v $del_j $nt_insert $seqid $tcr_seq $tcr_qual $barcode $barqual')
-  else:
-    stemplate = string.Template('$v $j $del_v $del_j $nt_insert')
-  found_tcrs = coll.Counter()
-  ############################################################################################
-  ##################################################################################################
-  
-  ##################################################################################
-# Scroll through input file and find TCRs 
+def read_fastq_pairs(inputargs: dict, opener):
+  """
+  Reads the input FASTQ data, splitting each read (pair) into its TCR and barcode parts
+  :return: generator of (read ID, TCR sequence, TCR quality, barcode sequence, barcode quality) tuples
+  """
+
+  # Get Barcode length
+  bclength = inputargs['bclength']
 
-  outdata = []
-  start_time = time()  
   if inputargs['nobarcoding'] == False:
     if inputargs['bc_read'] == "R2":
       fq1 = readfq(opener(inputargs['fastq'],'rt'))
@@ -659,11 +793,9 @@ def decombinator(inputargs: dict) -> list:
       fq1 = readfq(opener(inputargs['fastq'],'rt'))
       fq2 = fq1
       
-    fqs = (fq1, fq2)
     zipfqs = zip(fq1, fq2)
                   
     for records in zipfqs:
-          #print(records)
       record1, record2 = records
       if inputargs['bc_read'] == "R2": 
           readid = record1[0]  
@@ -678,64 +810,19 @@ def decombinator(inputargs: dict) -> list:
           vdjqual = record1[2][bclength:]
           bc =  record1[1][0:bclength]
           bcQ = record1[2][0:bclength]
-          #print(bc)
-          
-      if inputargs['nobarcoding'] == False:
-        if "N" in bc and inputargs['allowNs'] == False:       # Ambiguous base in barcode region
-          counts['dcrfilter_barcodeN'] += 1
-      
-      counts['read_count'] += 1
-      #print(counts['read_count'])
-      if counts['read_count'] % 100000 == 0 and inputargs['dontcount'] == False:
-          print('\t read', counts['read_count'])
-  
-      # Get details of the VJ recombination
-      if inputargs['orientation'] == 'reverse':
-        recom = dcr(revcomp(vdj), inputargs)
-        frame = 'reverse'
-      elif inputargs['orientation'] == 'forward':
-        recom = dcr(vdj, inputargs)
-        frame = 'forward'
-      elif inputargs['orientation'] == 'both':
-        recom = dcr(revcomp(vdj), inputargs)
-        frame = 'reverse'
-        if not recom:
-          recom = dcr(vdj, inputargs)
-          frame = 'forward'
-    
-      if recom:
-        #print("TEST1")
-        counts['vj_count'] += 1
-          
-        
-        if frame == 'reverse':
-          tcrseq = revcomp(vdj)[recom[5]:recom[6]]
-          tcrQ = vdjqual[::-1][recom[5]:recom[6]]
-        elif frame == 'forward':
-          tcrseq = vdj[recom[5]:recom[6]]
-          tcrQ = vdjqual[recom[5]:recom[6]]
-    
-        if inputargs['nobarcoding'] == False:
-          dcr_output = [str(recom[0]), str(recom[1]), str(recom[2]), \
-                        str(recom[3]), recom[4], readid, tcrseq, \
-                        tcrQ, bc, bcQ]     
-          outdata.append(dcr_output)
-
-        else: # TODO: create non-barcode alternative OR delete non-barcode methodology
-          dcr_string = stemplate.substitute( v = str(recom[0]) + ',', j = str(recom[1]) + ',', del_v = str(recom[2]) + ',', \
-          del_j = str(recom[3]) + ',', nt_insert = recom[4])      
-          found_tcrs[dcr_string] += 1
-          outdata.append(dcr_string)
 
-  if inputargs['nobarcoding'] == True:
-    # Write out non-barcoded results, with frequencies
-    if inputargs['extension'] == 'n12':
-      print("Non-barcoding option selected, but default output file extension (n12) detected. Automatically changing to 'nbc'.")
-      suffix = '.nbc'
-    for x in found_tcrs.most_common():
-      outdata.append(x[0] + ", " + str(found_tcrs[x[0]]))
-      
-  
+      yield readid, vdj, vdjqual, bc, bcQ
+
+def finish_decombining(inputargs: dict, decombiner: Decombiner = None):
+  """ Reports on the reads decombined (by decombiner, or that set up by import_tcr_info), and writes the Decombinator summary file """
+
+  decombiner = decombiner or default_decombiner
+  counts, chain = decombiner.counts, decombiner.chain
+
+  samplenam = str(inputargs['fastq'].split(".")[0]) 
+  if os.sep in samplenam: # Cope with situation where specified FQ file is in a subdirectory
+    samplenam = samplenam.split(os.sep)[-1]
+
   counts['end_time'] = time()
   timetaken = counts['end_time']-counts['start_time']
   
@@ -815,8 +902,6 @@ def decombinator(inputargs: dict) -> list:
     print(summstr,file=summaryfile) 
     summaryfile.close()
     sort_permissions(summaryname)
-  
-  return outdata
 
 
 if __name__ == "__main__":
@@ -44,6 +44,7 @@
   
   # -dz/--dontgzip: Suppress the automatic compression of output demultiplexed FASTQ files with gzip. 
     # Using this flag makes the script execute faster, but data will require more storage space. 
+    # Otherwise output files (including undetermined reads) are compressed as they are written. 
     
   # -dc/--dontcount: Suppress whether or not to show the running line count, every 100,000 reads. 
     # Helps in monitoring progress of large batches. 
@@ -56,6 +57,16 @@
   # -cl/--compresslevel: Allows user to specify the speed of gzip compression of output files as an integer from 1 to 9. 
     # 1 is the fastest but offers least compression, 9 is the slowest and offers the most compression. Default for this program is 4. 
 
+  # -th/--threads: Number of threads used to compress output files. Above 1, files are compressed in parallel blocks,
+    # producing standard multi-member gzip files, with each file compressed on its own threads in the background. Default = 1.
+
+  # -mo/--maxopen: Maximum number of output files kept open at once (each sample has an R1 and an R2 file). Default = 256.
+    # Above this, the least recently used are closed (and reopened if needed), e.g. for --outputall runs.
+
+  # -w/--workers: Number of worker processes to demultiplex reads with. Default = 1.
+    # Above 1, each worker writes its own part of every output file, which are joined at the end; reads are then not
+    # kept in their input order.
+
 # To see all options, run: python Demultiplexor.py -h
 
 
@@ -87,9 +98,13 @@ import argparse
 import gzip
 import os
 import itertools
+import shutil
+import queue
+import multiprocessing as mp
 import Levenshtein as lev
 import collections as coll
 from Bio.Seq import Seq
+from dcr_utilities import open_compressed
 
 __version__ = '4.0.2'
 
@@ -130,6 +145,12 @@ def args():
       '-ex', '--extension', type=str, help='Specify the file extension of the output FASTQ files. Default = \"fq\"', required=False, default="fq")
   parser.add_argument(
       '-cl', '--compresslevel', type=int, choices=range(1, 10), help='Specify compression level for output files', required=False, default=4)
+  parser.add_argument(
+      '-th', '--threads', type=int, help='Number of threads used to compress output files. Default = 1', required=False, default=1)
+  parser.add_argument(
+      '-w', '--workers', type=int, help='Number of worker processes to demultiplex reads with. Default = 1', required=False, default=1)
+  parser.add_argument(
+      '-mo', '--maxopen', type=int, help='Maximum number of output files to keep open at once. Default = 256', required=False, default=256)
   return parser.parse_args()
 
 ############################################
@@ -198,12 +219,86 @@ def readfq(fp):
                 yield name, seq, None # yield a fasta record instead
                 break
 
+def open_fastq(infile):
+  """open_fastq(file): Opens a FASTQ file for reading, whether or not it is gzip compressed"""
+
+  if infile.endswith('.gz'):
+    return gzip.open(infile, 'rt')
+  else:
+    return open(infile)
+
 def sort_permissions(fl):
   # Need to ensure proper file permissions on output data
     # If users are running pipeline through Docker might otherwise require root access
   if oct(os.stat(fl).st_mode)[4:] != '666':
     os.chmod(str(fl), 0o666)
 
+# Number of reads demultiplexed at a time (and passed to each worker at a time, when there are several)
+demultiplex_batch_size = 10000
+
+# Size of the block of records held in memory for each output file before it is written out, and of the records held for
+# all output files together
+output_block_size = 256 * 1024
+output_buffer_limit = 64 * 1024 * 1024
+
+class OutputPool:
+  """
+  OutputPool: the demultiplexed output files, which are kept open between reads and written to in large blocks. Only
+  max_open files are open at once: beyond that, the least recently written are closed, to be reopened (for appending)
+  if needed, so that runs with many outputs (e.g. --outputall) stay within the open file limit.
+  Unless compresslevel is None, the files are gzip-compressed as they are written (with threads above 1, in the
+  background on that many threads per file); reopened files carry on as a new gzip member
+  """
+
+  def __init__(self, max_open, compresslevel=None, threads=1):
+    self.max_open = max(max_open, 1)
+    self.compresslevel = compresslevel
+    self.threads = threads
+    self.handles = coll.OrderedDict()
+    self.blocks = coll.defaultdict(list)
+    self.block_sizes = coll.Counter()
+    self.buffered = 0
+    self.filenames = []           # Every file written to, in the order first written
+
+  def create(self, filename):
+    # Makes sure that a file is written, even if no records are
+    self.blocks.setdefault(filename, [])
+
+  def write(self, filename, record):
+    self.blocks[filename].append(record)
+    self.block_sizes[filename] += len(record)
+    self.buffered += len(record)
+    if self.block_sizes[filename] >= output_block_size:
+      self.flush(filename)
+    elif self.buffered >= output_buffer_limit:
+      for f in list(self.blocks):
+        self.flush(f)
+
+  def flush(self, filename):
+    if filename in self.handles:
+      self.handles.move_to_end(filename)
+    else:
+      if len(self.handles) >= self.max_open:
+        self.handles.popitem(last=False)[1].close()
+      # Files are started afresh the first time they are written to in a run
+      mode = "ab" if filename in self.filenames else "wb"
+      if self.compresslevel is None:
+        self.handles[filename] = open(filename, mode)
+      else:
+        self.handles[filename] = open_compressed(filename, self.compresslevel, self.threads, mode)
+      if filename not in self.filenames:
+        self.filenames.append(filename)
+
+    self.handles[filename].write("".join(self.blocks.pop(filename)).encode())
+    self.buffered -= self.block_sizes.pop(filename, 0)
+
+  def close(self):
+    for f in list(self.blocks):
+      self.flush(f)
+    for handle in self.handles.values():
+      handle.close()
+    self.handles.clear()
+
 def read_index_single_file(inputargs):
 
   suffix = "." + inputargs['extension']
@@ -240,10 +335,6 @@ def read_index_single_file(inputargs):
 
 def read_index_dual_file(inputargs):
 
-  suffix = "." + inputargs['extension']
-
-  failed1 = open("Undetermined_R1" + suffix, "w")
-  failed2 = open("Undetermined_R2" + suffix, "w")
   outputreads = coll.Counter()
   outputreads["Undetermined"] = 0
 
@@ -264,17 +355,15 @@ def read_index_dual_file(inputargs):
     index1 = revcomp(elements[1])
     index2 = elements[2]
 
-    #open(sample + "_R1" + suffix, "w").close()
-    #open(sample + "_R2" + suffix, "w").close()
     compound_index = index2 + index1 
     
-    XXdict1[compound_index] = sample + "_R1" + suffix
+    XXdict1[compound_index] = sample
     
     outputreads[sample] = 0
     usedindexes[sample] = compound_index
     
     
-  return XXdict1, outputreads, usedindexes, failed1, failed2
+  return XXdict1, outputreads, usedindexes
 
 
 ###############################################
@@ -284,123 +373,99 @@ def read_index_dual_file(inputargs):
 def revcomp(x):
   return str(Seq(x).reverse_complement())
 
+# Bases that can appear in index reads
+index_bases = 'ACGTN'
+
+# Number of clashing index pairs listed before a run
+clash_report_pairs = 20
+
+# Highest fuzzy matching threshold to build tables of the near matches of the indexes for; the number of near matches
+# grows too quickly beyond this, so higher thresholds compare each read with every index instead (as is done for reads
+# of lengths that no index has)
+fuzzy_table_max_threshold = 2
+
+def index_neighbours(index, threshold, length):
+  """index_neighbours(): Every sequence of the given length within the edit distance threshold of an index"""
+
+  found = {index} if len(index) == length else set()
+  frontier = {index}
+  for step in range(threshold):
+    # Only keep edits that can still end up at the right length
+    remaining = threshold - step - 1
+    edited = set()
+    for seq in frontier:
+      if len(seq) - 1 >= length - remaining:
+        edited.update(seq[:i] + seq[i+1:] for i in range(len(seq)))
+      if len(seq) + 1 <= length + remaining:
+        edited.update(seq[:i] + b + seq[i:] for i in range(len(seq) + 1) for b in index_bases)
+      if abs(len(seq) - length) <= remaining:
+        edited.update(seq[:i] + b + seq[i+1:] for i in range(len(seq)) for b in index_bases if b != seq[i])
+    frontier = edited
+    found.update(x for x in edited if len(x) == length)
+
+  return found
+
+def build_fuzzy_table(XXdict1, threshold, length):
+  """
+  build_fuzzy_table(): Finds the index that each possible index read of the given length fuzzily matches
+  :return: dictionary of every sequence within the threshold of exactly one index, to that index, and dictionary of
+  every sequence within the threshold of more than one index (i.e. clashing), to the set of those indexes
+  """
+
+  near_matches = {}
+  clashes = coll.defaultdict(set)
+  for ndx in XXdict1:
+    for seq in index_neighbours(ndx, threshold, length):
+      if seq in clashes:
+        clashes[seq].add(ndx)
+      elif seq in near_matches:
+        clashes[seq].update([near_matches.pop(seq), ndx])
+      else:
+        near_matches[seq] = ndx
 
-inputargs = vars(args())
-
-if inputargs['outputall'] == False and not inputargs['indexlist']:
-  print("No indexing file provided, and output all option not enabled; one (or both) is required.")
-  sys.exit()
-
-for f in [inputargs['read1'], inputargs['read2'], inputargs['index1']]:
-  if fastq_check(f) == False:
-    print("FASTQ sanity check failed reading", f, "- please ensure that this file is properly formatted and/or gzip compressed.")
-    sys.exit()
-  
-##########################################################
-############ CREATE DICTIONARIES FOR INDEXES #############
-##########################################################
-
-# Version 4.0.1 (and above) introduces new SP2 indexes 27-102
-
-# SP1 index = R1 (our own, RC1 proximal index)
-X1dict = {"1":"ATCACG", "2":"CGATGT", "3":"TTAGGC", "4":"TGACCA", "5":"ACAGTG", "6":"GCCAAT", "7": "CAGATC", "8":"ACTTGA", "9":"GATCAG", "10":"TAGCTT","11":"GGCTAC", "12":"CTTGTA", "13":"TAGACT"}
-# NB: One index removed due to similarity to others, but exists in earlier datasets: "14":"ACACGG" 
-
-# 'SP2' index = R2 (index read, comes first in rearranged sequence)
-X2dict = {"1":"CGTGAT", "2":"ACATCG", "3":"GCCTAA", "4":"TGGTCA", "5":"CACTGT", "6":"ATTGGC", "7":"GATCTG", "8":"TCAAGT", "9":"CTGATC", "10":"AAGCTA", "11":"GTAGCC", "12":"TACAAG", "13":"TTGACT", "14":"GGAACT", "15":"CCTGGTAG", "16":"TAAGCATG", "17":"AGATGTGC", "18":"GTCGAGCA", "19":"GAATTGCT", "20":"AAGCAACT", "21":"CTAACTGG", "22":"AGGCTCAA", "23":"CAGTTGGT","24": "TCTGGACC", "25":"TGTTATAC", "26":"TCAGCGAA", \
-          "27":"ACATAGCG", "28":"TGTGCTTA", "29":"GATGTTAC", "30":"GTCTTAGT", "31":"GAGTTACA", "32":"CCATTGTT", "33":"TGCGAAGG", "34":"CAACGGTC", "35":"CTTGCAGA", "36":"AGGATGTG", "37":"TAGATCCT", "38":"TAGATGAC", "39":"CTAGGTTC", "40":"GTGCGTAA", "41":"TCGCACCT", "42":"CGATCATG", "43":"GTTGCGGC", "44":"AGATATAA", "45":"CGCCACAG", "46":"AATGCGTT", "47":"GTCAAGTT", "48":"GGAAGGCG", "49":"TCCTGGTC", "50":"ACCAAGGA", \
-          "51":"AGTGTCTT", "52":"GATTACAG", "53":"ACTTCTTC", "54":"GTTCATTA", "55":"TTGCTGGA", "56":"CTGTGGAC", "57":"GACTATTG", "58":"CCTTACCT", "59":"GCTAAGTA", "60":"CTTCCTTC", "61":"TCGCTATG", "62":"CAGACAAT", "63":"GAGAGTTG", "64":"CCTAGAAT", "65":"CAGCAGCA", "66":"GGCTAGGC", "67":"GGCATAGG", "68":"GACGCTAT", "69":"ATCCGACA", "70":"TTACTGTC", "71":"TCGACGGC", "72":"CCTGGATA", "73":"AACATAAT", "74":"AATGTTGG", \
-          "75":"TGGATATC", "76":"TACTTGCA", "77":"AGAACATT", "78":"TACCGCTG", "79":"AGAGGAAT", "80":"ATCCGCAG", "81":"CATCAGAC", "82":"GGCAGATA", "83":"GATCGTGT", "84":"AGCTCTGG", "85":"GTTAGGTC", "86":"CAAGGCGA", "87":"ATGGTAGG", "88":"TCTAGCGA", "89":"ACATCCTT", "90":"CGAGTTAG", "91":"ATACCTGT", "92":"GACCGAGA", "93":"TCAACTGT", "94":"ACGCATAG", "95":"GGCTCCTG", "96":"TGCGACCT", "97":"CCTTGCTG", "98":"TTGATAAT", \
-          "99":"CTGATTAA", "100":"TGGTAACG", "101":"CTCTACTT", "102":"CTATTCAA"}
-
-##########################################################
-########### GENERATE SAMPLE-NAMED OUTPUT FILES ###########
-##########################################################
+  return near_matches, clashes
 
-suffix = "." + inputargs['extension']
-
-# If given an indexlist, use that to generate named output files
-if inputargs['indexlist']:
-  # if two index files submitted
-  if inputargs['index2']:
-    XXdict1, outputreads, usedindexes, failed1, failed2 = read_index_dual_file(inputargs)
-    sample_names =list(outputreads.keys())
-    #print(sample_names)
-    #exit()
-  # if one index file sumbitted
-  else:
-    XXdict, outputreads, usedindexes, failed = read_index_single_file(inputargs)
-    
-###############################################################################################################
-# If the outputall option is chosen, output all possible index combinations that exist in the data
-  # Note that if an indexlist is provided, those names are still used in the appropriate output files
-  # Also note that while all combinations are looked for, those which remain unused at the end will be deleted
-  
-if inputargs['outputall'] == True:
-  
-  # generate all possible index combinations, and then check if they have been generated yet (via an index file)
-    # only make those that haven't
-  allXcombs = [x + "-" + y for x in X1dict.keys() for y in X2dict.keys()]
-  
-  for x in allXcombs:
-    compound_index = X1dict[x.split("-")[0]] + X2dict[x.split("-")[1]]
-    
-    if compound_index not in usedindexes.values():
-      XXdict1[compound_index] = open("Indexes_" + x + suffix, "a")
-      outputreads["Indexes_" + x] = 0
-      usedindexes["Indexes_" + x] = compound_index
-####################################################################################################################      
-if __name__ == '__main__':
-  count = 0
-  dmpd_count = 0          # number successfully demultiplexed 
-  fuzzy_count = 0         # number of sequences that were demultiplexed using non-exact index matches
-  clash_count = 0         # number of fuzzy ID clashes
+def fuzzy_match(seqX, XXdict1, threshold, fuzzy_tables):
+  """
+  fuzzy_match(): Finds the index an index read is within the threshold of, if there is only one
+  :return: the matching index (or None), and whether the read was within the threshold of more than one index
+  """
 
-  fuzzies = []            # list to record IDs matched using fuzzy indexes
+  # Reads of other lengths (e.g. truncated ones) are rare, and not worth building a table for
+  if len(seqX) not in fuzzy_tables:
+    matches = [ndx for ndx in XXdict1 if lev.distance(ndx, seqX) <= threshold]
+    return (matches[0] if len(matches) == 1 else None), len(matches) > 1
 
-  print("Running Demultiplexor version", __version__)
-  t0 = time.time() # Begin timer
-    
-  ##########################################################
-  ########### LOOP THROUGH ALL READ FILES IN SYNC ##########
-  ######## PROCESS INTO CORRECT FORMAT & DEMULTIPLEX #######
-  ##########################################################
+  near_matches, clashes = fuzzy_tables[len(seqX)]
+  return near_matches.get(seqX), seqX in clashes
 
-  print("Reading input files...")
+def report_index_clashes(XXdict1, clashes, threshold):
+  """report_index_clashes(): Lists the indexes whose fuzzy matches overlap, so that reads between them would be discarded"""
 
-  # Open read files
-  if inputargs['read1'].endswith('.gz'):
-    fq1 = readfq(gzip.open(inputargs['read1'],'rt'))
-  else:
-    fq1 = readfq(open(inputargs['read1']))
-    
-  if inputargs['index1'].endswith('.gz'):
-    fq2 = readfq(gzip.open(inputargs['index1'], 'rt'))
-  else:
-    fq2 = readfq(open(inputargs['index1'])) 
+  if not clashes:
+    return
 
-  if inputargs['read2'].endswith('.gz'):
-    fq3 = readfq(gzip.open(inputargs['read2'], 'rt'))
-  else:
-    fq3 = readfq(open(inputargs['read2']))
+  pairs = coll.Counter(frozenset(XXdict1[x] for x in ndxs) for ndxs in clashes.values())
+  print("Warning:", len(clashes), "possible index reads are within", threshold, "edits of more than one index, " \
+        "so reads with them will be discarded as index clashes:")
+  for samples, n in pairs.most_common(clash_report_pairs):
+    print("  ", " & ".join(sorted(samples)) + ":", n, "sequences")
+  if len(pairs) > clash_report_pairs:
+    print("   ...and", len(pairs) - clash_report_pairs, "more")
 
-  if inputargs['index2']:
-    if inputargs['index2'].endswith('.gz'):
-      fq4 = readfq(gzip.open(inputargs['index2'], 'rt'))
-    else:
-      fq4 = readfq(open(inputargs['index2'])) 
 
-  print("Demultiplexing data...")
-
-  if inputargs['index2']:
-      fqs = (fq1, fq2, fq3, fq4)
-      zipfqs = zip(fq1, fq2, fq3, fq4)
-  else:
-      fqs = (fq1, fq2, fq3)
-      zipfqs = zip(fq1, fq2, fq3)
+def demultiplex_reads(reads, outputs, XXdict1, inputargs, fuzzy_tables, suffix, counts, outputreads, fuzzies):
+  """
+  demultiplex_reads(): Assigns each read to a sample by its index reads, writing it out to that sample's output files
+  :param reads: iterable of tuples of the readfq records of a read from each input file (R1, I1, R2 and, if given, I2)
+  :param outputs: OutputPool to write the reads to
+  :param suffix: output file name suffix (extension)
+  :param counts: Counter of the reads processed, demultiplexed, fuzzily demultiplexed and with index clashes, added to
+  :param outputreads: Counter of the reads output for each sample, added to
+  :param fuzzies: list of the IDs of reads demultiplexed using fuzzy index matching, added to
+  """
 
-#  for record1, record2, record3 in zip(fq1, fq2, fq3):
-  for records in zipfqs:
+  for records in reads:
 
     if inputargs['index2']:
       record1, record2, record3, record4 = records
@@ -409,12 +474,8 @@ if __name__ == '__main__':
 
     # Readfq function will return each read from each file as a 3 part tuple
       # ('ID', 'SEQUENCE', 'QUALITY')
-    count += 1    
+    counts['read_count'] += 1
 
- #   if count % 100000 == 0 and inputargs['dontcount'] == False:
-    if count % 1000 == 0 and inputargs['dontcount'] == False:
-        print('\t read', count)
-        
                #os.unlink(f + "_R1"+ suffix) 
 ####################################################################################
   #      exit()
@@ -476,100 +537,274 @@ if __name__ == '__main__':
         
     if seqX in XXdict1:
       # Exact index matches
-      filename_1 = open(XXdict1[seqX],"a")     
-      filename_1.write(new_record1)
-      filename_1.close()
-      filename_2 = open(XXdict1[seqX].replace("R1.f","R2.f"),"a")
-      filename_2.write(new_record2)
-      filename_2.close()
-      dmpd_count += 1
+      outputs.write(XXdict1[seqX] + "_R1" + suffix, new_record1)
+      outputs.write(XXdict1[seqX] + "_R2" + suffix, new_record2)
+      counts['demultiplexed'] += 1
       outputreads[XXdict1[seqX]] += 1
       #Sprint(sample_names)
     else:
       # Otherwise allow fuzzy matching
       
-      matches = []
+      match, clash = fuzzy_match(seqX, XXdict1, inputargs['threshold'], fuzzy_tables)
       
-      for ndx in XXdict1.keys():
-        
-        if lev.distance(ndx, seqX) <= inputargs['threshold']:
-          matches.append(ndx)
-      
-      if len(matches) == 1:
+      if match:
         # Only allow fuzzy match if there is one candidate match within threshold
         #print("fuzzy")
-        filename_1 = open(XXdict1[matches[0]],"a")
-        filename_2 = open(XXdict1[matches[0]].replace("R1.f","R2.f"),"a")
-        
-        #print(filename_1)
-        filename_1.write(new_record1)
-        filename_1.close()
-        filename_2.write(new_record2)
-        filename_2.close()
-        dmpd_count += 1
-        fuzzy_count += 1
+        outputs.write(XXdict1[match] + "_R1" + suffix, new_record1)
+        outputs.write(XXdict1[match] + "_R2" + suffix, new_record2)
+        counts['demultiplexed'] += 1
+        counts['fuzzy'] += 1
         fuzzies.append(fq_id)
         #print(XXdict1[matches[0]])
         #exit()
-        outputreads[XXdict1[matches[0]]] += 1
+        outputreads[XXdict1[match]] += 1
         
       else:
         
-        if len(matches) > 1:
-          clash_count += 1
+        if clash:
+          counts['clash'] += 1
           
-        failed1.write(new_record1)
-        failed2.write(new_record2)
+        outputs.write("Undetermined_R1" + suffix, new_record1)
+        outputs.write("Undetermined_R2" + suffix, new_record2)
         outputreads['Undetermined'] += 1
-        
-  for x in XXdict1.values():
-    open(x).close
-    sort_permissions(open(x).name)
+
+def read_batches(reads, inputargs):
+  """read_batches(): Splits the input reads into batches to demultiplex, showing the running count as it goes"""
+
+  count = 0
+  while True:
+    batch = list(itertools.islice(reads, demultiplex_batch_size))
+    if not batch:
+      return
+    if (count + len(batch)) // 100000 > count // 100000 and inputargs['dontcount'] == False:
+      print('\t read', (count + len(batch)) // 100000 * 100000)
+    count += len(batch)
+    yield batch
+
+def demultiplex_worker(worker, batch_queue, results_queue, XXdict1, inputargs, fuzzy_tables, suffix, sample_names):
+  # Demultiplexes batches of reads into the worker's own part of each output file, then sends back its counts
+  outputs = OutputPool(inputargs['maxopen'] // inputargs['workers'], None if inputargs['dontgzip'] else inputargs['compresslevel'],
+                       inputargs['threads'])
+  part_suffix = suffix + ".part" + str(worker)
+  for f in sample_names:
+    outputs.create(f + "_R1" + part_suffix)
+    outputs.create(f + "_R2" + part_suffix)
+
+  counts = coll.Counter()
+  outputreads = coll.Counter()
+  fuzzies = []
+  while True:
+    batch = batch_queue.get()
+    if batch is None:
+      break
+    demultiplex_reads(batch, outputs, XXdict1, inputargs, fuzzy_tables, part_suffix, counts, outputreads, fuzzies)
+
+  outputs.close()
+  results_queue.put((counts, outputreads, fuzzies, [x[:-len(part_suffix)] + suffix for x in outputs.filenames]))
+
+def parallel_demultiplex(batches, XXdict1, inputargs, fuzzy_tables, suffix, sample_names, counts, outputreads, fuzzies):
+  """
+  parallel_demultiplex(): Demultiplexes batches of reads on worker processes, each writing its own part of every output
+  file. The parts are joined end to end once all reads are done, in the same worker order for R1 and R2 so that they
+  stay in step; gzip files can be joined this way as each part is a complete gzip member
+  :return: names of the output files written
+  """
+
+  ctx = mp.get_context('fork')
+  batch_queue = ctx.Queue(maxsize=inputargs['workers'] * 2)
+  results_queue = ctx.Queue()
+  workers = [ctx.Process(target=demultiplex_worker, args=(k, batch_queue, results_queue, XXdict1, inputargs, fuzzy_tables,
+                                                          suffix, sample_names))
+             for k in range(inputargs['workers'])]
+  for worker in workers:
+    worker.start()
+
+  def check_workers():
+    # Don't wait forever if one of the workers has failed
+    if any(worker.exitcode for worker in workers):
+      raise RuntimeError("A demultiplexing worker stopped unexpectedly")
+
+  def put_batch(batch):
+    while True:
+      try:
+        return batch_queue.put(batch, timeout=1)
+      except queue.Full:
+        check_workers()
+
+  finished = False
+  try:
+    for batch in itertools.chain(batches, [None] * len(workers)):
+      put_batch(batch)
+
+    output_names = []
+    for _ in workers:
+      while True:
+        try:
+          worker_counts, worker_outputreads, worker_fuzzies, worker_names = results_queue.get(timeout=1)
+          break
+        except queue.Empty:
+          check_workers()
+      counts.update(worker_counts)
+      outputreads.update(worker_outputreads)
+      fuzzies.extend(worker_fuzzies)
+      output_names += [x for x in worker_names if x not in output_names]
+
+    for worker in workers:
+      worker.join()
+    finished = True
+  finally:
+    if not finished:
+      for worker in workers:
+        worker.terminate()
+
+  for name in output_names:
+    with open(name, 'wb') as outfile:
+      for k in range(len(workers)):
+        part = name[:-len(suffix)] + suffix + ".part" + str(k)
+        if os.path.exists(part):
+          with open(part, 'rb') as infile:
+            shutil.copyfileobj(infile, outfile, output_block_size)
+          os.remove(part)
+
+  return output_names
+
+
+##########################################################
+############ CREATE DICTIONARIES FOR INDEXES #############
+##########################################################
+
+# Version 4.0.1 (and above) introduces new SP2 indexes 27-102
+
+# SP1 index = R1 (our own, RC1 proximal index)
+X1dict = {"1":"ATCACG", "2":"CGATGT", "3":"TTAGGC", "4":"TGACCA", "5":"ACAGTG", "6":"GCCAAT", "7": "CAGATC", "8":"ACTTGA", "9":"GATCAG", "10":"TAGCTT","11":"GGCTAC", "12":"CTTGTA", "13":"TAGACT"}
+# NB: One index removed due to similarity to others, but exists in earlier datasets: "14":"ACACGG" 
+
+# 'SP2' index = R2 (index read, comes first in rearranged sequence)
+X2dict = {"1":"CGTGAT", "2":"ACATCG", "3":"GCCTAA", "4":"TGGTCA", "5":"CACTGT", "6":"ATTGGC", "7":"GATCTG", "8":"TCAAGT", "9":"CTGATC", "10":"AAGCTA", "11":"GTAGCC", "12":"TACAAG", "13":"TTGACT", "14":"GGAACT", "15":"CCTGGTAG", "16":"TAAGCATG", "17":"AGATGTGC", "18":"GTCGAGCA", "19":"GAATTGCT", "20":"AAGCAACT", "21":"CTAACTGG", "22":"AGGCTCAA", "23":"CAGTTGGT","24": "TCTGGACC", "25":"TGTTATAC", "26":"TCAGCGAA", \
+          "27":"ACATAGCG", "28":"TGTGCTTA", "29":"GATGTTAC", "30":"GTCTTAGT", "31":"GAGTTACA", "32":"CCATTGTT", "33":"TGCGAAGG", "34":"CAACGGTC", "35":"CTTGCAGA", "36":"AGGATGTG", "37":"TAGATCCT", "38":"TAGATGAC", "39":"CTAGGTTC", "40":"GTGCGTAA", "41":"TCGCACCT", "42":"CGATCATG", "43":"GTTGCGGC", "44":"AGATATAA", "45":"CGCCACAG", "46":"AATGCGTT", "47":"GTCAAGTT", "48":"GGAAGGCG", "49":"TCCTGGTC", "50":"ACCAAGGA", \
+          "51":"AGTGTCTT", "52":"GATTACAG", "53":"ACTTCTTC", "54":"GTTCATTA", "55":"TTGCTGGA", "56":"CTGTGGAC", "57":"GACTATTG", "58":"CCTTACCT", "59":"GCTAAGTA", "60":"CTTCCTTC", "61":"TCGCTATG", "62":"CAGACAAT", "63":"GAGAGTTG", "64":"CCTAGAAT", "65":"CAGCAGCA", "66":"GGCTAGGC", "67":"GGCATAGG", "68":"GACGCTAT", "69":"ATCCGACA", "70":"TTACTGTC", "71":"TCGACGGC", "72":"CCTGGATA", "73":"AACATAAT", "74":"AATGTTGG", \
+          "75":"TGGATATC", "76":"TACTTGCA", "77":"AGAACATT", "78":"TACCGCTG", "79":"AGAGGAAT", "80":"ATCCGCAG", "81":"CATCAGAC", "82":"GGCAGATA", "83":"GATCGTGT", "84":"AGCTCTGG", "85":"GTTAGGTC", "86":"CAAGGCGA", "87":"ATGGTAGG", "88":"TCTAGCGA", "89":"ACATCCTT", "90":"CGAGTTAG", "91":"ATACCTGT", "92":"GACCGAGA", "93":"TCAACTGT", "94":"ACGCATAG", "95":"GGCTCCTG", "96":"TGCGACCT", "97":"CCTTGCTG", "98":"TTGATAAT", \
+          "99":"CTGATTAA", "100":"TGGTAACG", "101":"CTCTACTT", "102":"CTATTCAA"}
+
+def demultiplex(inputargs):
+  """
+  demultiplex(): Demultiplexes a run's reads into per-sample FASTQ files, by their index reads
+  :param inputargs: command line (argparse) input arguments dictionary, as from args()
+  :return: dictionary of the run's statistics: the numbers of reads processed ('read_count'), demultiplexed
+  ('demultiplexed'), demultiplexed using fuzzy index matching ('fuzzy') and with fuzzy index clashes ('clash'), the
+  number of reads output for each sample ('sample_reads'), the output files written ('output_files') and the seconds taken
+  """
+
+  if inputargs['outputall'] == False and not inputargs['indexlist']:
+    print("No indexing file provided, and output all option not enabled; one (or both) is required.")
+    sys.exit()
+
+  for f in [inputargs['read1'], inputargs['read2'], inputargs['index1']]:
+    if fastq_check(f) == False:
+      print("FASTQ sanity check failed reading", f, "- please ensure that this file is properly formatted and/or gzip compressed.")
+      sys.exit()
+
+  ##########################################################
+  ########### GENERATE SAMPLE-NAMED OUTPUT FILES ###########
+  ##########################################################
+
+  # Output files are gzip-compressed as they are written, unless told not to
+  suffix = "." + inputargs['extension'] + ("" if inputargs['dontgzip'] else ".gz")
+
+  # If given an indexlist, use that to generate named output files
+  if inputargs['indexlist']:
+    # if two index files submitted
+    if inputargs['index2']:
+      XXdict1, outputreads, usedindexes = read_index_dual_file(inputargs)
+      sample_names =list(outputreads.keys())
+      #print(sample_names)
+      #exit()
+    # if one index file sumbitted
+    else:
+      XXdict, outputreads, usedindexes, failed = read_index_single_file(inputargs)
+    
+  ###############################################################################################################
+  # If the outputall option is chosen, output all possible index combinations that exist in the data
+    # Note that if an indexlist is provided, those names are still used in the appropriate output files
+    # Also note that while all combinations are looked for, those which remain unused at the end will be deleted
   
+  if inputargs['outputall'] == True:
+  
+    # generate all possible index combinations, and then check if they have been generated yet (via an index file)
+      # only make those that haven't
+    allXcombs = [x + "-" + y for x in X1dict.keys() for y in X2dict.keys()]
+  
+    for x in allXcombs:
+      compound_index = X1dict[x.split("-")[0]] + X2dict[x.split("-")[1]]
+    
+      if compound_index not in usedindexes.values():
+        XXdict1[compound_index] = "Indexes_" + x
+        outputreads["Indexes_" + x] = 0
+        usedindexes["Indexes_" + x] = compound_index
+
+  counts = coll.Counter() # numbers of reads processed ('read_count'), successfully demultiplexed ('demultiplexed'),
+                          # demultiplexed using non-exact index matches ('fuzzy') and with fuzzy ID clashes ('clash')
+
+  fuzzies = []            # list to record IDs matched using fuzzy indexes
+
+  print("Running Demultiplexor version", __version__)
+  t0 = time.time() # Begin timer
+
+  # Tables of the reads within the fuzzy matching threshold of each index, for each of the indexes' lengths, so that fuzzy
+  # matching is a single look up for reads of those lengths. Building them also finds any clashes between indexes
+  fuzzy_tables = {}
+  for length in sorted(set(len(x) for x in XXdict1)) if inputargs['threshold'] <= fuzzy_table_max_threshold else []:
+    fuzzy_tables[length] = build_fuzzy_table(XXdict1, inputargs['threshold'], length)
+    report_index_clashes(XXdict1, fuzzy_tables[length][1], inputargs['threshold'])
+    
+  ##########################################################
+  ########### LOOP THROUGH ALL READ FILES IN SYNC ##########
+  ######## PROCESS INTO CORRECT FORMAT & DEMULTIPLEX #######
+  ##########################################################
+
+  print("Reading input files...")
+
+  # Open read files
+  fqs = [open_fastq(inputargs[x]) for x in ['read1', 'index1', 'read2', 'index2'] if inputargs[x]]
+
+  print("Demultiplexing data...")
+
+  zipfqs = zip(*(readfq(f) for f in fqs))
+
+  # Reads are demultiplexed in batches, on worker processes if there are to be more than one
+  if inputargs['workers'] > 1:
+    output_names = parallel_demultiplex(read_batches(zipfqs, inputargs), XXdict1, inputargs, fuzzy_tables, suffix,
+                                        sample_names, counts, outputreads, fuzzies)
+  else:
+    outputs = OutputPool(inputargs['maxopen'], None if inputargs['dontgzip'] else inputargs['compresslevel'], inputargs['threads'])
+    # Every sample in the index file gets output files, as do undetermined reads, even if no reads are assigned them
+    for f in sample_names:
+      outputs.create(f + "_R1" + suffix)
+      outputs.create(f + "_R2" + suffix)
+
+    for batch in read_batches(zipfqs, inputargs):
+      demultiplex_reads(batch, outputs, XXdict1, inputargs, fuzzy_tables, suffix, counts, outputreads, fuzzies)
+
+    outputs.close()
+    output_names = outputs.filenames
+
+  for x in output_names:
+    sort_permissions(x)
   
-  failed1.close()
-  failed2.close()  
-  sort_permissions(failed1.name)
-  sort_permissions(failed2.name)
   for f in fqs:
       f.close()
+
+  count, dmpd_count, fuzzy_count, clash_count = (counts[x] for x in ['read_count', 'demultiplexed', 'fuzzy', 'clash'])
   
   # If output all is allowed, delete all unused index combinations
   if inputargs['outputall'] == True:
-    for f in outputreads.keys():
-      if outputreads[f] == 0:
-        os.remove(f + suffix)
-        del outputreads[f]
-        del usedindexes[f]
+    for f in [x for x in outputreads.keys() if outputreads[x] == 0 and x != "Undetermined"]:
+      for fl in [f + "_R1" + suffix, f + "_R2" + suffix]:
+        if os.path.exists(fl):
+          os.remove(fl)
+      del outputreads[f]
+      del usedindexes[f]
 
-  # Gzip compress output
- 
- ##########################################################################################################################
-  
-  if inputargs['dontgzip'] == False:
-           print("Compressing demultiplexed files...")
-           for f in sample_names:
-              #print(f)
-              with open(f+"_R1"+ suffix) as infile, gzip.open(f + "_R1"+suffix + '.gz', 'wt',compresslevel=inputargs['compresslevel']) as outfile:
-                outfile.writelines(infile)
-                sort_permissions(outfile.name)
-                print(f+"_R1"+ suffix,"compressed to",f+"_R1"+suffix+'.gz')         
-              try: 
-                os.remove(f + '_R1' + suffix) 
-                #print("works")
-              except: 
-                continue
-              with open(f+"_R2"+ suffix) as infile, gzip.open(f + "_R2"+suffix + '.gz', 'wt',compresslevel=inputargs['compresslevel']) as outfile:
-                outfile.writelines(infile)
-                sort_permissions(outfile.name)
-                print(f+"_R2"+ suffix,"compressed to",f+"_R2"+suffix+'.gz')         
-              try: 
-                os.remove(f + '_R2' + suffix) 
-                #print("works")
-              except: 
-                continue
-             
-             
   #################################################
   ################## STATISTICS ###################
   #################################################
@@ -658,3 +893,10 @@ if __name__ == '__main__':
 
     fuzzout.close()
     sort_permissions(fuzzname)
+
+  return {'read_count': count, 'demultiplexed': dmpd_count, 'fuzzy': fuzzy_count, 'clash': clash_count,
+          'sample_reads': dict(outputreads), 'output_files': output_names, 'time_taken': timed}
+
+if __name__ == '__main__':
+
+  demultiplex(vars(args()))
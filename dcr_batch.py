@@ -0,0 +1,166 @@
+import os
+import sys
+import csv
+import argparse
+import contextlib
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from time import time, strftime
+import Decombinator
+import CDR3translator
+from dcr_pipeline import Pipeline
+from dcr_utilities import build_parser, sort_permissions
+
+from datetime import datetime
+
+# Sample sheet columns, and the pipeline flags they are passed to each sample as
+sample_sheet_columns = {'fastq': '-fq', 'chain': '-c', 'oligo': '-ol', 'bc_read': '-br'}
+
+def batch_args():
+    """batch_args(): Obtains the batch runner's own command line arguments, and those passed on to every sample"""
+
+    parser = argparse.ArgumentParser(
+        description='Runs dcr_pipeline.py over every sample in a sample sheet, in parallel. Any other arguments are passed on \
+        to the pipeline for every sample, e.g. "python dcr_batch.py -in samples.csv -j 8 -dz -bi".', allow_abbrev=False)
+    parser.add_argument(
+        '-in', '--samplesheet', type=str, help='CSV (or .tsv) file with a header row and columns ' + ', '.join(sample_sheet_columns) \
+        + ', one row per sample', required=True)
+    parser.add_argument(
+        '-j', '--jobs', type=int, help='Number of samples to run at once. Default = number of CPUs', required=False,
+        default=os.cpu_count())
+
+    batchargs, pipeline_argv = parser.parse_known_args()
+    return vars(batchargs), pipeline_argv
+
+def read_sample_sheet(samplesheet, pipeline_argv):
+    """
+    Reads the sample sheet, checking each sample's arguments with the pipeline's own parser
+    :param samplesheet: path to the CSV or TSV sample sheet
+    :param pipeline_argv: pipeline command line arguments shared by every sample
+    :return: list of input argument dictionaries, one per sample, largest FASTQ first
+    """
+
+    delimiter = "\t" if samplesheet.endswith(".tsv") else ","
+    with open(samplesheet, newline='') as sheet:
+        rows = list(csv.DictReader(sheet, delimiter=delimiter))
+
+    if not rows or not all(column in rows[0] for column in sample_sheet_columns):
+        print("Sample sheet", samplesheet, "must have a header row including the columns", ', '.join(sample_sheet_columns))
+        sys.exit()
+
+    parser = build_parser()
+    samples = []
+    for row in rows:
+        sample_argv = [x for column, flag in sample_sheet_columns.items() for x in [flag, row[column].strip()]]
+        samples.append(vars(parser.parse_args(sample_argv + pipeline_argv)))
+        if not os.path.isfile(samples[-1]['fastq']):
+            print("Cannot find FASTQ file", samples[-1]['fastq'], "listed in", samplesheet)
+            sys.exit()
+
+    # Start the longest samples first, so that the batch takes about as long as its largest sample
+    return sorted(samples, key=lambda x: os.path.getsize(x['fastq']), reverse=True)
+
+def preload_gene_data(samples):
+    # Build the tag tries and read in the germline data for each chain once, to be inherited by every sample's process
+    for inputargs in samples:
+        Decombinator.Decombiner(dict(inputargs))
+        CDR3translator.Translator(dict(inputargs))
+
+def sample_name(inputargs):
+    return os.path.basename(inputargs['fastq']).split(".")[0] + "_" + str(inputargs['chain'])
+
+def run_sample(inputargs, conn):
+    # Runs one sample in its own process, with its output going to its own log file, and reports back how it went
+    logname = "Logs/" + sample_name(inputargs) + "_pipeline.log"
+    result = {'sample': sample_name(inputargs), 'fastq': inputargs['fastq'], 'log': logname}
+    t0 = time()
+    pipeline = Pipeline(inputargs)
+
+    with open(logname, 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            data = pipeline.run()
+            result.update({'status': 'complete', 'output_rearrangements': len(data)})
+        except BaseException as err:
+            # Includes the sys.exit() calls the pipeline makes on bad input
+            print("Pipeline failed:", repr(err))
+            result.update({'status': 'failed', 'error': repr(err)})
+
+    counts = pipeline.decombiner.counts if pipeline.decombiner else {}
+    result.update({'reads': counts.get('read_count', ''), 'reads_decombined': counts.get('vj_count', ''),
+                   'time_taken_s': round(time() - t0, 2)})
+    sort_permissions(logname)
+    conn.send(result)
+
+def run_batch(samples, jobs):
+    """
+    Runs every sample through the pipeline, with up to jobs samples at once, each in a process forked from this one
+    (so inheriting the preloaded gene data)
+    :param samples: list of sample input argument dictionaries, in the order to start them
+    :param jobs: maximum number of samples to run at once
+    :return: list of results, one dictionary per sample
+    """
+
+    ctx = mp.get_context('fork')
+    pending = list(samples)
+    running = {}
+    results = []
+
+    while pending or running:
+        while pending and len(running) < jobs:
+            inputargs = pending.pop(0)
+            receiver, sender = ctx.Pipe(duplex=False)
+            process = ctx.Process(target=run_sample, args=(inputargs, sender))
+            process.start()
+            sender.close()
+            running[process.sentinel] = (process, receiver, inputargs)
+            print("Started", sample_name(inputargs))
+
+        for sentinel in wait(list(running)):
+            process, receiver, inputargs = running.pop(sentinel)
+            if receiver.poll():
+                result = receiver.recv()
+            else:
+                result = {'sample': sample_name(inputargs), 'fastq': inputargs['fastq'], 'status': 'failed',
+                          'error': "process exited with code " + str(process.exitcode)}
+            process.join()
+            receiver.close()
+            results.append(result)
+            print("Finished", result['sample'] + ":", result['status'], "(" + str(len(results)) + "/" + str(len(samples)) + ")")
+
+    return results
+
+def write_batch_log(results, samplesheet):
+    # One combined log for the batch, with a row per sample
+    date = strftime("%Y_%m_%d")
+    logname = "Logs/" + date + "_" + os.path.basename(samplesheet).split(".")[0] + "_Batch_Summary.csv"
+    for i in range(2, 10000):
+        if not os.path.exists(logname):
+            break
+        logname = "Logs/" + date + "_" + os.path.basename(samplesheet).split(".")[0] + "_Batch_Summary" + str(i) + ".csv"
+
+    fields = ['sample', 'fastq', 'status', 'reads', 'reads_decombined', 'output_rearrangements', 'time_taken_s', 'log', 'error']
+    with open(logname, 'w', newline='') as log:
+        writer = csv.DictWriter(log, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+    sort_permissions(logname)
+    return logname
+
+if __name__ == '__main__':
+
+    startTime = datetime.now()
+    batchargs, pipeline_argv = batch_args()
+
+    samples = read_sample_sheet(batchargs['samplesheet'], pipeline_argv)
+    if not os.path.exists('Logs'):
+        os.makedirs('Logs')
+
+    preload_gene_data(samples)
+    results = run_batch(samples, max(batchargs['jobs'], 1))
+    logname = write_batch_log(results, batchargs['samplesheet'])
+
+    failed = [x['sample'] for x in results if x['status'] != 'complete']
+    print("Batch of", len(results), "samples complete in", datetime.now() - startTime, "- summary written to", logname)
+    if failed:
+        print("Failed samples (see their logs in Logs/):", ", ".join(failed))
+        sys.exit(1)
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import signal
+import argparse
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from time import time, strftime, sleep
+from dcr_batch import preload_gene_data, run_sample
+from dcr_utilities import build_parser
+
+# Seconds between checks of the spool directory for new jobs
+spool_poll_interval = 1
+
+# Sub-directories of the spool directory: jobs are submitted to incoming, moved to running while they run, and their
+# results written to done or failed
+spool_dirs = ['incoming', 'running', 'done', 'failed']
+
+def daemon_args():
+    """daemon_args(): Obtains the daemon's command line arguments, and (with --submit) the pipeline arguments of a job"""
+
+    parser = argparse.ArgumentParser(
+        description='Runs pipeline jobs submitted to a spool directory, in processes forked from a daemon that has already \
+        loaded the tag and germline data, so that small samples are not held up by start up costs. Submit a job by \
+        running with --submit followed by the pipeline arguments, e.g. "python dcr_daemon.py -sd spool --submit -fq \
+        sample_R1.fq.gz -c a -br R2 -ol M13".', allow_abbrev=False)
+    parser.add_argument(
+        '-sd', '--spooldir', type=str, help='Spool directory that jobs are submitted to and their results are written to', required=True)
+    parser.add_argument(
+        '-j', '--jobs', type=int, help='Number of jobs to run at once. Default = number of CPUs', required=False,
+        default=os.cpu_count())
+    parser.add_argument(
+        '--species', type=str, nargs='+', help='Species to preload the tag and germline data of. Default = human', required=False,
+        default=['human'])
+    parser.add_argument(
+        '--chains', type=str, nargs='+', help='Chains to preload the tag and germline data of. Default = a b', required=False,
+        default=['a', 'b'])
+    parser.add_argument(
+        '--tags', type=str, help='Tag set to preload. Default = extended', required=False, default="extended")
+    parser.add_argument(
+        '--tagfastadir', type=str, help='Path to folder containing TCR FASTA and Decombinator tag files. \
+        Default = \"Decombinator-Tags-FASTAs\".', required=False, default="Decombinator-Tags-FASTAs")
+    parser.add_argument(
+        '--submit', action='store_true', help='Submit a job with the remaining (pipeline) arguments to the spool directory, \
+        to be run in the current directory, rather than starting the daemon', required=False)
+
+    # Everything after --submit belongs to the pipeline, even options with the same names as the daemon's (e.g. --species)
+    argv = sys.argv[1:]
+    pipeline_argv = []
+    if '--submit' in argv:
+        split = argv.index('--submit') + 1
+        argv, pipeline_argv = argv[:split], argv[split:]
+
+    return vars(parser.parse_args(argv)), pipeline_argv
+
+def submit_job(spooldir, pipeline_argv, cwd):
+    """
+    Submits a pipeline job to a daemon's spool directory
+    :param spooldir: the daemon's spool directory
+    :param pipeline_argv: dcr_pipeline.py command line arguments for the job
+    :param cwd: directory to run the job in, where its output files are written (as if dcr_pipeline.py were run there)
+    :return: the name of the job file
+    """
+
+    jobname = strftime("%Y%m%d_%H%M%S") + "_" + str(os.getpid()) + "_" + str(int(time() * 1e6) % 1000000) + ".json"
+    incoming = os.path.join(spooldir, 'incoming')
+    os.makedirs(incoming, exist_ok=True)
+
+    # Written under a temporary name then renamed, so the daemon never sees a partly written job
+    with open(os.path.join(incoming, "." + jobname), 'w') as jobfile:
+        json.dump({'args': pipeline_argv, 'cwd': os.path.abspath(cwd), 'submitted': strftime("%Y-%m-%d %H:%M:%S")}, jobfile)
+    os.rename(os.path.join(incoming, "." + jobname), os.path.join(incoming, jobname))
+    return jobname
+
+def preload_inputargs(daemonargs):
+    # Pipeline arguments for each species and chain to preload, as if given on the command line
+    parser = build_parser()
+    return [vars(parser.parse_args(['-fq', 'preload.fq', '-br', 'R2', '-ol', 'M13', '-c', chain, '-sp', species,
+                                    '-tg', daemonargs['tags'], '-tfdir', daemonargs['tagfastadir']]))
+            for species in daemonargs['species'] for chain in daemonargs['chains']]
+
+def run_job(job, conn):
+    # Runs a job in its own process, in the directory it was submitted from
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        os.chdir(job['cwd'])
+        inputargs = vars(build_parser().parse_args(job['args']))
+    except BaseException as err:
+        # Includes argparse's exit on bad arguments
+        conn.send({'status': 'failed', 'error': "Could not start job: " + repr(err)})
+        return
+
+    if not os.path.exists('Logs'):
+        os.makedirs('Logs')
+    run_sample(inputargs, conn)
+
+def claim_jobs(spooldir, n):
+    # Moves up to n of the oldest submitted jobs into running, returning their names and contents
+    incoming = os.path.join(spooldir, 'incoming')
+    claimed = []
+    for jobname in sorted(x for x in os.listdir(incoming) if x.endswith(".json") and not x.startswith(".")):
+        if len(claimed) == n:
+            break
+        running = os.path.join(spooldir, 'running', jobname)
+        try:
+            os.rename(os.path.join(incoming, jobname), running)
+        except FileNotFoundError:
+            # Taken by another daemon sharing the spool directory
+            continue
+        try:
+            with open(running) as jobfile:
+                claimed.append((jobname, json.load(jobfile)))
+        except ValueError as err:
+            finish_job(spooldir, jobname, {}, {'status': 'failed', 'error': "Could not read job file: " + repr(err)})
+
+    return claimed
+
+def finish_job(spooldir, jobname, job, result):
+    # Writes a job's result next to the job itself, in done or failed
+    job.update(result)
+    job['finished'] = strftime("%Y-%m-%d %H:%M:%S")
+    outdir = os.path.join(spooldir, 'done' if result['status'] == 'complete' else 'failed')
+    with open(os.path.join(outdir, "." + jobname), 'w') as resultfile:
+        json.dump(job, resultfile, indent=1)
+    os.rename(os.path.join(outdir, "." + jobname), os.path.join(outdir, jobname))
+    os.remove(os.path.join(spooldir, 'running', jobname))
+    print(job['finished'], "Finished", jobname + ":", result['status'])
+
+def run_daemon(daemonargs):
+    """
+    Runs jobs from the spool directory until stopped (with SIGTERM or Ctrl-C), each in a process forked from this one,
+    so that they inherit the preloaded tag and germline data. Jobs still running when stopped are finished first
+    :param daemonargs: the daemon's command line arguments dictionary
+    """
+
+    spooldir = daemonargs['spooldir']
+    for subdir in spool_dirs:
+        os.makedirs(os.path.join(spooldir, subdir), exist_ok=True)
+
+    # Jobs left running by a daemon that didn't shut down cleanly are run again
+    for jobname in os.listdir(os.path.join(spooldir, 'running')):
+        os.rename(os.path.join(spooldir, 'running', jobname), os.path.join(spooldir, 'incoming', jobname))
+
+    preload_gene_data(preload_inputargs(daemonargs))
+
+    stopping = []
+    def stop(signum, frame):
+        print("Stopping once running jobs are finished...")
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    ctx = mp.get_context('fork')
+    running = {}
+    jobs = max(daemonargs['jobs'], 1)
+    print("Waiting for jobs in", os.path.join(spooldir, 'incoming'))
+
+    while not stopping or running:
+        if not stopping:
+            for jobname, job in claim_jobs(spooldir, jobs - len(running)):
+                receiver, sender = ctx.Pipe(duplex=False)
+                process = ctx.Process(target=run_job, args=(job, sender))
+                process.start()
+                sender.close()
+                running[process.sentinel] = (process, receiver, jobname, job)
+                print(strftime("%Y-%m-%d %H:%M:%S"), "Started", jobname, "in", job['cwd'])
+
+        for sentinel in wait(list(running), timeout=spool_poll_interval) if running else []:
+            process, receiver, jobname, job = running.pop(sentinel)
+            if receiver.poll():
+                result = receiver.recv()
+            else:
+                result = {'status': 'failed', 'error': "process exited with code " + str(process.exitcode)}
+            process.join()
+            receiver.close()
+            finish_job(spooldir, jobname, job, result)
+
+        if not running and not stopping:
+            sleep(spool_poll_interval)
+
+if __name__ == '__main__':
+
+    daemonargs, pipeline_argv = daemon_args()
+
+    if daemonargs['submit']:
+        print("Submitted job", submit_job(daemonargs['spooldir'], pipeline_argv, os.getcwd()))
+    else:
+        run_daemon(daemonargs)
@@ -1,26 +1,283 @@
-from Decombinator import decombinator
-from Collapsinator import collapsinator
-from CDR3translator import cdr3translator
-from dcr_utilities import args, write_out_translated, write_out_intermediate
+import collections as coll
+import itertools
+import queue
+import multiprocessing as mp
+import Decombinator
+import Collapsinator
+from Decombinator import Decombiner, decombinator, decombinator_records
+from Collapsinator import Collapser
+from CDR3translator import Translator
+from dcr_utilities import args, write_out_translated, write_out_intermediate, tee_intermediate, \
+    BackgroundIntermediateWriter, find_resumable_intermediate, read_in_intermediate, new_run_profile, profile_stage, \
+    write_run_profile, check_output_format
 
 from datetime import datetime
-startTime = datetime.now()
 
-if __name__ == '__main__':
+# Number of reads passed between parallel stages at a time, and the number of such batches that may be in flight
+# (being read, decombined, parsed or waiting to be collapsed) per decombining worker, which bounds memory use
+stage_batch_size = 5000
+stage_batches_per_worker = 4
+
+def read_stage(inputargs, opener, read_queue, results_queue, in_flight, decombine_workers):
+    # Reads (and decompresses) the FASTQ data, handing batches of reads to the decombining workers
+    batches = itertools.count()
+    reads = Decombinator.read_fastq_pairs(inputargs, opener)
+    for n in batches:
+        batch = list(itertools.islice(reads, stage_batch_size))
+        if not batch:
+            break
+        in_flight.acquire()
+        read_queue.put((n, batch))
+
+    for _ in range(decombine_workers):
+        read_queue.put(None)
+    results_queue.put(('done', n))
+
+def decombine_stage(decombiner, read_queue, out_queue):
+    # Decombines batches of reads, along with the counts they add to the Decombinator summary. Each worker has its own
+    # copy of the decombiner, so its counts only ever hold those of the current batch
+    while True:
+        item = read_queue.get()
+        if item is None:
+            return
+        n, batch = item
+        decombiner.counts.clear()
+        decombiner.counts['read_count'] += len(batch)
+        records = [r for r in (decombiner.decombine_read(*read) for read in batch) if r]
+        out_queue.put((n, records, decombiner.counts))
+
+def barcode_stage(inputargs, decombined_queue, results_queue):
+    # Finds and quality checks the barcodes of batches of decombined reads, ready for Collapsinator to group
+    while True:
+        item = decombined_queue.get()
+        if item is None:
+            return
+        n, records, dcr_counts = item
+        results_queue.put((n, records, *parse_barcodes(records, inputargs), dcr_counts))
+
+def parse_barcodes(records, inputargs):
+    barcode_quality_parameters = [inputargs['minbcQ'], inputargs['bcQbelowmin'], inputargs['avgQthreshold']]
+    parse_counts = coll.Counter()
+    parsed = [Collapsinator.parse_barcoded_read(r, inputargs, barcode_quality_parameters, parse_counts) for r in records]
+    return parsed, parse_counts
+
+def parallel_stage_records(inputargs, decombiner, collapser):
+    """
+    Runs FASTQ reading, decombining, barcode parsing and .n12 writing as separate stages in their own processes,
+    connected by queues of read batches. Batches are put back in their original order, so the output is identical
+    to running the stages in turn. The number of batches in flight is capped, so a slow stage holds up the stages
+    before it rather than letting their output pile up in memory.
+    :param inputargs: command line (argparse) input arguments dictionary
+    :param decombiner: Decombiner to decombine the reads with, whose counts the batches' counts are added to
+    :param collapser: Collapser that the reads are to be collapsed by, whose counts the barcode parsing counts are added to
+    :return: generator of decombined reads (or, with barcode workers, their parsed barcodes, for collapsinator's
+    parsed option); the Decombinator summary and .n12 file are complete once it has been exhausted
+    """
+
+    ctx = mp.get_context('fork')
+    decombine_workers = max(inputargs['decombineworkers'], 1)
+    barcode_workers = inputargs['barcodeworkers']
+
+    opener, decombiner = Decombinator.start_decombining(inputargs, decombiner)
+
+    in_flight = ctx.BoundedSemaphore(decombine_workers * stage_batches_per_worker)
+    read_queue = ctx.Queue(maxsize=decombine_workers * 2)
+    results_queue = ctx.Queue()
+    decombined_queue = ctx.Queue() if barcode_workers else results_queue
+
+    stages = [ctx.Process(target=read_stage, args=(inputargs, opener, read_queue, results_queue, in_flight,
+                                                   decombine_workers))]
+    stages += [ctx.Process(target=decombine_stage, args=(decombiner, read_queue, decombined_queue))
+               for _ in range(decombine_workers)]
+    stages += [ctx.Process(target=barcode_stage, args=(inputargs, decombined_queue, results_queue))
+               for _ in range(barcode_workers)]
+    for stage in stages:
+        stage.start()
+
+    writer = BackgroundIntermediateWriter(inputargs, ".n12", ctx)
+
+    def get_result():
+        # Don't wait forever if one of the stages has failed
+        while True:
+            try:
+                return results_queue.get(timeout=1)
+            except queue.Empty:
+                if any(stage.exitcode for stage in stages):
+                    raise RuntimeError("A parallel pipeline stage stopped unexpectedly")
+
+    finished = False
+    try:
+        pending = {}
+        next_batch = 0
+        total_batches = None
+        while total_batches is None or next_batch < total_batches:
+            result = get_result()
+            if result[0] == 'done':
+                total_batches = result[1]
+                continue
+            pending[result[0]] = result[1:]
+
+            while next_batch in pending:
+                if barcode_workers:
+                    records, parsed, parse_counts, dcr_counts = pending.pop(next_batch)
+                    collapser.counts.update(parse_counts)
+                else:
+                    records, dcr_counts = pending.pop(next_batch)
+                    parsed = records
+
+                previous_count = decombiner.counts['read_count']
+                decombiner.counts.update(dcr_counts)
+                if decombiner.counts['read_count'] // 100000 > previous_count // 100000 and not inputargs['dontcount']:
+                    print('\t read', decombiner.counts['read_count'] // 100000 * 100000)
+
+                writer.write_chunk(records)
+                yield from parsed
+                in_flight.release()
+                next_batch += 1
 
-    inputargs = args()
+        for _ in range(barcode_workers):
+            decombined_queue.put(None)
+        for stage in stages:
+            stage.join()
+        writer.close()
+        finished = True
+    finally:
+        if not finished:
+            for stage in stages:
+                stage.terminate()
+            writer.abort()
 
-    # Run pipline, ovewriting data after each function call to save memory
-    data = decombinator(inputargs)
-    write_out_intermediate(data, inputargs, ".n12")
-    print("Decombinator complete...")
+    Decombinator.finish_decombining(inputargs, decombiner)
 
-    data = collapsinator(data, inputargs)
-    write_out_intermediate(data, inputargs, ".freq")
-    print("Collapsinator complete...")
+class Pipeline:
+    """
+    Runs a sample through Decombinator, Collapsinator and CDR3translator, writing out the intermediate and final files.
+    Each pipeline holds its own Decombiner, Collapser, Translator and run profile rather than using module globals, so
+    several can be run in one process (e.g. from threads), sharing the tag and germline data they have in common
+    """
 
-    data = cdr3translator(data, inputargs)
-    print("CDR3translator complete...")
+    def __init__(self, inputargs: dict, decombiner: Decombiner = None):
+        """
+        :param inputargs: command line (argparse) input arguments dictionary, as from args()
+        :param decombiner: Decombiner to use, otherwise one is made for the sample's chain when it is needed
+        """
+        self.inputargs = inputargs
+        self.decombiner = decombiner
+        self.collapser = None
+        self.translator = None
+        self.profile = None
+
+    def run(self):
+        """
+        :return: the translated data
+        """
+
+        inputargs = self.inputargs
+        check_output_format(inputargs['outputformat'])
+        startTime = datetime.now()
+        self.profile = profile = new_run_profile(inputargs)
+
+        # Settle the chain and tag set up front: the stages would otherwise correct them (e.g. switching mouse runs to
+        # the original tags) only once they start, after the resume check below has compared them with earlier runs'
+        inputargs['chain'] = Decombinator.get_chain(inputargs, coll.Counter())
+        Decombinator.check_tag_set(inputargs, inputargs['chain'])
+
+        # With --resume, pick up from the latest intermediate file that an earlier run completed with the same input
+        # data and parameters
+        freq_file = n12_file = None
+        if inputargs['resume']:
+            freq_file = find_resumable_intermediate(inputargs, ".freq")
+            if not freq_file:
+                n12_file = find_resumable_intermediate(inputargs, ".n12")
+
+        # Run pipline, ovewriting data after each function call to save memory
+        if freq_file:
+            print("Resuming from", freq_file)
+            with profile_stage('read_freq', profile=profile) as stage:
+                data = read_in_intermediate(freq_file)
+                stage['records_out'] = len(data)
+        else:
+            self.collapser = Collapser(inputargs, profile)
+            if n12_file:
+                print("Resuming from", n12_file)
+                with profile_stage('read_n12', profile=profile) as stage:
+                    data = read_in_intermediate(n12_file)
+                    stage['records_out'] = len(data)
+                with profile_stage('collapsinator', len(data), profile) as stage:
+                    data = self.collapser.collapse(data)
+                    stage['records_out'] = len(data)
+            elif inputargs['loadgroups']:
+                # Collapsinator reloads its barcode groups from an earlier run, so there is nothing to decombine
+                with profile_stage('collapsinator', profile=profile) as stage:
+                    data = self.collapser.collapse([])
+                    stage['records_out'] = len(data)
+            else:
+                data = self.decombine_and_collapse()
+
+            with profile_stage('write_freq', len(data), profile):
+                write_out_intermediate(data, inputargs, ".freq")
+            print("Collapsinator complete...")
+
+        with profile_stage('cdr3translator', len(data), profile) as stage:
+            self.translator = Translator(inputargs)
+            data = self.translator.translate(data)
+            stage['records_out'] = len(data)
+        print("CDR3translator complete...")
+
+        with profile_stage('write_translated', len(data), profile):
+            write_out_translated(data, inputargs)
+        write_run_profile(inputargs, profile)
+        print(f"Pipeline complete in {datetime.now() - startTime}")
+
+        return data
+
+    def decombine_and_collapse(self):
+        # Decombines the sample's reads, writing out the .n12 file, and collapses them
+        inputargs, profile, collapser = self.inputargs, self.profile, self.collapser
+        if self.decombiner is None:
+            self.decombiner = Decombiner(inputargs)
+        counts = self.decombiner.counts
+
+        if (inputargs['decombineworkers'] or inputargs['barcodeworkers']) and not inputargs['nobarcoding']:
+            # Reading, decombining, barcode parsing and writing the .n12 file run in parallel processes
+            with profile_stage('decombinator_collapsinator', profile=profile) as stage:
+                stream = parallel_stage_records(inputargs, self.decombiner, collapser)
+                data = collapser.collapse(stream, parsed=inputargs['barcodeworkers'] > 0)
+                coll.deque(stream, maxlen=0)
+                stage.update({'records_in': counts['read_count'], 'records_out': len(data)})
+            print("Decombinator complete...")
+        elif inputargs['streaming']:
+            # Decombined reads are collapsed as they are found, with the .n12 file written in the background as they pass
+            with profile_stage('decombinator_collapsinator', profile=profile) as stage:
+                stream = tee_intermediate(decombinator_records(inputargs, self.decombiner), inputargs, ".n12")
+                data = collapser.collapse(stream)
+                # Make sure all reads have been decombined (and so the .n12 file and Decombinator summary are
+                # complete), even if Collapsinator stopped reading early
+                coll.deque(stream, maxlen=0)
+                stage.update({'records_in': counts['read_count'], 'records_out': len(data)})
+            print("Decombinator complete...")
+        else:
+            with profile_stage('decombinator', profile=profile) as stage:
+                data = decombinator(inputargs, self.decombiner)
+                stage.update({'records_in': counts['read_count'], 'records_out': len(data)})
+            with profile_stage('write_n12', len(data), profile):
+                write_out_intermediate(data, inputargs, ".n12")
+            print("Decombinator complete...")
+            with profile_stage('collapsinator', len(data), profile) as stage:
+                data = collapser.collapse(data)
+                stage['records_out'] = len(data)
+
+        return data
+
+def run_pipeline(inputargs):
+    """
+    Runs a sample through Decombinator, Collapsinator and CDR3translator, writing out the intermediate and final files
+    :param inputargs: command line (argparse) input arguments dictionary, as from args()
+    :return: the translated data
+    """
+
+    return Pipeline(inputargs).run()
+
+if __name__ == '__main__':
 
-    write_out_translated(data, inputargs)
-    print(f"Pipeline complete in {datetime.now() - startTime}")
\ No newline at end of file
+    run_pipeline(args())
\ No newline at end of file
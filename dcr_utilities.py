@@ -1,11 +1,34 @@
 import os
+import io
+import gc
+import sys
 import gzip
+import json
+import hashlib
+import zlib
+import struct
+import queue
+import pstats
+import cProfile
 import argparse
+import resource
+import threading
+import contextlib
+from time import time, perf_counter, strftime, localtime
+import collections as coll
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
 def args():
     """args(): Obtains command line arguments which dictate the script's behaviour"""
 
+    return vars(build_parser().parse_args())
+
+def build_parser():
+    """build_parser(): Builds the parser for the pipeline's command line arguments, e.g. to parse those of each sample
+    in a batch"""
+
     # Help flag
     parser = argparse.ArgumentParser(
         description='Decombinator v4.2.0: find rearranged TCR sequences in HTS data. Please go to https://innate2adaptive.github.io/Decombinator/ for more details.')
@@ -20,6 +43,14 @@ def args():
         '-s', '--suppresssummary', action='store_true', help='Suppress the production of summary data log file', required=False)
     parser.add_argument(
         '-dz', '--dontgzip', action='store_true', help='Stop the output FASTQ files automatically being compressed with gzip', required=False)
+    parser.add_argument(
+        '-cl', '--compresslevel', type=int, choices=range(1, 10), help='gzip compression level (1-9) of the output files. Lower is faster, but gives larger files. Default = 9', \
+        required=False, default=9)
+    parser.add_argument(
+        '-bi', '--binaryintermediates', action='store_true', help='Write the .n12 and .freq intermediate files in a compact binary format \
+        (.n12.bin/.freq.bin), which is smaller and much faster to read back in than gzipped text', required=False)
+    parser.add_argument(
+        '-th', '--threads', type=int, help='Number of threads used to compress output files. Default = 1', required=False, default=1)
     parser.add_argument(
         '-dk', '--dontcheck', action='store_true', help='Skip the FASTQ check', required=False, default=False)  
     parser.add_argument(
@@ -41,6 +72,22 @@ def args():
     parser.add_argument(
         '-tfdir', '--tagfastadir', type=str, help='Path to folder containing TCR FASTA and Decombinator tag files, for offline analysis. \
         Default = \"Decombinator-Tags-FASTAs\".', required=False, default="Decombinator-Tags-FASTAs")
+    parser.add_argument(
+        '-st', '--streaming', action='store_true', help='Stream decombined reads straight into Collapsinator as they are found, \
+        writing the .n12 file in the background, rather than holding all of them in memory first', required=False)
+    parser.add_argument(
+        '-dw', '--decombineworkers', type=int, help='Run the pipeline as parallel stages (FASTQ reading, decombining, barcode parsing \
+        and .n12 writing each in their own processes), with this many decombining worker processes. Default = 0 (stages run in turn)', \
+        required=False, default=0)
+    parser.add_argument(
+        '-bw', '--barcodeworkers', type=int, help='Number of barcode parsing worker processes when running parallel stages (see -dw). \
+        With 0, barcodes are parsed by Collapsinator itself. Default = 0', required=False, default=0)
+    parser.add_argument(
+        '-rs', '--resume', action='store_true', help='Reuse the .n12 and .freq intermediate files of an earlier run, if they were \
+        completed from the same input FASTQ data with the same parameters, skipping the stages that made them', required=False)
+    parser.add_argument(
+        '-pd', '--profiledir', '--profile-dir', type=str, help='Run each pipeline stage under cProfile, saving a .pstats file \
+        per stage to this directory and a report of the slowest functions of each to Logs', required=False, default=None)
     parser.add_argument(
         '-nbc', '--nobarcoding', action='store_true', help='Option to run Decombinator without barcoding, i.e. so as to run on data produced by any protocol.', required=False)
     parser.add_argument(
@@ -76,15 +123,38 @@ def args():
     parser.add_argument(
         '-wc', '--writeclusters', action='store_true', help='Write cluster data to separate cluster files',\
         required=False, default=False)
+    parser.add_argument(
+        '-wca', '--writeclusterarchive', action='store_true', help='Write cluster data to a single indexed gzip archive, rather than one file per cluster',\
+        required=False, default=False)
     parser.add_argument(
         '-uh', '--UMIhistogram', action='store_true', help='Creates histogram of average UMI cluster sizes',\
         required=False, default=False)
+    parser.add_argument(
+        '-sg', '--savegroups', type=str, help='Save the initial barcode groups to this (gzipped) file, so that clustering parameters can be re-tuned later with -lg',\
+        required=False, default=None)
+    parser.add_argument(
+        '-lg', '--loadgroups', type=str, help='Load initial barcode groups saved with -sg and go straight to clustering, skipping Decombinator and barcode parsing',\
+        required=False, default=None)
+    parser.add_argument(
+        '-sbc', '--sweepbcthresholds', type=int, nargs='+', help='Barcode thresholds (-bc) to sweep over, writing a .freq file and summary row for each \
+        combination with -slv. The pairwise comparisons are only made once, at the loosest thresholds.', required=False, default=None)
+    parser.add_argument(
+        '-slv', '--sweeplevdists', type=int, nargs='+', help='Percentage Levenshtein distances (-lv) to sweep over, in combination with -sbc.',\
+        required=False, default=None)
 
     # CDR3translator arguments
     parser.add_argument('-npf', '--nonproductivefilter', action='store_true', required=False,
                         help='Filter out non-productive reads from the output')
+    parser.add_argument('-tc', '--translationcache', type=str, required=False, default=None,
+                        help='SQLite database in which to cache CDR3 translations between runs, keyed by species, tag set, chain, \
+                        germline files and DCR. Created if it does not exist.')
+    parser.add_argument('-of', '--outputformat', type=str, required=False, default="tsv", choices=["tsv", "parquet", "feather"],
+                        help='Format of the translated output file. Parquet and feather are compressed columnar formats, \
+                        which require pyarrow to be installed. Default = tsv')
+    parser.add_argument('-pr', '--processes', type=int, required=False, default=1,
+                        help='Number of worker processes to translate CDR3s with. Output is identical to a single process run. Default = 1')
  
-    return vars(parser.parse_args())
+    return parser
 
 def sort_permissions(fl):
     """
@@ -97,47 +167,762 @@ def sort_permissions(fl):
     if oct(os.stat(fl).st_mode)[4:] != '666':
         os.chmod(fl, 0o666)
 
-def write_out_intermediate(data: list, inputargs: dict, suffix: str):
+# Size of the write buffer in front of output files, so that compression works on large blocks
+write_buffer_size = 1024 * 1024
+
+# Size of the blocks compressed independently by ParallelGzipWriter
+compress_block_size = 1024 * 1024
+
+class ParallelGzipWriter(io.RawIOBase):
+    """
+    Writable binary file that gzip-compresses its input in fixed-size blocks on a pool of threads (zlib releases the GIL)
+    Each block is written out, in order, as a complete gzip member, so the result is a standard multi-member gzip file
+    that gzip.open, zcat etc. read as normal
+    """
+
+    def __init__(self, filename, compresslevel=9, threads=2, block_size=compress_block_size, mode='wb'):
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.pending = coll.deque()
+        self.max_pending = 2 * threads
+        self.members = 0
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.fileobj = open(filename, mode)
+        self.name = filename
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self.submit_block(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def submit_block(self, block):
+        self.pending.append(self.executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+        # Limit the number of blocks held in memory, by writing out the oldest once enough are queued
+        while len(self.pending) > self.max_pending:
+            self.write_member()
+
+    def write_member(self):
+        self.fileobj.write(self.pending.popleft().result())
+        self.members += 1
+
+    def close(self):
+        if self.closed:
+            return
+        # Always write at least one member, so that empty outputs are still valid gzip files
+        if self.buffer or not (self.members or self.pending):
+            self.submit_block(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.write_member()
+        self.executor.shutdown()
+        self.fileobj.close()
+        super().close()
+
+def open_compressed(filename: str, compresslevel: int, threads: int, mode: str = 'wb'):
+    """
+    :param filename: name of the gzip file to write
+    :param compresslevel: gzip compression level (1-9)
+    :param threads: number of compression threads; above 1, blocks are compressed in parallel by ParallelGzipWriter
+    :param mode: 'wb' to start the file afresh, or 'ab' to add to the end of an existing gzip file (as a new member)
+    :return: writable binary handle, which compresses its input into the file
+    """
+
+    if threads > 1:
+        return ParallelGzipWriter(filename, compresslevel=compresslevel, threads=threads, mode=mode)
+    else:
+        return gzip.GzipFile(filename, mode, compresslevel=compresslevel)
+
+def open_output(outfilename: str, inputargs: dict):
+    """
+    Opens an output file for writing text, gzip-compressing it on the fly unless -dz is set
+    :param outfilename: name of the output file, without any .gz extension
+    :param inputargs: command line (argparse) input arguments dictionary
+    :return: the name of the file actually written to, and the open text handle
+    """
+
+    if inputargs['dontgzip']:
+        return outfilename, open(outfilename, 'w', buffering=write_buffer_size)
+
+    outfilename = outfilename + ".gz"
+    compressed = open_compressed(outfilename, inputargs['compresslevel'], inputargs['threads'])
+    return outfilename, io.TextIOWrapper(io.BufferedWriter(compressed, buffer_size=write_buffer_size))
+
+# Binary intermediate files start with binary_magic and a length-prefixed JSON header, followed by blocks of records.
+# Each block holds a (record count, compressed size) pair and then its records stored column by column, zlib-compressed:
+# DCR indexes and counts as fixed-width integers, sequences packed two bases to a byte, and qualities as raw bytes.
+binary_magic = b'DCRBIN\x01\n'
+binary_block_records = 100000
+binary_seq_alphabet = 'ACGTNRYKMSWBDHV-'
+binary_seq_codes = np.full(256, 255, dtype=np.uint8)
+binary_seq_codes[np.frombuffer(binary_seq_alphabet.encode(), dtype=np.uint8)] = np.arange(len(binary_seq_alphabet))
+
+# Column types: 'index' (DCR indexes, held as strings in memory), 'count', 'str', 'seq', and 'qual' (always
+# following the 'seq' column it belongs to, sharing its lengths)
+binary_schemas = {
+    'n12': [('v_index', 'index'), ('j_index', 'index'), ('v_deletions', 'index'), ('j_deletions', 'index'),
+            ('insert', 'seq'), ('id', 'str'), ('tcr_seq', 'seq'), ('tcr_qual', 'qual'),
+            ('barcode_seq', 'seq'), ('barcode_qual', 'qual')],
+    'freq': [('v_index', 'index'), ('j_index', 'index'), ('v_deletions', 'index'), ('j_deletions', 'index'),
+             ('insert', 'seq'), ('frequency', 'count'), ('av_UMI_cluster_size', 'count')]
+}
+binary_dtypes = {'index': '<u2', 'count': '<u4'}
+
+class BinaryIntermediateWriter:
+    """
+    Writes Decombinator (n12) or Collapsinator (freq) records to a binary intermediate file, a block at a time
+    """
+
+    def __init__(self, filename: str, schema: str, header: dict, compresslevel: int = 6):
+        self.columns = binary_schemas[schema]
+        self.compresslevel = compresslevel
+        self.records = []
+        self.outfile = open(filename, 'wb')
+        header = dict(header, format_version=1, schema=schema, columns=[x[0] for x in self.columns])
+        header = json.dumps(header).encode()
+        self.outfile.write(binary_magic + struct.pack('<I', len(header)) + header)
+
+    def write(self, record):
+        self.records.append(record)
+        if len(self.records) == binary_block_records:
+            self.write_block()
+
+    def write_block(self):
+        payload = []
+        for i, (name, coltype) in enumerate(self.columns):
+            values = [x[i] for x in self.records]
+
+            if coltype in binary_dtypes:
+                numbers = np.array([int(x) for x in values], dtype=np.int64)
+                limits = np.iinfo(binary_dtypes[coltype])
+                if len(numbers) and (numbers.min() < limits.min or numbers.max() > limits.max):
+                    raise ValueError("Cannot write " + name + " values outside " + str(limits.min) + "-" +
+                                     str(limits.max) + " to binary intermediate file")
+                payload.append(numbers.astype(binary_dtypes[coltype]).tobytes())
+
+            elif coltype == 'str':
+                encoded = [x.encode() for x in values]
+                payload.append(np.array([len(x) for x in encoded], dtype='<u4').tobytes() + b''.join(encoded))
+
+            elif coltype == 'seq':
+                seq_lengths = [len(x) for x in values]
+                codes = binary_seq_codes[np.frombuffer(''.join(values).encode('ascii', 'replace'), dtype=np.uint8)]
+                if (codes == 255).any():
+                    raise ValueError("Cannot write non-nucleotide characters in " + name + " to binary intermediate file")
+                if len(codes) % 2:
+                    codes = np.append(codes, 0)
+                packed = (codes[0::2] << 4 | codes[1::2]).astype(np.uint8)
+                payload.append(np.array(seq_lengths, dtype='<u4').tobytes() + packed.tobytes())
+
+            elif coltype == 'qual':
+                if [len(x) for x in values] != seq_lengths:
+                    raise ValueError(name + " does not match the length of its sequence")
+                payload.append(''.join(values).encode('ascii'))
+
+        block = zlib.compress(b''.join(payload), self.compresslevel)
+        self.outfile.write(struct.pack('<II', len(self.records), len(block)) + block)
+        self.records = []
+
+    def close(self):
+        if self.records:
+            self.write_block()
+        self.outfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_binary_header(infile):
+    """
+    :param infile: open binary intermediate file, positioned at its start
+    :return: the file's header dictionary, or None if it is not a binary intermediate file
+    """
+
+    if infile.read(len(binary_magic)) != binary_magic:
+        return None
+    header_length = struct.unpack('<I', infile.read(4))[0]
+    return json.loads(infile.read(header_length))
+
+def read_binary_block(payload: bytes, n: int, columns: list) -> list:
+    """
+    :param payload: decompressed block of column data
+    :param n: number of records in the block
+    :param columns: (name, type) pairs of the block's columns
+    :return: list of the block's records, in the same form as produced in memory by the pipeline
+    """
+
+    out_columns = []
+    pos = 0
+
+    def split(joined, lengths):
+        # Separating the values with null bytes lets str.split do the slicing, which is much faster than doing it in Python
+        if not n:
+            return []
+        separated = np.insert(joined, np.cumsum(lengths)[:-1].astype(np.int64), 0)
+        return separated.tobytes().decode().split('\0')
+
+    for name, coltype in columns:
+        if coltype in binary_dtypes:
+            width = np.dtype(binary_dtypes[coltype]).itemsize
+            values = np.frombuffer(payload, dtype=binary_dtypes[coltype], count=n, offset=pos)
+            if coltype == 'index' and n:
+                # Indexes take few distinct values, so each is only converted to a string once
+                as_str = [str(x) for x in range(int(values.max()) + 1)]
+                out_columns.append([as_str[x] for x in values.tolist()])
+            else:
+                out_columns.append(values.tolist())
+            pos += width * n
+
+        else:
+            if coltype != 'qual':
+                lengths = np.frombuffer(payload, dtype='<u4', count=n, offset=pos)
+                pos += 4 * n
+            total = int(lengths.sum())
+
+            if coltype == 'str':
+                out_columns.append(split(np.frombuffer(payload, dtype=np.uint8, count=total, offset=pos), lengths))
+                pos += total
+
+            elif coltype == 'seq':
+                packed = np.frombuffer(payload, dtype=np.uint8, count=(total + 1) // 2, offset=pos)
+                codes = np.empty(2 * len(packed), dtype=np.uint8)
+                codes[0::2] = packed >> 4
+                codes[1::2] = packed & 15
+                alphabet = np.frombuffer(binary_seq_alphabet.encode(), dtype=np.uint8)
+                out_columns.append(split(alphabet[codes[:total]], lengths))
+                pos += len(packed)
+
+            elif coltype == 'qual':
+                out_columns.append(split(np.frombuffer(payload, dtype=np.uint8, count=total, offset=pos), lengths))
+                pos += total
+
+    # The records contain no reference cycles, so the garbage collector is paused rather than left to rescan them
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return list(map(list, zip(*out_columns)))
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+def read_in_intermediate(filename: str) -> list:
+    """
+    Reads an intermediate .n12 or .freq file back in, whether written as (gzipped) text or in the binary format
+    :param filename: path to the intermediate file
+    :return: list of records, as produced in memory by Decombinator (n12) or Collapsinator (freq)
+    """
+
+    data = []
+
+    with open(filename, 'rb') as infile:
+        header = read_binary_header(infile)
+
+        if header:
+            columns = binary_schemas[header['schema']]
+            while True:
+                block_info = infile.read(8)
+                if not block_info:
+                    break
+                n, block_length = struct.unpack('<II', block_info)
+                data.extend(read_binary_block(zlib.decompress(infile.read(block_length)), n, columns))
+            return data
+
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rt') as infile:
+        for line in infile:
+            fields = line.rstrip("\n").split(", ")
+            if len(fields) == len(binary_schemas['freq']):
+                fields[5:] = [int(x) for x in fields[5:]]
+            data.append(fields)
+
+    return data
+
+def intermediate_filename(inputargs: dict, suffix: str) -> str:
+    """ Name of an intermediate file, before any .gz or .bin extension """
     chain = inputargs["chain"]
     chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
     filename_id = os.path.basename(inputargs['fastq']).split(".")[0]
-    outfilename = f"dcr_{filename_id}" + f"_{chainnams[chain]}" + suffix
-    with open(outfilename, 'w') as outfile:
-        for line in data:
-            outfile.write(", ".join(map(str, line)) + "\n")
+    return f"dcr_{filename_id}" + f"_{chainnams[chain]}" + suffix
 
-    if not inputargs['dontgzip']:
-        print("Compressing intermediate output file to", outfilename + ".gz")
+# Run parameters that each intermediate file depends on. These are recorded in a .meta file alongside it, together
+# with hashes of the input FASTQ data, so that --resume can tell whether the intermediate can be reused
+decombinator_parameters = ['species', 'chain', 'tags', 'tagfastadir', 'allowNs', 'orientation', 'lenthreshold',
+                           'bc_read', 'bclength', 'nobarcoding']
+collapsinator_parameters = ['minbcQ', 'bcQbelowmin', 'avgQthreshold', 'percentlevdist', 'bcthreshold',
+                            'positionalbarcodes', 'oligo', 'loadgroups', 'sweepbcthresholds', 'sweeplevdists']
+intermediate_parameters = {'.n12': decombinator_parameters,
+                           '.freq': decombinator_parameters + collapsinator_parameters}
+input_hash_cache = {}
 
-        with open(outfilename) as infile, gzip.open(outfilename + '.gz', 'wt') as outfile:
-            outfile.writelines(infile)
-        os.unlink(outfilename)
+def input_files(inputargs: dict) -> list:
+    """ The input FASTQ file(s) that the intermediate files are made from """
+    infiles = [inputargs['fastq']]
+    if inputargs['bc_read'] == "R2" and not inputargs['nobarcoding']:
+        infiles.append(inputargs['fastq'].replace("1.f", "2.f"))
+    return infiles
 
-        outfilenam = outfilename + ".gz"
+def input_hash(infile: str) -> str:
+    """
+    SHA-256 hash of an input file, only calculated once per process for each version of the file
+    :param infile: path to the file
+    :return: hex digest
+    """
 
+    stat = os.stat(infile)
+    key = (os.path.abspath(infile), stat.st_size, stat.st_mtime_ns)
+    if key not in input_hash_cache:
+        digest = hashlib.sha256()
+        with open(infile, 'rb') as inhandle:
+            for block in iter(lambda: inhandle.read(write_buffer_size), b''):
+                digest.update(block)
+        input_hash_cache[key] = digest.hexdigest()
+    return input_hash_cache[key]
+
+def input_fingerprints(inputargs: dict) -> dict:
+    """
+    Identifies the input FASTQ file(s) by size and modification time, which is cheap. Their SHA-256 hashes are only
+    added with --resume, as hashing means reading all of the input an extra time
+    :param inputargs: command line (argparse) input arguments dictionary
+    :return: dictionary of {FASTQ file name: {'size', 'mtime_ns' and, with --resume, 'sha256'}}
+    """
+
+    fingerprints = {}
+    for infile in input_files(inputargs):
+        stat = os.stat(infile)
+        fingerprints[os.path.basename(infile)] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if inputargs['resume']:
+            fingerprints[os.path.basename(infile)]['sha256'] = input_hash(infile)
+    return fingerprints
+
+def same_input(recorded: dict, inputargs: dict) -> bool:
+    """
+    Checks whether the input fingerprints recorded for an intermediate file match the current input. Files with the
+    same size and modification time are taken to be unchanged; otherwise (e.g. for copied files) they are hashed, and
+    only match if their hashes were recorded and are the same
+    """
+
+    infiles = {os.path.basename(x): x for x in input_files(inputargs)}
+    if not isinstance(recorded, dict) or set(recorded) != set(infiles):
+        return False
+
+    for name, fingerprint in recorded.items():
+        stat = os.stat(infiles[name])
+        if not isinstance(fingerprint, dict) or fingerprint.get('size') != stat.st_size:
+            return False
+        if fingerprint.get('mtime_ns') != stat.st_mtime_ns and fingerprint.get('sha256') != input_hash(infiles[name]):
+            return False
+
+    return True
+
+def resume_metadata(inputargs: dict, suffix: str) -> dict:
+    # The parts of an intermediate file's metadata that must be the same to resume from it, other than its input.
+    # Round trip through JSON so that this compares equal to metadata read back in (e.g. tuples become lists)
+    return json.loads(json.dumps({'format_version': 2, 'stage': suffix.lstrip("."),
+                                  'parameters': {x: inputargs[x] for x in intermediate_parameters[suffix]}}))
+
+def intermediate_metadata(inputargs: dict, suffix: str) -> dict:
+    return dict(resume_metadata(inputargs, suffix), input=input_fingerprints(inputargs))
+
+def find_resumable_intermediate(inputargs: dict, suffix: str):
+    """
+    Looks for an intermediate file from an earlier run that can be used in place of rerunning the stages that made it,
+    i.e. one that was completely written, from the same input data, with the same parameters
+    :param inputargs: command line (argparse) input arguments dictionary
+    :param suffix: intermediate file suffix, ".n12" or ".freq"
+    :return: name of the intermediate file, or None if there is no usable one
+    """
+
+    # Non-barcoded data is not stored as records, so can't be read back in
+    if inputargs['nobarcoding']:
+        return None
+
+    outfilename = intermediate_filename(inputargs, suffix)
+    for candidate in [outfilename + ".bin", outfilename + ".gz", outfilename]:
+        if not os.path.exists(candidate + ".meta"):
+            continue
+        with open(candidate + ".meta") as metafile:
+            metadata = json.load(metafile)
+        if not os.path.exists(candidate) or os.path.getsize(candidate) != metadata.pop('size'):
+            print("Not resuming from", candidate, "- the file is missing or has changed since it was written")
+        elif {k: v for k, v in metadata.items() if k not in ['records', 'input']} != resume_metadata(inputargs, suffix) \
+                or not same_input(metadata.get('input'), inputargs):
+            print("Not resuming from", candidate, "- it was made from different input data or parameters")
+        else:
+            return candidate
+
+    return None
+
+def write_out_intermediate(data: list, inputargs: dict, suffix: str):
+    outfilename = intermediate_filename(inputargs, suffix)
+
+    # Non-barcoded data is not stored as records, so is always written as text
+    if inputargs['binaryintermediates'] and not inputargs['nobarcoding'] and suffix.lstrip(".") in binary_schemas:
+        outfilenam = outfilename + ".bin"
     else:
-        outfilenam = outfilename
+        outfilenam = outfilename + ("" if inputargs['dontgzip'] else ".gz")
+
+    # Any metadata left from an earlier run no longer describes the file once it starts being overwritten
+    if os.path.exists(outfilenam + ".meta"):
+        os.remove(outfilenam + ".meta")
+
+    records = 0
+    try:
+        if outfilenam.endswith(".bin"):
+            print("Writing binary intermediate output file to", outfilenam)
+            header = {x: inputargs[x] for x in ['species', 'tags', 'chain']}
+            with BinaryIntermediateWriter(outfilenam, suffix.lstrip("."), header, inputargs['compresslevel']) as outfile:
+                for line in data:
+                    outfile.write(line)
+                    records += 1
+        else:
+            outfilenam, outfile = open_output(outfilename, inputargs)
+            print("Writing intermediate output file to", outfilenam)
+            with outfile:
+                for line in data:
+                    outfile.write(", ".join(map(str, line)) + "\n")
+                    records += 1
+    except BaseException:
+        # Don't leave a partial file behind if the records stopped coming (e.g. a later stage failed)
+        if os.path.exists(outfilenam):
+            os.remove(outfilenam)
+        raise
 
     sort_permissions(outfilenam)
 
+    # Written last, so it only exists for complete files
+    if suffix in intermediate_parameters:
+        metadata = intermediate_metadata(inputargs, suffix)
+        metadata.update({'records': records, 'size': os.path.getsize(outfilenam)})
+        with open(outfilenam + ".meta", 'w') as metafile:
+            json.dump(metadata, metafile, indent=1)
+        sort_permissions(outfilenam + ".meta")
+
+# Number of records handed to the background writer at a time by tee_intermediate, and the number of such chunks
+# that may be waiting to be written
+tee_chunk_size = 10000
+tee_queue_chunks = 8
+
+class IntermediateWriteAborted(Exception):
+    """Raised in a BackgroundIntermediateWriter's records when the file being written is abandoned"""
+
+class BackgroundIntermediateWriter:
+    """
+    Writes chunks of records to an intermediate file (as write_out_intermediate) in a background thread, or in a
+    separate process if given a multiprocessing context. At most tee_queue_chunks chunks are held waiting to be
+    written, after which write_chunk() blocks until the writer catches up. Once all the records have been written,
+    close() finishes the file; abort() instead abandons it, deleting the partial file and writing no .meta file
+    """
+
+    def __init__(self, inputargs: dict, suffix: str, context=None):
+        self.suffix = suffix
+        if context:
+            self.chunks = context.Queue(maxsize=tee_queue_chunks)
+            self.writer = context.Process(target=self.write, args=(inputargs, suffix))
+        else:
+            self.chunks = queue.Queue(maxsize=tee_queue_chunks)
+            self.writer = threading.Thread(target=self.write, args=(inputargs, suffix))
+        self.writer.start()
+
+    def write(self, inputargs, suffix):
+        try:
+            write_out_intermediate(self.queued_records(), inputargs, suffix)
+        except IntermediateWriteAborted:
+            pass
+
+    def queued_records(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            if chunk == 'abort':
+                raise IntermediateWriteAborted()
+            yield from chunk
+
+    def write_chunk(self, chunk):
+        # Don't wait forever on a full queue if the writer has failed
+        while True:
+            try:
+                self.chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                if not self.writer.is_alive():
+                    raise RuntimeError("Writing of the " + self.suffix + " intermediate file stopped unexpectedly")
+
+    def close(self):
+        self.write_chunk(None)
+        self.writer.join()
+        if getattr(self.writer, 'exitcode', 0):
+            raise RuntimeError("Writing of the " + self.suffix + " intermediate file stopped unexpectedly")
+
+    def abort(self):
+        # The writer may already have stopped, or be too far behind to take the message quickly
+        while self.writer.is_alive():
+            try:
+                self.chunks.put('abort', timeout=1)
+                break
+            except queue.Full:
+                pass
+        self.writer.join()
+
+def tee_intermediate(data, inputargs: dict, suffix: str):
+    """
+    Passes records through unchanged, while a background thread writes them to an intermediate file
+    (as write_out_intermediate), so that writing overlaps with whatever is consuming the records
+    :param data: iterable of records, e.g. from Decombinator.decombinator_records()
+    :param inputargs: command line (argparse) input arguments dictionary
+    :param suffix: intermediate file suffix, e.g. ".n12"
+    :return: generator of the records in data; the file is complete once it has been exhausted. If it is not (e.g. the
+    consumer fails part way through), the partial file is deleted rather than being left to be resumed from
+    """
+
+    writer = BackgroundIntermediateWriter(inputargs, suffix)
+
+    chunk = []
+    finished = False
+    try:
+        for record in data:
+            chunk.append(record)
+            yield record
+            if len(chunk) == tee_chunk_size:
+                writer.write_chunk(chunk)
+                chunk = []
+        writer.write_chunk(chunk)
+        finished = True
+    finally:
+        if finished:
+            writer.close()
+        else:
+            writer.abort()
+
 def write_out_translated(data: pd.DataFrame, inputargs: dict):
-    suffix = ".tsv"
     chain = inputargs["chain"]
     chainnams = {"a": "alpha", "b": "beta", "g": "gamma", "d": "delta"}
     filename_id = os.path.basename(inputargs['fastq']).split(".")[0]
-    outfilename = f"dcr_{filename_id}" + f"_{chainnams[chain]}" + suffix
-    data.to_csv(f"{outfilename}", sep="\t", index=False)
+    outfilename = f"dcr_{filename_id}" + f"_{chainnams[chain]}"
+
+    if inputargs['outputformat'] != "tsv":
+        write_out_columnar(data, outfilename + "." + inputargs['outputformat'], inputargs['outputformat'])
+        return
+
+    outfilename = outfilename + ".tsv"
+    outfilenam, outfile = open_output(outfilename, inputargs)
+    print("Writing pipeline output file to", outfilenam)
+    with outfile:
+        data.to_csv(outfile, sep="\t", index=False)
+
+    sort_permissions(outfilenam)
 
-    if not inputargs['dontgzip']:
-        print("Compressing pipeline output file to", outfilename + ".gz")
+def check_output_format(outputformat: str):
+    """
+    Checks that the packages needed to write the chosen output format are installed, exiting if not, so that a run
+    doesn't fail only once it comes to write its output
+    :param outputformat: tsv, parquet or feather
+    :return: Nothing
+    """
+
+    if outputformat != "tsv":
+        try:
+            import pyarrow
+        except ImportError:
+            print("Writing", outputformat, "output requires the pyarrow package. Please install it (pip install pyarrow), " \
+                  "or use the default tsv output format.")
+            sys.exit()
+
+def write_out_columnar(data: pd.DataFrame, outfilename: str, outputformat: str):
+    """
+    Writes the translated output as a compressed parquet or feather file, keeping column types
+    :param data: the translated output dataframe
+    :param outfilename: name of the output file
+    :param outputformat: parquet or feather
+    :return: Nothing: output is written to outfilename
+    """
 
-        with open(outfilename) as infile, gzip.open(outfilename + '.gz', 'wt') as outfile:
-            outfile.writelines(infile)
-        os.unlink(outfilename)
+    check_output_format(outputformat)
 
-        outfilenam = outfilename + ".gz"
+    # Gene names and T/F flags are dictionary-encoded, and numeric fields left blank (e.g. for non-barcoded data) become nulls
+    data = data.copy()
+    for field in ['v_call', 'j_call', 'productive', 'vj_in_frame', 'stop_codon', 'conserved_c', 'conserved_f']:
+        data[field] = data[field].astype('category')
+    data['duplicate_count'] = pd.to_numeric(data['duplicate_count']).astype('Int64')
+    data['av_UMI_cluster_size'] = pd.to_numeric(data['av_UMI_cluster_size'], errors='coerce')
 
+    print("Writing pipeline output file to", outfilename)
+    if outputformat == "parquet":
+        data.to_parquet(outfilename, engine="pyarrow", compression="zstd", index=False)
     else:
-        outfilenam = outfilename
+        data.to_feather(outfilename, compression="zstd")
+
+    sort_permissions(outfilename)
+
+# Resource use of each pipeline stage, collected by profile_stage once start_run_profile has been called
+run_profile = None
+
+# Number of functions listed for each stage in the --profiledir text report
+profile_report_functions = 25
+
+def start_run_profile(inputargs: dict):
+    """
+    Starts collecting the resource use of the stages of a pipeline run, for write_run_profile, as the current run
+    :param inputargs: command line (argparse) input arguments dictionary
+    :return: the run profile
+    """
+    global run_profile
+    run_profile = new_run_profile(inputargs)
+    return run_profile
+
+def new_run_profile(inputargs: dict):
+    """
+    Starts collecting the resource use of the stages of a pipeline run, to be passed to profile_stage and
+    write_run_profile, e.g. when several runs share a process. With --profiledir, each stage is also run under cProfile
+    (see profile_stage)
+    :param inputargs: command line (argparse) input arguments dictionary
+    :return: the run profile
+    """
+    run_profile = {'start_time': time(), 'start': perf_counter(), 'stages': [],
+                   'usage': resource.getrusage(resource.RUSAGE_SELF),
+                   'children_usage': resource.getrusage(resource.RUSAGE_CHILDREN),
+                   'profiledir': inputargs['profiledir'], 'profiling': False,
+                   'name': intermediate_filename(inputargs, "")}
+
+    if inputargs['profiledir']:
+        os.makedirs(inputargs['profiledir'], exist_ok=True)
+        if not os.path.exists('Logs'):
+            os.makedirs('Logs')
+        reportname = "Logs/" + strftime("%Y_%m_%d") + "_" + run_profile['name'] + "_Profile_Report"
+        for i in range(2, 10000):
+            if not os.path.exists(reportname + ".txt"):
+                break
+            reportname = "Logs/" + strftime("%Y_%m_%d") + "_" + run_profile['name'] + "_Profile_Report" + str(i)
+        run_profile['report'] = reportname + ".txt"
+        open(run_profile['report'], 'w').close()
+        sort_permissions(run_profile['report'])
+
+    return run_profile
+
+def save_stage_profile(name: str, profiler: cProfile.Profile, run_profile: dict):
+    # Dumps a stage's cProfile data for later analysis (e.g. with pstats or snakeviz), and adds its slowest functions
+    # (by cumulative time) to the run's text report
+    statsname = os.path.join(run_profile['profiledir'], run_profile['name'] + "_" + name + ".pstats")
+    profiler.dump_stats(statsname)
+    sort_permissions(statsname)
+
+    with open(run_profile['report'], 'a') as report:
+        print("=" * 100 + "\nStage:", name, "(" + statsname + ")\n" + "=" * 100, file=report)
+        stats = pstats.Stats(profiler, stream=report)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(profile_report_functions)
+
+def peak_rss_mb(usage):
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    return round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+@contextlib.contextmanager
+def profile_stage(name: str, records_in: int = None, profile: dict = None):
+    """
+    Measures the wall time, CPU time and peak memory of a pipeline stage, if a run profile is being collected
+    :param name: name of the stage in the run profile
+    :param records_in: number of records going into the stage, if known at the start
+    :param profile: run profile to add the stage to, from new_run_profile(), otherwise that of the current run
+    :return: context manager giving the stage's profile dictionary, so that record counts can be filled in as they
+    become known. CPU time used by child processes is only included once they have finished, and peak RSS is
+    that of the whole run so far, up to the end of the stage. With --profiledir, the stage is also run under cProfile,
+    unless it is part of a stage that already is (only one profiler can be active at once). This only covers the
+    pipeline's own process, not worker processes
+    """
+
+    stage = {'stage': name, 'records_in': records_in, 'records_out': None}
+    if profile is None:
+        profile = run_profile
+    if profile is None:
+        yield stage
+        return
+
+    profiler = None
+    if profile['profiledir'] and not profile['profiling']:
+        profiler = cProfile.Profile()
+        profile['profiling'] = True
+
+    t0 = perf_counter()
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    children0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        if profiler:
+            with profiler:
+                yield stage
+        else:
+            yield stage
+    finally:
+        if profiler:
+            profile['profiling'] = False
+            save_stage_profile(name, profiler, profile)
+        wall = perf_counter() - t0
+        self1 = resource.getrusage(resource.RUSAGE_SELF)
+        children1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        stage.update({
+            'started_s': round(t0 - profile['start'], 3),
+            'wall_s': round(wall, 3),
+            'user_cpu_s': round(self1.ru_utime - self0.ru_utime, 3),
+            'sys_cpu_s': round(self1.ru_stime - self0.ru_stime, 3),
+            'children_user_cpu_s': round(children1.ru_utime - children0.ru_utime, 3),
+            'children_sys_cpu_s': round(children1.ru_stime - children0.ru_stime, 3),
+            'peak_rss_mb': peak_rss_mb(self1),
+            'children_peak_rss_mb': peak_rss_mb(children1)})
+        stage['cpu_utilisation'] = round((sum(stage[x] for x in ['user_cpu_s', 'sys_cpu_s', 'children_user_cpu_s',
+                                                                 'children_sys_cpu_s']) / wall) if wall else 0, 2)
+        stage['records_per_s'] = round(stage['records_in'] / wall, 1) if stage['records_in'] and wall else None
+        profile['stages'].append(stage)
+
+def write_run_profile(inputargs: dict, profile: dict = None):
+    """
+    Writes the resource use of each stage of the run to a JSON file in Logs, alongside the stage summaries
+    :param inputargs: command line (argparse) input arguments dictionary
+    :param profile: run profile to write, from new_run_profile(), otherwise that of the current run
+    :return: the name of the file written, or None if summaries are suppressed
+    """
+
+    if profile is None:
+        profile = run_profile
+
+    if inputargs['suppresssummary'] or profile is None:
+        return None
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    summary = {
+        'format_version': 1,
+        'input': inputargs['fastq'],
+        'chain': inputargs['chain'],
+        'started': strftime("%Y-%m-%d %H:%M:%S", localtime(profile['start_time'])),
+        'directory': os.getcwd(),
+        'cpus': os.cpu_count(),
+        'arguments': dict(inputargs),
+        'wall_s': round(perf_counter() - profile['start'], 3),
+        'user_cpu_s': round(usage.ru_utime - profile['usage'].ru_utime, 3),
+        'sys_cpu_s': round(usage.ru_stime - profile['usage'].ru_stime, 3),
+        'children_user_cpu_s': round(children.ru_utime - profile['children_usage'].ru_utime, 3),
+        'children_sys_cpu_s': round(children.ru_stime - profile['children_usage'].ru_stime, 3),
+        'peak_rss_mb': peak_rss_mb(usage),
+        'children_peak_rss_mb': peak_rss_mb(children),
+        # Sub-stages (e.g. Collapsinator's) finish before the stages they are part of, so put them in order of starting
+        'stages': sorted(profile['stages'], key=lambda x: (x['started_s'], -x['wall_s']))}
+
+    if not os.path.exists('Logs'):
+        os.makedirs('Logs')
+    profilename = "Logs/" + strftime("%Y_%m_%d") + "_" + intermediate_filename(inputargs, "_Run_Profile")
+    for i in range(2, 10000):
+        if not os.path.exists(profilename + ".json"):
+            break
+        profilename = "Logs/" + strftime("%Y_%m_%d") + "_" + intermediate_filename(inputargs, "_Run_Profile" + str(i))
+
+    with open(profilename + ".json", 'w') as profilefile:
+        json.dump(summary, profilefile, indent=1)
+    sort_permissions(profilename + ".json")
+    print("Run profile written to", profilename + ".json")
+    return profilename + ".json"
 
-    sort_permissions(outfilenam)
\ No newline at end of file